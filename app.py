@@ -9,24 +9,39 @@ xray-report-ui v2.0: Полная переработка
 """
 
 import base64
+import bisect
 import datetime as dt
 import glob
+import gzip
+import hashlib
+import heapq
+import hmac
 import json
+import math
+import mmap
 import os
 import re
 import shutil
+import sqlite3
+import struct
 import subprocess
+import sys
 import tempfile
 import threading
 import time
 import traceback
 import uuid as uuid_lib
+import zlib
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing, contextmanager
 from functools import lru_cache
-from typing import Any, Dict, List, Optional, Tuple
+from operator import itemgetter
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
 import csv as csv_module
 import psutil
 
-from flask import Flask, Response, jsonify, request, send_file
+from flask import Flask, Response, g, has_request_context, jsonify, request, send_file
 
 # Optional import for date parsing
 try:
@@ -35,6 +50,26 @@ try:
 except ImportError:
     HAS_DATEUTIL = False
 
+# Optional faster JSON encoder for pre-serialized responses
+try:
+    import orjson  # type: ignore[import] # pyright: ignore
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
+
+# Optional compressors for negotiated response encoding (gzip is always available)
+try:
+    import brotli  # type: ignore[import] # pyright: ignore
+    HAS_BROTLI = True
+except ImportError:
+    HAS_BROTLI = False
+
+try:
+    import zstandard  # type: ignore[import] # pyright: ignore
+    HAS_ZSTD = True
+except ImportError:
+    HAS_ZSTD = False
+
 APP_HOST = "127.0.0.1"
 APP_PORT = int(os.environ.get("XRAY_REPORT_UI_PORT", "8787"))
 
@@ -53,6 +88,22 @@ USAGE_DIR = "/var/log/xray/usage"
 ACCESS_LOG = os.environ.get("XRAY_ACCESS_LOG", "/var/log/xray/access.log")
 LIVE_STATE_PATH = os.path.join(DATA_DIR, "usage_live.json")
 LIVE_STATE_OFFSET_PATH = os.path.join(DATA_DIR, "usage_state.json")
+DOMAINS_INDEX_PATH = os.path.join(DATA_DIR, "domains_index.json")
+METRICS_DB_PATH = os.path.join(DATA_DIR, "metrics.db")
+LIVE_USER_IDS_PATH = os.path.join(DATA_DIR, "live_user_ids.json")  # user -> bit для масок онлайна
+PARSED_CACHE_DIR = os.path.join(DATA_DIR, "parsed_cache")
+PROFILES_DIR = os.path.join(DATA_DIR, "profiles")  # cProfile-дампы запросов с X-Profile
+# Admin endpoints (profiler) are off unless a token is set in the service environment
+ADMIN_TOKEN = os.environ.get("XRAY_REPORT_UI_ADMIN_TOKEN", "")
+# Public Suffix List, bundled next to app.py (https://publicsuffix.org/list/public_suffix_list.dat)
+PUBLIC_SUFFIX_PATHS = [
+    os.environ.get("XRAY_PUBLIC_SUFFIX_LIST", ""),
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "public_suffix_list.dat"),
+    "/usr/share/publicsuffix/public_suffix_list.dat",
+]
+# Встроенный коллектор: один проход по access.log вместо трёх xray_daily_*.sh
+BUILTIN_COLLECTOR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "xray_collector.py")
+LEGACY_COLLECTOR_SCRIPTS = ("xray_daily_usage.sh", "xray_daily_conns.sh", "xray_daily_report.sh")
 
 SERVICE_UI = "xray-report-ui"
 SERVICE_XRAY_DEFAULT = "xray"
@@ -72,49 +123,140 @@ app = Flask(__name__)
 
 # Cache for dashboard and usage data
 # Оптимизировано для сервера с 3.8GB RAM
-_cache_store: Dict[str, Tuple[Any, float]] = {}
+# Entry: {"value": ..., "ts": stored_at, "version": source version or None,
+#         "tags": frozenset of dependency tags,
+#         "bodies": {"identity": encoded JSON, content-encoding: compressed JSON}}
+_cache_store: Dict[str, Dict[str, Any]] = {}
+_cache_tags: Dict[str, set] = {}  # tag -> keys of entries depending on it
 _cache_lock = threading.Lock()
+_cache_counters = {"hits": 0, "misses": 0}  # get_cached_entry lookups, under _cache_lock
+# TTL is only a backstop: entries are dropped by invalidate_tags() when what they
+# were built from changes (hooks below and sync_usage_cache for usage_dir files)
 CACHE_TTL = {
-    "dashboard": 60.0,  # 60 секунд - баланс между свежестью и CPU
-    "usage": 60.0,      # 60 секунд
+    "dashboard": 3600.0,
+    "usage": 3600.0,
     "live": 5.0,        # 5 секунд для live данных
-    "users": 120.0,     # 2 минуты - пользователи редко меняются
-    "user_stats": 300.0, # 5 минут - тяжёлый расчёт
+    "users": 3600.0,
+    "user_stats": 3600.0,
+    "csv": 3600.0,
+}
+
+# Dependency tags (see invalidate_tags)
+TAG_USAGE = "usage"        # anything built from usage_dir CSVs
+TAG_ALLTIME = "alltime"    # all-time aggregates (depend on every date)
+TAG_CONFIG = "config"      # Xray config: the client list
+TAG_SETTINGS = "settings"  # settings.json (usage_dir, collector options)
+
+def tag_date(date: Any) -> str:
+    return f"date:{date.isoformat() if hasattr(date, 'isoformat') else date}"
+
+def tag_user(email: str) -> str:
+    """Entries embedding this user's displayName (alias)"""
+    return f"user:{email}"
+
+def tag_file(path: str) -> str:
+    return f"file:{os.path.abspath(path)}"
+
+def date_tags(end_date: dt.date, span_days: int) -> List[str]:
+    """tag_date for end_date and the span_days - 1 days before it"""
+    return [tag_date(end_date - dt.timedelta(days=i)) for i in range(span_days)]
+
+# HTTP Cache-Control per endpoint group (responses also carry an ETag,
+# so "no-cache" clients revalidate cheaply with If-None-Match)
+CACHE_CONTROL = {
+    "dashboard": "private, no-cache",
+    "usage": "private, no-cache",
+    "user_stats": "private, no-cache",
+    "events": "private, no-cache",
+    "backups": "private, no-cache",
+    "live": "private, max-age=5",
 }
 
-def get_cached(key: str, ttl: float = 60.0) -> Optional[Any]:
-    """Get value from cache if not expired"""
+def _cache_drop(key: str) -> None:
+    """Remove entry and its tag links (caller holds _cache_lock)"""
+    entry = _cache_store.pop(key, None)
+    if entry is None:
+        return
+    for tag in entry["tags"]:
+        keys = _cache_tags.get(tag)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del _cache_tags[tag]
+
+def get_cached_entry(key: str, ttl: float = 60.0) -> Optional[Dict[str, Any]]:
+    """Get cache entry (value + version) if not expired"""
+    _perf_cache_event("lookups")
     with _cache_lock:
-        if key in _cache_store:
-            value, timestamp = _cache_store[key]
-            if time.time() - timestamp < ttl:
-                return value
-            else:
-                del _cache_store[key]
+        entry = _cache_store.get(key)
+        if entry is not None:
+            if time.time() - entry["ts"] < ttl:
+                _cache_counters["hits"] += 1
+                return entry
+            _cache_drop(key)
+        _cache_counters["misses"] += 1
     return None
 
-def set_cached(key: str, value: Any) -> None:
-    """Store value in cache"""
+def get_cached(key: str, ttl: float = 60.0, version: Optional[str] = None) -> Optional[Any]:
+    """Get value from cache if not expired (and built from the same source version)"""
+    entry = get_cached_entry(key, ttl)
+    if entry is None:
+        return None
+    if version is not None and entry["version"] != version:
+        return None
+    return entry["value"]
+
+def set_cached(key: str, value: Any, version: Optional[str] = None, tags: Any = ()) -> Dict[str, Any]:
+    """Store value in cache (tagged with its dependencies), returns the new entry"""
+    _perf_cache_event("stores")
+    entry = {"value": value, "ts": time.time(), "version": version, "tags": frozenset(tags), "bodies": {}}
     with _cache_lock:
-        _cache_store[key] = (value, time.time())
+        _cache_drop(key)
+        _cache_store[key] = entry
+        for tag in entry["tags"]:
+            _cache_tags.setdefault(tag, set()).add(key)
         # Clean old entries only if cache is really large (increased limit)
         # Allow more entries to improve performance
         if len(_cache_store) > 200:  # Optimized for 3.8GB RAM server
             # Remove oldest 10% of entries (less aggressive cleanup)
-            items = sorted(_cache_store.items(), key=lambda x: x[1][1])
+            items = sorted(_cache_store.items(), key=lambda x: x[1]["ts"])
             remove_count = max(20, len(items) // 10)  # Remove at least 20 or 10%
             for k, _ in items[:remove_count]:
-                del _cache_store[k]
+                _cache_drop(k)
+    return entry
+
+def touch_cached(keys: Sequence[str], ttl: float) -> int:
+    """Restart the TTL of the entries that are still cached and not expired, returns how many"""
+    now = time.time()
+    touched = 0
+    with _cache_lock:
+        for key in keys:
+            entry = _cache_store.get(key)
+            if entry is not None and now - entry["ts"] < ttl:
+                entry["ts"] = now
+                touched += 1
+    return touched
+
+def invalidate_tags(*tags: str) -> int:
+    """Drop every cache entry depending on any of the tags, returns how many"""
+    with _cache_lock:
+        keys = set()
+        for tag in tags:
+            keys |= _cache_tags.get(tag, set())
+        for k in keys:
+            _cache_drop(k)
+    return len(keys)
 
 def clear_cache(pattern: str = None) -> None:
-    """Clear cache entries matching pattern (or all if None)"""
+    """Clear cache entries whose key contains pattern (or all if None); prefer invalidate_tags"""
     with _cache_lock:
         if pattern:
             keys_to_delete = [k for k in _cache_store.keys() if pattern in k]
             for k in keys_to_delete:
-                del _cache_store[k]
+                _cache_drop(k)
         else:
             _cache_store.clear()
+            _cache_tags.clear()
 
 # Global error handler to log exceptions as events
 @app.errorhandler(Exception)
@@ -297,6 +439,304 @@ def fail(error: str, code: int = 400, **extra):
     payload.update(extra)
     return jsonify(payload), code
 
+# ---------------------------
+# Conditional GET (ETag / If-None-Match)
+# ---------------------------
+
+def path_version(*paths: str) -> str:
+    """Cheap source version from stat() of files/directories (mtime + size)"""
+    parts = []
+    for p in paths:
+        try:
+            st = os.stat(p)
+            parts.append(f"{p}:{st.st_mtime_ns}:{st.st_size}")
+        except OSError:
+            parts.append(f"{p}:-")
+    return "|".join(parts)
+
+def make_etag(version: str) -> str:
+    """Strong validator for the current request URL and source version"""
+    return hashlib.sha1(f"{request.full_path}|{version}".encode("utf-8")).hexdigest()
+
+def not_modified(version: str, cache_control: str) -> Optional[Response]:
+    """Return 304 response if the client already has this version, else None"""
+    etag = make_etag(version)
+    # Compressed representations carry the content-coding as ETag suffix
+    for tag in [etag] + [f"{etag}-{enc}" for enc in COMPRESS_ENCODINGS]:
+        if request.if_none_match.contains(tag):
+            resp = Response(status=304)
+            resp.set_etag(tag)
+            resp.headers["Cache-Control"] = cache_control
+            resp.vary.add("Accept-Encoding")
+            return resp
+    return None
+
+def with_validators(resp: Response, version: str, cache_control: str) -> Response:
+    """Attach ETag and Cache-Control to a successful JSON response"""
+    if resp.status_code == 200:
+        etag = make_etag(version)
+        encoding = resp.headers.get("Content-Encoding")
+        resp.set_etag(f"{etag}-{encoding}" if encoding else etag)
+        resp.headers["Cache-Control"] = cache_control
+    return resp
+
+# ---------------------------
+# Request timing (latency histograms, spans)
+# ---------------------------
+# Fixed memory: one histogram per route rule and one per span name, with
+# log-spaced bucket bounds; percentiles are interpolated inside the buckets.
+PERF_BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000)
+PERF_SLOW_FLOOR_MS = 100  # быстрее — настройки даже не читаем
+PERF_SLOW_EVENT_INTERVAL = 60  # не чаще одного события slow_request на маршрут в минуту
+
+class LatencyHistogram:
+    """Bucketed latency distribution (count, sum, max, percentiles)"""
+    __slots__ = ("counts", "count", "total_ms", "max_ms")
+
+    def __init__(self):
+        self.counts = [0] * (len(PERF_BUCKETS_MS) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def add(self, ms: float) -> None:
+        self.counts[bisect.bisect_left(PERF_BUCKETS_MS, ms)] += 1
+        self.count += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+
+    def percentile(self, q: float) -> float:
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, c in enumerate(self.counts):
+            if c and seen + c >= rank:
+                lower = PERF_BUCKETS_MS[i - 1] if i else 0.0
+                upper = PERF_BUCKETS_MS[i] if i < len(PERF_BUCKETS_MS) else self.max_ms
+                return min(self.max_ms, lower + (upper - lower) * (rank - seen) / c)
+            seen += c
+        return self.max_ms
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "avg_ms": round(self.total_ms / self.count, 2) if self.count else 0.0,
+            "p50_ms": round(self.percentile(0.50), 2),
+            "p95_ms": round(self.percentile(0.95), 2),
+            "p99_ms": round(self.percentile(0.99), 2),
+            "max_ms": round(self.max_ms, 2),
+            "total_ms": round(self.total_ms, 1),
+            "buckets": {("le_%g" % b if i < len(PERF_BUCKETS_MS) else "inf"): c
+                        for i, (b, c) in enumerate(zip(PERF_BUCKETS_MS + (None,), self.counts)) if c},
+        }
+
+_perf_lock = threading.Lock()
+_perf_routes: Dict[str, Dict[str, Any]] = {}  # "GET /api/..." -> {latency, bytes, status, cache}
+_perf_spans: Dict[str, LatencyHistogram] = {}
+_perf_slow_last: Dict[str, float] = {}
+_perf_started = time.time()
+
+def _record_span(name: str, ms: float) -> None:
+    with _perf_lock:
+        hist = _perf_spans.get(name)
+        if hist is None:
+            hist = _perf_spans[name] = LatencyHistogram()
+        hist.add(ms)
+    if has_request_context() and "perf_spans" in g:
+        total = g.perf_spans.get(name, (0.0, 0))
+        g.perf_spans[name] = (total[0] + ms, total[1] + 1)
+
+@contextmanager
+def perf_span(name: str) -> Iterator[None]:
+    """Time a block (or, as a decorator, a function) into the span histograms and Server-Timing"""
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        _record_span(name, (time.perf_counter() - t0) * 1000)
+
+def _perf_cache_event(kind: str) -> None:
+    """Count a response-cache lookup/store against the current request"""
+    if has_request_context() and "perf_cache" in g:
+        g.perf_cache[kind] += 1
+
+@app.before_request
+def perf_start() -> None:
+    g.perf_t0 = time.perf_counter()
+    g.perf_spans = {}
+    g.perf_cache = {"lookups": 0, "stores": 0}
+
+@app.after_request
+def perf_finish(resp: Response) -> Response:
+    """
+    Record latency, size, status and cache outcome per route. Registered before
+    compress_response, so it runs after it and sees the bytes actually sent.
+    """
+    t0 = g.get("perf_t0")
+    if t0 is None:
+        return resp
+    ms = (time.perf_counter() - t0) * 1000
+    route = f"{request.method} {request.url_rule.rule if request.url_rule else '<unmatched>'}"
+    size = 0 if resp.is_streamed else (resp.content_length or 0)
+    cache = g.perf_cache
+    if resp.status_code == 304:
+        outcome = "not_modified"
+    elif cache["stores"]:
+        outcome = "miss"
+    elif cache["lookups"]:
+        outcome = "hit"
+    else:
+        outcome = "none"
+    with _perf_lock:
+        stats = _perf_routes.get(route)
+        if stats is None:
+            stats = _perf_routes[route] = {
+                "latency": LatencyHistogram(), "bytes_total": 0, "bytes_max": 0, "status": {},
+                "cache": {"hit": 0, "miss": 0, "not_modified": 0, "none": 0},
+            }
+        stats["latency"].add(ms)
+        stats["bytes_total"] += size
+        stats["bytes_max"] = max(stats["bytes_max"], size)
+        status = f"{resp.status_code // 100}xx"
+        stats["status"][status] = stats["status"].get(status, 0) + 1
+        stats["cache"][outcome] += 1
+
+    if g.perf_spans:
+        resp.headers["Server-Timing"] = ", ".join(
+            f'{name};dur={total:.1f};desc="x{n}"' for name, (total, n) in g.perf_spans.items())
+    if ms >= PERF_SLOW_FLOOR_MS:
+        _perf_slow_request(route, ms, resp.status_code)
+    return resp
+
+def _perf_slow_request(route: str, ms: float, status: int) -> None:
+    """PERFORMANCE/slow_request event when perf.slow_request_ms is set and exceeded"""
+    threshold = safe_int(str(load_settings().get("perf", {}).get("slow_request_ms", 0)), 0)
+    if threshold <= 0 or ms < threshold:
+        return
+    now = time.time()
+    with _perf_lock:
+        if now - _perf_slow_last.get(route, 0) < PERF_SLOW_EVENT_INTERVAL:
+            return
+        _perf_slow_last[route] = now
+    try:
+        append_event({
+            "type": "PERFORMANCE",
+            "severity": "WARN",
+            "action": "slow_request",
+            "message": f"{route} took {ms:.0f} ms (threshold {threshold} ms)",
+            "route": route,
+            "path": request.full_path.rstrip("?"),
+            "status": status,
+            "duration_ms": round(ms, 1),
+            "spans": {name: round(total, 1) for name, (total, _n) in g.perf_spans.items()},
+        })
+    except OSError:
+        pass
+
+def perf_report() -> Dict[str, Any]:
+    """Copy of the timing state for /api/debug/perf"""
+    with _perf_lock:
+        routes = {}
+        for route, stats in _perf_routes.items():
+            count = stats["latency"].count
+            routes[route] = {
+                "latency": stats["latency"].snapshot(),
+                "bytes": {"avg": stats["bytes_total"] // count if count else 0, "max": stats["bytes_max"]},
+                "status": dict(stats["status"]),
+                "cache": dict(stats["cache"]),
+            }
+        spans = {name: hist.snapshot() for name, hist in _perf_spans.items()}
+    return {"since": dt.datetime.utcfromtimestamp(_perf_started).isoformat() + "Z", "routes": routes, "spans": spans}
+
+def perf_reset() -> None:
+    global _perf_started
+    with _perf_lock:
+        _perf_routes.clear()
+        _perf_spans.clear()
+        _perf_slow_last.clear()
+        _perf_started = time.time()
+
+# ---------------------------
+# Response compression
+# ---------------------------
+
+COMPRESS_MIN_BYTES = 1024  # smaller bodies are sent as-is
+# Server preference order; only encodings with an importable compressor are offered
+COMPRESS_ENCODINGS = [enc for enc, available in (("br", HAS_BROTLI), ("zstd", HAS_ZSTD), ("gzip", True)) if available]
+
+def negotiate_encoding() -> Optional[str]:
+    """Pick response content-coding from Accept-Encoding (None = identity)"""
+    return request.accept_encodings.best_match(COMPRESS_ENCODINGS)
+
+def compress_body(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=5)
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=3).compress(body)
+    return gzip.compress(body, compresslevel=6)
+
+def _encoded_json_response(body: bytes, encoding: Optional[str]) -> Response:
+    resp = Response(body, mimetype="application/json")
+    if encoding:
+        resp.headers["Content-Encoding"] = encoding
+    resp.vary.add("Accept-Encoding")
+    return resp
+
+def encode_json(obj: Any) -> bytes:
+    """Serialize to compact JSON bytes (orjson when installed, same key order as jsonify)"""
+    if HAS_ORJSON:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            pass  # e.g. int > 64 bit - fall back to the stdlib encoder
+    return json.dumps(obj, ensure_ascii=False, sort_keys=True, separators=(",", ":")).encode("utf-8")
+
+def encoded_body(entry: Dict[str, Any], encoding: Optional[str] = None) -> bytes:
+    """Encoded JSON (optionally compressed) for a cache entry, built once per entry"""
+    bodies = entry["bodies"]
+    body = bodies.get("identity")
+    if body is None:
+        body = bodies["identity"] = encode_json(entry["value"])
+    if not encoding or len(body) < COMPRESS_MIN_BYTES:
+        return body
+    compressed = bodies.get(encoding)
+    if compressed is None:
+        compressed = bodies[encoding] = compress_body(body, encoding)
+    return compressed
+
+def cached_json_response(entry: Dict[str, Any]) -> Response:
+    """JSON response streamed from the pre-serialized bytes of a cache entry.
+
+    Encoded and compressed bytes are stored in entry["bodies"] on first use,
+    so repeated hits skip both serialization and compression.
+    """
+    encoding = negotiate_encoding()
+    body = encoded_body(entry, encoding)
+    if body is entry["bodies"]["identity"]:
+        encoding = None
+    return _encoded_json_response(body, encoding)
+
+@app.after_request
+def compress_response(resp: Response) -> Response:
+    """Compress large JSON responses that were not served pre-compressed"""
+    if (resp.status_code != 200 or resp.direct_passthrough or resp.is_streamed
+            or resp.mimetype != "application/json" or "Content-Encoding" in resp.headers):
+        return resp
+    resp.vary.add("Accept-Encoding")
+    encoding = negotiate_encoding()
+    if not encoding:
+        return resp
+    body = resp.get_data()
+    if len(body) < COMPRESS_MIN_BYTES:
+        return resp
+    resp.set_data(compress_body(body, encoding))
+    resp.headers["Content-Encoding"] = encoding
+    etag, weak = resp.get_etag()
+    if etag:
+        resp.set_etag(f"{etag}-{encoding}", weak=weak)
+    return resp
+
 # ---------------------------
 # Settings
 # ---------------------------
@@ -326,6 +766,14 @@ DEFAULT_SETTINGS = {
     "collector": {
         "usage_dir": USAGE_DIR,
         "enabled": True,
+        "parallelism": 3,  # сколько скриптов коллектора запускать одновременно
+        "builtin": False,  # xray_collector.py вместо xray_daily_*.sh (включать вместе с отключением их cron)
+    },
+    "live": {
+        "sample_sec": 10,  # интервал сэмплов high-res кольца (5..60); Stats API — раз в минуту
+    },
+    "perf": {
+        "slow_request_ms": 0,  # > 0: запросы дольше пишутся в events.log (PERFORMANCE/slow_request)
     },
 }
 
@@ -393,6 +841,16 @@ def get_xray_clients(cfg: Dict[str, Any] = None) -> List[Dict[str, Any]]:
     clients = (ib.get("settings") or {}).get("clients") or []
     return clients
 
+def _clients_change_tags(old: List[Dict[str, Any]], new: List[Dict[str, Any]]) -> List[str]:
+    """Cache tags a clients update invalidates: the users whose alias changed, or TAG_CONFIG for anything else"""
+    def without_alias(clients: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        return [{k: v for k, v in c.items() if k != "alias"} for c in clients if isinstance(c, dict)]
+    if without_alias(old) != without_alias(new):
+        return [TAG_CONFIG]
+    old_alias = {c.get("email", ""): c.get("alias") for c in old if isinstance(c, dict)}
+    return [tag_user(c.get("email", "")) for c in new
+            if isinstance(c, dict) and c.get("alias") != old_alias.get(c.get("email", ""))]
+
 def set_xray_clients(clients: List[Dict[str, Any]]) -> Tuple[bool, str]:
     """Set clients in Xray config, backup, restart"""
     cfg, err = load_xray_config()
@@ -404,6 +862,7 @@ def set_xray_clients(clients: List[Dict[str, Any]]) -> Tuple[bool, str]:
         return False, "VLESS inbound not found"
     if "settings" not in ib:
         ib["settings"] = {}
+    old_clients = ib["settings"].get("clients") or []
     ib["settings"]["clients"] = clients
     
     # Backup
@@ -412,12 +871,17 @@ def set_xray_clients(clients: List[Dict[str, Any]]) -> Tuple[bool, str]:
     
     # Save
     save_xray_config(cfg, path)
+    change_tags = _clients_change_tags(old_clients, clients)
+    invalidate_tags(*change_tags)  # aliases / clients are embedded in dashboards
+    note_config_written()
     
     # Restart
     ok_r, msg = systemctl_restart(settings["xray"].get("service_name", SERVICE_XRAY_DEFAULT))
     if not ok_r:
         # Rollback
         shutil.copy2(bkp, path)
+        invalidate_tags(*change_tags)
+        note_config_written()
         systemctl_restart(settings["xray"].get("service_name", SERVICE_XRAY_DEFAULT))
         return False, f"Restart failed, rolled back: {msg}"
     
@@ -536,9 +1000,13 @@ def save_xray_stats_before_restart() -> None:
     """Save Xray statistics before restart to prevent data loss"""
     try:
         script_path = "/usr/local/bin/xray_daily_usage.sh"
+        cmd = [script_path]
+        if load_settings()["collector"].get("builtin", False) and os.path.exists(BUILTIN_COLLECTOR):
+            script_path = BUILTIN_COLLECTOR
+            cmd = [sys.executable, BUILTIN_COLLECTOR, "--today"]
         if os.path.exists(script_path):
             subprocess.run(
-                [script_path],
+                cmd,
                 capture_output=True,
                 timeout=30,
                 env={**os.environ, "LABEL_DATE": dt.datetime.now().strftime("%Y-%m-%d")}
@@ -547,6 +1015,7 @@ def save_xray_stats_before_restart() -> None:
         # Log but don't fail - stats saving shouldn't block restart
         print(f"Warning: Failed to save stats before restart: {e}")
 
+@perf_span("systemctl_restart")
 def systemctl_restart(service: str) -> Tuple[bool, str]:
     # First: validate format to prevent command injection
     if not service or not isinstance(service, str):
@@ -578,6 +1047,7 @@ def systemctl_restart(service: str) -> Tuple[bool, str]:
     except Exception as e:
         return False, str(e)
 
+@perf_span("systemctl_is_active")
 def systemctl_is_active(service: str) -> Tuple[bool, str]:
     # Validate service name format to prevent command injection
     if not service or not isinstance(service, str):
@@ -673,6 +1143,7 @@ def _read_csv(path: str) -> Tuple[List[str], List[List[str]], Optional[str]]:
     except Exception as e:
         return [], [], str(e)
 
+@perf_span("load_usage_data")
 def load_usage_data(days: int = 7) -> Dict[str, Any]:
     """Load usage data from CSV files"""
     settings = load_settings()
@@ -761,29 +1232,199 @@ def load_usage_data(days: int = 7) -> Dict[str, Any]:
     
     return result
 
+# ---------------------------
+# Parsed CSV cache on disk (survives restarts)
+# ---------------------------
+# Blob: one JSON meta line (format, kind, path, mtime_ns, size), then the payload:
+#   dict    JSON [header, rows] of _read_csv_dict;
+#   tuples  packed little-endian records (u32 string-table index per str column,
+#           i64 per int column), then the string table as a JSON list, then
+#           the u32 CRC-32 of records + table and the u64 offset of the table.
+#           Read and written in chunks, so memory is bounded by the distinct
+#           strings, not by the number of rows.
+# Nothing is unpickled. A blob that fails to decode (bad JSON, bad trailer, CRC
+# mismatch) is deleted and the CSV is parsed again; the CRC is checked before
+# the first row is yielded, so a damaged blob never yields a row.
+# Loaded lazily per file, LRU by blob mtime, evicted by total size.
+PARSED_CACHE_FORMAT = 3
+PARSED_CACHE_MAX_BYTES = 256 * 1024 * 1024
+PARSED_CACHE_MAX_FILE_BYTES = 16 * 1024 * 1024  # CSV крупнее — только стриминг, без кеша
+PARSED_CACHE_CHUNK_ROWS = 4096
+_TUPLES_TRAILER = struct.Struct("<IQ")  # CRC-32 of records + string table, offset of the table
+
+def _parsed_cache_path(path: str, kind: str) -> str:
+    digest = hashlib.sha1(f"{kind}|{os.path.abspath(path)}".encode("utf-8")).hexdigest()
+    return os.path.join(PARSED_CACHE_DIR, f"{kind}_{digest}.blob")
+
+def _parsed_cache_meta(path: str, kind: str, st: os.stat_result) -> bytes:
+    meta = [PARSED_CACHE_FORMAT, kind, os.path.abspath(path), st.st_mtime_ns, st.st_size]
+    return json.dumps(meta).encode("utf-8") + b"\n"
+
+def _parsed_cache_open(path: str, kind: str) -> Optional[Any]:
+    """Blob for path positioned after its meta line if it matches the current mtime/size, else None"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    blob = _parsed_cache_path(path, kind)
+    try:
+        f = open(blob, "rb")
+    except OSError:
+        return None
+    if f.readline(4096) != _parsed_cache_meta(path, kind, st):
+        f.close()
+        return None
+    try:
+        os.utime(blob)  # LRU
+    except OSError:
+        pass
+    return f
+
+def _parsed_cache_drop(f: Any, path: str, kind: str) -> None:
+    """Close and delete a damaged blob (the caller parses the CSV instead)"""
+    f.close()
+    try:
+        os.remove(_parsed_cache_path(path, kind))
+    except OSError:
+        pass
+
+def _parsed_cache_create(path: str, kind: str, st: os.stat_result) -> Tuple[Any, Optional[str]]:
+    """
+    Start a blob (st = stat of the source taken before parsing): returns
+    (file positioned after the meta line, temp path), or (None, None) if the
+    cache directory is unusable. Finish with _parsed_cache_commit/_discard.
+    """
+    tmp = None
+    try:
+        os.makedirs(PARSED_CACHE_DIR, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(prefix=".tmp_", dir=PARSED_CACHE_DIR)
+        f = os.fdopen(fd, "wb")
+        f.write(_parsed_cache_meta(path, kind, st))
+        return f, tmp
+    except OSError:
+        if tmp and os.path.exists(tmp):
+            os.remove(tmp)
+        return None, None
+
+def _parsed_cache_discard(f: Any, tmp: str) -> None:
+    try:
+        f.close()
+    except OSError:
+        pass
+    try:
+        os.remove(tmp)
+    except OSError:
+        pass
+
+def _parsed_cache_commit(f: Any, tmp: str, path: str, kind: str) -> None:
+    """Close the blob and move it into place atomically"""
+    try:
+        f.close()
+        os.replace(tmp, _parsed_cache_path(path, kind))
+    except OSError:
+        _parsed_cache_discard(f, tmp)
+        return
+    _parsed_cache_evict()
+
+def _parsed_cache_evict() -> None:
+    """Drop least recently used blobs until the cache fits PARSED_CACHE_MAX_BYTES"""
+    blobs = []
+    total = 0
+    try:
+        with os.scandir(PARSED_CACHE_DIR) as it:
+            for e in it:
+                if e.name.endswith(".pickle"):
+                    # format 1 leftovers
+                    try:
+                        os.remove(e.path)
+                    except OSError:
+                        pass
+                    continue
+                if not e.name.endswith(".blob"):
+                    continue
+                try:
+                    st = e.stat()
+                except OSError:
+                    continue
+                blobs.append((st.st_mtime, st.st_size, e.path))
+                total += st.st_size
+    except OSError:
+        return
+    if total <= PARSED_CACHE_MAX_BYTES:
+        return
+    for _mtime, size, p in sorted(blobs):
+        try:
+            os.remove(p)
+            total -= size
+        except OSError:
+            pass
+        if total <= PARSED_CACHE_MAX_BYTES:
+            break
+
+def _parsed_cache_load_dict(path: str) -> Optional[List[Dict[str, str]]]:
+    """_read_csv_dict rows from the disk cache, or None"""
+    f = _parsed_cache_open(path, "dict")
+    if f is None:
+        return None
+    try:
+        header, rows = json.loads(f.read())
+        keys = [sys.intern(str(h)) for h in header]
+        out = [dict(zip(keys, row)) for row in rows]
+    except (OSError, ValueError, TypeError):
+        _parsed_cache_drop(f, path, "dict")
+        return None
+    f.close()
+    return out
+
+def _parsed_cache_store_dict(path: str, st: os.stat_result, rows: List[Dict[str, str]]) -> None:
+    header = list(rows[0]) if rows else []
+    if any(list(r) != header for r in rows):
+        return  # ragged rows from the fallback reader: not worth caching
+    f, tmp = _parsed_cache_create(path, "dict", st)
+    if f is None:
+        return
+    try:
+        f.write(json.dumps([header, [list(r.values()) for r in rows]], ensure_ascii=False).encode("utf-8"))
+    except OSError:
+        _parsed_cache_discard(f, tmp)
+        return
+    _parsed_cache_commit(f, tmp, path, "dict")
+
+@perf_span("read_csv_dict")
 def _read_csv_dict(path: str) -> List[Dict[str, str]]:
-    """Read CSV and return list of dicts - optimized with streaming"""
+    """Read CSV and return list of dicts - memory cache, then disk cache, then parse"""
     try:
         # Check cache first (cache by file path + mtime)
         cache_key = f"csv_dict_{path}"
         try:
-            mtime = os.path.getmtime(path)
-            cache_key = f"{cache_key}_{mtime}"
+            st = os.stat(path)
+            cache_key = f"{cache_key}_{st.st_mtime}"
         except OSError:
-            pass
+            st = None
         
-        cached = get_cached(cache_key, ttl=300.0)  # 5 minutes for CSV cache
+        cached = get_cached(cache_key, ttl=CACHE_TTL["csv"])
         if cached is not None:
             return cached
         
+        # The file changed (new mtime key): drop results parsed from older versions
+        # and the aggregates built from them (its day and all-time stats)
+        if invalidate_tags(tag_file(path)):
+            file_date = _parse_date_from_name(path)
+            invalidate_tags(TAG_ALLTIME, *([tag_date(file_date)] if file_date else []))
+        
+        cached = _parsed_cache_load_dict(path)
+        if cached is not None:
+            set_cached(cache_key, cached, tags=(tag_file(path),))
+            return cached
+        
         # Use csv module for better performance
         result = []
         try:
             with open(path, "r", encoding="utf-8") as f:
                 reader = csv_module.DictReader(f)
                 for row in reader:
-                    # Normalize keys to lowercase and strip
-                    normalized = {k.strip().lower(): v.strip() if v else "" for k, v in row.items()}
+                    # Normalize keys to lowercase and strip (interned: one key object shared by all rows)
+                    normalized = {sys.intern(k.strip().lower()): v.strip() if v else "" for k, v in row.items()}
                     result.append(normalized)
         except Exception:
             # Fallback to old method
@@ -798,31 +1439,484 @@ def _read_csv_dict(path: str) -> List[Dict[str, str]]:
                 result.append(d)
         
         # Cache result
-        set_cached(cache_key, result)
+        set_cached(cache_key, result, tags=(tag_file(path),))
+        if st is not None and st.st_size <= PARSED_CACHE_MAX_FILE_BYTES:
+            _parsed_cache_store_dict(path, st, result)
         return result
     except Exception:
         return []
 
-def _load_domains_map(usage_dir: str, to_date: dt.date) -> Dict[str, str]:
-    """Load IP->domain mapping from domains_*.csv files"""
-    domains_map = {}
-    # Find the most recent domains file up to to_date
-    domains_files = sorted(glob.glob(os.path.join(usage_dir, "domains_*.csv")))
-    pick_file = None
-    for f in domains_files:
-        d = _parse_date_from_name(f)
-        if d and d <= to_date:
-            pick_file = f
-    if not pick_file and domains_files:
-        pick_file = domains_files[-1]
-    
-    if pick_file:
-        for row in _read_csv_dict(pick_file):
-            ip = (row.get("dst") or row.get("ip") or "").strip()
-            dom = (row.get("domain") or "").strip()
-            if ip and dom:
-                domains_map[ip] = dom
-    return domains_map
+# Column specs for _iter_csv_tuples: (header aliases, is_int)
+REPORT_COLUMNS = ((("user",), False), (("dst",), False), (("traffic_bytes",), True))
+CONNS_COLUMNS = ((("user",), False), (("dst",), False), (("conn_count", "conns", "count"), True))
+
+def _parse_int_field(value: str) -> int:
+    """int(float(x)) semantics of the dict readers, 0 for empty/invalid"""
+    if not value:
+        return 0
+    try:
+        return int(value)
+    except ValueError:
+        try:
+            return int(float(value))
+        except (ValueError, OverflowError):
+            return 0
+
+def _iter_csv_tuples(path: str, columns: Sequence[Tuple[Tuple[str, ...], bool]]) -> Iterator[Tuple[Any, ...]]:
+    """
+    Stream a CSV as typed tuples without building per-row dicts.
+    The file is memory-mapped and the header resolved once; each column is
+    taken from the first alias present in the header. Strings are stripped and
+    interned (repeated users/dsts share one object), ints parsed with
+    _parse_int_field. Missing columns yield "" / 0.
+    """
+    try:
+        f = open(path, "rb")
+    except OSError:
+        return
+    with f:
+        try:
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return
+        with mm:
+            header = [h.strip().lower() for h in mm.readline().decode("utf-8-sig", "replace").split(",")]
+            spec = []
+            for aliases, is_int in columns:
+                idx = next((header.index(a) for a in aliases if a in header), -1)
+                spec.append((idx, _parse_int_field if is_int else sys.intern))
+            need = max(idx for idx, _ in spec) + 1 if all(idx >= 0 for idx, _ in spec) else None
+            for line in iter(mm.readline, b""):
+                text = line.decode("utf-8", "replace")
+                if '"' in text:
+                    cells = next(csv_module.reader([text]), [])
+                else:
+                    cells = text.split(",")
+                n = len(cells)
+                if need is not None and n >= need:
+                    yield tuple([conv(cells[idx].strip()) for idx, conv in spec])
+                elif n > 1 or cells[0].strip():
+                    # short row or column missing from header
+                    yield tuple([conv(cells[idx].strip() if 0 <= idx < n else "") for idx, conv in spec])
+
+def _parsed_cache_check_tuples(f: Any, rec: struct.Struct, chunk_bytes: int) -> Tuple[int, List[str]]:
+    """
+    Validate a tuples blob positioned at its records: trailer, string table
+    and the CRC over records and table (the writer only emits indices into
+    its own table, so matching records cannot index outside it). Returns (table
+    offset, table) with f back at the records; raises ValueError (or
+    OSError/struct.error) if damaged.
+    """
+    start = f.tell()
+    end = f.seek(-_TUPLES_TRAILER.size, os.SEEK_END)
+    crc_stored, table_at = _TUPLES_TRAILER.unpack(f.read(_TUPLES_TRAILER.size))
+    if not start <= table_at <= end or (table_at - start) % rec.size:
+        raise ValueError("truncated blob")
+    f.seek(start)
+    crc = 0
+    left = table_at - start
+    while left > 0:
+        buf = f.read(min(chunk_bytes, left))
+        if not buf:
+            raise ValueError("truncated blob")
+        left -= len(buf)
+        crc = zlib.crc32(buf, crc)
+    raw = f.read(end - table_at)
+    if zlib.crc32(raw, crc) != crc_stored:
+        raise ValueError("CRC mismatch")
+    table = json.loads(raw)
+    if not isinstance(table, list) or not all(isinstance(t, str) for t in table):
+        raise ValueError("bad string table")
+    f.seek(start)
+    return table_at, [sys.intern(t) for t in table]
+
+def _iter_cached_csv_tuples(path: str, columns: Sequence[Tuple[Tuple[str, ...], bool]],
+                            kind: str) -> Iterator[Tuple[Any, ...]]:
+    """
+    _iter_csv_tuples backed by the on-disk parsed cache: a hit replays the
+    stored records chunk by chunk, a miss streams the file and writes the
+    records as it goes; the blob is kept only if the stream was fully consumed.
+    Peak memory either way: one chunk plus the string table.
+    """
+    is_int = [c[1] for c in columns]
+    rec = struct.Struct("<" + "".join("q" if i else "I" for i in is_int))
+    chunk_bytes = rec.size * PARSED_CACHE_CHUNK_ROWS
+
+    f = _parsed_cache_open(path, kind)
+    if f is not None:
+        try:
+            table_at, table = _parsed_cache_check_tuples(f, rec, chunk_bytes)
+        except (OSError, ValueError, TypeError, struct.error):
+            _parsed_cache_drop(f, path, kind)  # damaged: parse the CSV again and overwrite
+        else:
+            with f:
+                left = table_at - f.tell()
+                while left > 0:
+                    buf = f.read(min(chunk_bytes, left))
+                    left -= len(buf)
+                    for vals in rec.iter_unpack(buf):
+                        yield tuple([v if i else table[v] for v, i in zip(vals, is_int)])
+            return
+    try:
+        st = os.stat(path)
+    except OSError:
+        return
+    if st.st_size > PARSED_CACHE_MAX_FILE_BYTES:
+        yield from _iter_csv_tuples(path, columns)
+        return
+
+    blob, tmp = _parsed_cache_create(path, kind, st)
+    index: Dict[str, int] = {}
+    buf = bytearray()
+    crc = 0
+    try:
+        for row in _iter_csv_tuples(path, columns):
+            if blob is not None:
+                try:
+                    buf += rec.pack(*[v if i else index.setdefault(v, len(index)) for v, i in zip(row, is_int)])
+                    if len(buf) >= chunk_bytes:
+                        blob.write(buf)
+                        crc = zlib.crc32(buf, crc)
+                        buf.clear()
+                except (OSError, struct.error):
+                    # disk full or a value outside i64: keep streaming without the cache
+                    _parsed_cache_discard(blob, tmp)
+                    blob = None
+            yield row
+        if blob is not None:
+            try:
+                blob.write(buf)
+                crc = zlib.crc32(buf, crc)
+                table_at = blob.tell()
+                raw = json.dumps(list(index), ensure_ascii=False).encode("utf-8")
+                blob.write(raw)
+                blob.write(_TUPLES_TRAILER.pack(zlib.crc32(raw, crc), table_at))
+            except OSError:
+                _parsed_cache_discard(blob, tmp)
+            else:
+                _parsed_cache_commit(blob, tmp, path, kind)
+            blob = None
+    finally:
+        if blob is not None:
+            # the consumer stopped early: the blob would be incomplete
+            _parsed_cache_discard(blob, tmp)
+
+def _iter_report_rows(path: str) -> Iterator[Tuple[str, str, int]]:
+    """(user, dst, traffic_bytes) rows of a report_*.csv"""
+    return _iter_cached_csv_tuples(path, REPORT_COLUMNS, "report")
+
+def _iter_conns_rows(path: str) -> Iterator[Tuple[str, str, int]]:
+    """(user, dst, conn_count) rows of a conns_*.csv"""
+    return _iter_cached_csv_tuples(path, CONNS_COLUMNS, "conns")
+
+def _load_usage_partial(usage_dir: str, date_key: str) -> Optional[Dict[str, Any]]:
+    """
+    usage_<date>.partial (hourly buckets appended by xray_collector.py while the
+    day is open) collapsed to the day, or None if there is none:
+    {"usage": {user: bytes}, "conns": {(user, dst): count},
+     "report": {(user, dst): bytes}, "domains": {ip: domain},
+     "hours": {hour: [bytes, conns]}}
+    report is derived like report_*.csv: a user's traffic split across
+    destinations by their share of connections.
+    """
+    path = os.path.join(usage_dir, f"usage_{date_key}.partial")
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    version = f"{st.st_mtime_ns}:{st.st_size}"
+    cache_key = f"usage_partial_{path}"
+    cached = get_cached(cache_key, ttl=CACHE_TTL["csv"], version=version)
+    if cached is not None:
+        return cached
+
+    usage: Dict[str, int] = {}
+    conns: Dict[Tuple[str, str], int] = {}
+    domains: Dict[str, str] = {}
+    hours: Dict[int, List[int]] = {}
+    try:
+        with open(path, "r", encoding="utf-8", newline="") as f:
+            reader = csv_module.reader(f)
+            header = [h.strip().lower() for h in next(reader, [])]
+            idx = {h: i for i, h in enumerate(header)}
+            i_hour = idx.get("hour", 0)
+            i_user, i_dst, i_dom = idx.get("user", 1), idx.get("dst", 2), idx.get("domain", 6)
+            i_up, i_down, i_conns = idx.get("uplink_bytes", 3), idx.get("downlink_bytes", 4), idx.get("conn_count", 5)
+            for row in reader:
+                if len(row) < len(header):
+                    continue  # строка дописывается прямо сейчас
+                user, dst = row[i_user], row[i_dst]
+                if row[i_dom]:
+                    domains[dst] = row[i_dom]
+                elif dst:
+                    key = (sys.intern(user), sys.intern(dst))
+                    c = _parse_int_field(row[i_conns])
+                    conns[key] = conns.get(key, 0) + c
+                    hours.setdefault(_parse_int_field(row[i_hour]), [0, 0])[1] += c
+                elif user:
+                    b = _parse_int_field(row[i_up]) + _parse_int_field(row[i_down])
+                    usage[user] = usage.get(user, 0) + b
+                    hours.setdefault(_parse_int_field(row[i_hour]), [0, 0])[0] += b
+    except (OSError, csv_module.Error):
+        return None
+
+    per_user_conns: Dict[str, int] = {}
+    for (user, _dst), c in conns.items():
+        per_user_conns[user] = per_user_conns.get(user, 0) + c
+    report = {}
+    for (user, dst), c in conns.items():
+        if usage.get(user) and per_user_conns[user]:
+            report[(user, dst)] = usage[user] * c // per_user_conns[user]
+
+    result = {"usage": usage, "conns": conns, "report": report, "domains": domains, "hours": hours}
+    set_cached(cache_key, result, version=version, tags=(tag_file(path),))
+    return result
+
+def _partial_domains_map(partial: Dict[str, Any], domains_map: Dict[str, str], group: bool) -> Dict[str, str]:
+    """domains_map plus the DNS answers seen so far in an open day"""
+    if not partial["domains"]:
+        return domains_map
+    merged = dict(domains_map)
+    for ip, dom in partial["domains"].items():
+        merged[ip] = registrable_domain(dom) if group else dom
+    return merged
+
+# ---------------------------
+# IP -> domain index (domains_*.csv history)
+# ---------------------------
+DOMAINS_INDEX_VIEWS = 8  # сколько разрешённых "на дату" словарей держать в памяти
+ETLD1_CACHE_SIZE = 65536  # LRU для hostname -> eTLD+1
+DOMAIN_GROUPS = ("host", "etld1")  # ?group= для рейтингов доменов
+
+_public_suffixes: Optional[Tuple[set, set, set]] = None
+_public_suffixes_lock = threading.Lock()
+
+def _get_public_suffixes() -> Tuple[set, set, set]:
+    """(rules, wildcard parents, exceptions) from the Public Suffix List, loaded once"""
+    global _public_suffixes
+    with _public_suffixes_lock:
+        if _public_suffixes is not None:
+            return _public_suffixes
+        rules, wildcards, exceptions = set(), set(), set()
+        for path in PUBLIC_SUFFIX_PATHS:
+            if not path or not os.path.isfile(path):
+                continue
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    for line in f:
+                        rule = line.strip().lower()
+                        if not rule or rule.startswith("//"):
+                            continue
+                        rule = rule.split()[0]
+                        try:
+                            # hostnames in logs are punycode
+                            rule = rule.encode("idna").decode("ascii") if not rule.isascii() else rule
+                        except UnicodeError:
+                            pass
+                        if rule.startswith("!"):
+                            exceptions.add(rule[1:])
+                        elif rule.startswith("*."):
+                            wildcards.add(rule[2:])
+                        else:
+                            rules.add(rule)
+            except OSError:
+                continue
+            break
+        _public_suffixes = (rules, wildcards, exceptions)
+        return _public_suffixes
+
+@lru_cache(maxsize=ETLD1_CACHE_SIZE)
+def registrable_domain(host: str) -> str:
+    """
+    Collapse a hostname to its registrable domain (eTLD+1) using the Public
+    Suffix List: r1---sn-xyz.googlevideo.com -> googlevideo.com,
+    a.b.example.co.uk -> example.co.uk. IPs and markers are returned as is.
+    """
+    host = (host or "").strip().lower().rstrip(".")
+    if "." not in host or ":" in host or _looks_like_ip(host):
+        return host
+    rules, wildcards, exceptions = _get_public_suffixes()
+    labels = host.split(".")
+    n = len(labels)
+    suffix_len = 1  # default rule "*"
+    for i in range(n):
+        candidate = ".".join(labels[i:])
+        if candidate in exceptions:
+            suffix_len = n - i - 1
+            break
+        if candidate in rules or (i + 1 < n and ".".join(labels[i + 1:]) in wildcards):
+            suffix_len = n - i
+            break
+    if suffix_len >= n:
+        return host
+    return sys.intern(".".join(labels[n - suffix_len - 1:]))
+
+class DomainIndex:
+    """
+    Persistent, incrementally updated IP -> domain index over domains_*.csv.
+    Domains are interned to integer ids; every IP keeps a date-sorted list of
+    [date ordinal, domain id] so it can be resolved "as of" a report date.
+    Only new or changed files are re-read; the index is saved to DATA_DIR.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.loaded = False
+        self._reset(None)
+
+    def _reset(self, usage_dir: Optional[str]) -> None:
+        self.usage_dir = usage_dir
+        self.files: Dict[str, List[float]] = {}  # file name -> [mtime, size, date ordinal]
+        self.domains: List[str] = []  # id -> domain
+        self.domain_groups: List[str] = []  # id -> registrable domain (eTLD+1), computed at ingest
+        self.domain_ids: Dict[str, int] = {}  # domain -> id
+        self.ips: Dict[str, List[List[int]]] = {}  # ip -> [[date ordinal, domain id], ...]
+        self.views: Dict[Tuple[Optional[int], bool], Dict[str, str]] = {}
+
+    def _load(self) -> None:
+        self.loaded = True
+        data = read_json(self.path, None)
+        if not isinstance(data, dict) or data.get("version") != 1:
+            return
+        self.usage_dir = data.get("usage_dir")
+        self.files = data.get("files") or {}
+        self.domains = [sys.intern(d) for d in data.get("domains") or []]
+        self.domain_groups = [registrable_domain(d) for d in self.domains]
+        self.domain_ids = {d: i for i, d in enumerate(self.domains)}
+        self.ips = {sys.intern(ip): entries for ip, entries in (data.get("ips") or {}).items()}
+
+    def _save(self) -> None:
+        try:
+            atomic_write_text(self.path, json.dumps({
+                "version": 1,
+                "usage_dir": self.usage_dir,
+                "files": self.files,
+                "domains": self.domains,
+                "ips": self.ips,
+            }, ensure_ascii=False, separators=(",", ":")))
+        except OSError:
+            pass
+
+    def _domain_id(self, domain: str) -> int:
+        did = self.domain_ids.get(domain)
+        if did is None:
+            did = len(self.domains)
+            self.domains.append(sys.intern(domain))
+            self.domain_groups.append(registrable_domain(domain))
+            self.domain_ids[domain] = did
+        return did
+
+    def _drop_date(self, ordinal: int) -> None:
+        for ip in list(self.ips):
+            entries = [e for e in self.ips[ip] if e[0] != ordinal]
+            if entries:
+                self.ips[ip] = entries
+            else:
+                del self.ips[ip]
+
+    def _add_file(self, path: str, ordinal: int) -> None:
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                reader = csv_module.DictReader(f)
+                for row in reader:
+                    row = {(k or "").strip().lower(): (v or "").strip() for k, v in row.items()}
+                    # collector versions differ: "dst" or "ip" column
+                    ip = row.get("dst") or row.get("ip") or ""
+                    dom = row.get("domain") or ""
+                    if not ip or not dom:
+                        continue
+                    item = [ordinal, self._domain_id(dom)]
+                    entries = self.ips.get(ip)
+                    if entries is None:
+                        self.ips[sys.intern(ip)] = [item]
+                        continue
+                    pos = bisect.bisect_left(entries, [ordinal])
+                    if pos < len(entries) and entries[pos][0] == ordinal:
+                        entries[pos] = item
+                    else:
+                        entries.insert(pos, item)
+        except (OSError, UnicodeDecodeError, csv_module.Error):
+            pass
+
+    def refresh(self, usage_dir: str) -> None:
+        """Pick up new/changed/removed domains_*.csv files"""
+        with self.lock:
+            if not self.loaded:
+                self._load()
+            if self.usage_dir != usage_dir:
+                self._reset(usage_dir)
+            
+            seen: Dict[str, List[float]] = {}
+            try:
+                with os.scandir(usage_dir) as it:
+                    for e in it:
+                        if not (e.name.startswith("domains_") and e.name.endswith(".csv")):
+                            continue
+                        d = _parse_date_from_name(e.name)
+                        if not d:
+                            continue
+                        try:
+                            st = e.stat()
+                        except OSError:
+                            continue
+                        seen[e.name] = [st.st_mtime, st.st_size, d.toordinal()]
+            except OSError:
+                return
+            
+            changed = False
+            for name, meta in self.files.items():
+                if name not in seen:
+                    self._drop_date(int(meta[2]))
+                    changed = True
+            for name, meta in sorted(seen.items(), key=lambda x: x[1][2]):
+                old = self.files.get(name)
+                if old == meta:
+                    continue
+                if old is not None:
+                    self._drop_date(int(meta[2]))
+                self._add_file(os.path.join(usage_dir, name), int(meta[2]))
+                changed = True
+            
+            if changed:
+                self.files = seen
+                self.views = {}
+                self._save()
+
+    def resolve(self, as_of: Optional[dt.date] = None, group: bool = False) -> Dict[str, str]:
+        """
+        IP -> domain dict as known on `as_of` (latest mapping not after the date,
+        else the earliest one). None means the latest mapping overall.
+        group=True maps to registrable domains (eTLD+1) instead of hostnames.
+        The dict is shared and must not be modified.
+        """
+        ordinal = as_of.toordinal() if as_of else None
+        key = (ordinal, group)
+        with self.lock:
+            view = self.views.get(key)
+            if view is not None:
+                return view
+            names = self.domain_groups if group else self.domains
+            view = {}
+            for ip, entries in self.ips.items():
+                if ordinal is None:
+                    view[ip] = names[entries[-1][1]]
+                else:
+                    pos = bisect.bisect_right(entries, [ordinal, len(names)])
+                    view[ip] = names[entries[pos - 1 if pos else 0][1]]
+            if len(self.views) >= DOMAINS_INDEX_VIEWS:
+                self.views.pop(next(iter(self.views)))
+            self.views[key] = view
+            return view
+
+_domain_index = DomainIndex(DOMAINS_INDEX_PATH)
+
+def _load_domains_map(usage_dir: str, to_date: Optional[dt.date], group: bool = False) -> Dict[str, str]:
+    """IP->domain mapping as of to_date from the persistent domains index (None = latest, group = eTLD+1)"""
+    _domain_index.refresh(usage_dir)
+    return _domain_index.resolve(to_date, group)
 
 def _looks_like_ip(s: str) -> bool:
     """Check if string looks like an IP address"""
@@ -836,35 +1930,334 @@ def _looks_like_ip(s: str) -> bool:
     except (ValueError, TypeError):
         return False
 
-def _dst_to_domain(dst: str, domains_map: Dict[str, str]) -> str:
-    """Convert IP/dst to domain using map"""
+def _dst_to_domain(dst: str, domains_map: Dict[str, str], group: bool = False) -> str:
+    """Convert IP/dst to domain using map (group: collapse unmapped hostnames to eTLD+1)"""
     dst = (dst or "").strip()
-    return domains_map.get(dst, dst) if dst else "-"
+    if not dst:
+        return "-"
+    dom = domains_map.get(dst)
+    if dom is not None:
+        return dom
+    return registrable_domain(dst) if group else dst
+
+# ---------------------------
+# Top-K (domain rankings)
+# ---------------------------
+# Ёмкость скетча = K с запасом: ошибка счётчика не больше total / capacity, так что
+# домены топа с долей заметно выше 0.1% (0.4% у пользователя) ранжируются верно.
+# Если скетч вытеснял, ответ помечается topDomainsApproximate.
+TOPK_MAX = 10  # самый длинный топ, который отдаёт API
+TOPK_CAPACITY = TOPK_MAX * 100
+TOPK_USER_CAPACITY = TOPK_MAX * 25
+
+class SpaceSaving:
+    """
+    Mergeable heavy-hitters sketch (Space-Saving with batched eviction).
+    Keeps at most 2*capacity counters; on overflow prunes back to the
+    `capacity` largest ones. A key inserted after pruning starts from the
+    largest pruned count (`floor`), so counts[key] is an upper bound and
+    counts[key] - errors[key] a guaranteed lower bound. Exact while no
+    pruning happened; top() reports the lower bounds.
+    """
+    __slots__ = ("capacity", "counts", "errors", "floor", "total")
+
+    def __init__(self, capacity: int = TOPK_CAPACITY):
+        self.capacity = max(1, int(capacity))
+        self.counts: Dict[str, int] = {}
+        self.errors: Dict[str, int] = {}
+        self.floor = 0
+        self.total = 0
+
+    def __len__(self) -> int:
+        return len(self.counts)
+
+    @property
+    def exact(self) -> bool:
+        return self.floor == 0
+
+    def update(self, key: str, weight: int = 1) -> None:
+        self.total += weight
+        counts = self.counts
+        if key in counts:
+            counts[key] += weight
+            return
+        counts[key] = self.floor + weight
+        if self.floor:
+            self.errors[key] = self.floor
+        if len(counts) > 2 * self.capacity:
+            self._prune()
+
+    def merge(self, other: "SpaceSaving") -> "SpaceSaving":
+        """Merge another sketch into this one (e.g. per-day sketches into a window)"""
+        self.total += other.total
+        counts = self.counts
+        for key, v in other.counts.items():
+            if key in counts:
+                counts[key] += v
+                err = self.errors.get(key, 0) + other.errors.get(key, 0)
+            else:
+                counts[key] = self.floor + v
+                err = self.floor + other.errors.get(key, 0)
+            if err:
+                self.errors[key] = err
+        if other.floor:
+            # Keys the other sketch pruned may have had up to other.floor
+            for key in counts:
+                if key not in other.counts:
+                    counts[key] += other.floor
+                    self.errors[key] = self.errors.get(key, 0) + other.floor
+        self.floor += other.floor
+        if len(counts) > 2 * self.capacity:
+            self._prune()
+        return self
+
+    def _prune(self) -> None:
+        counts = self.counts
+        vals = sorted(counts.values(), reverse=True)
+        cutoff = vals[self.capacity - 1]
+        # Counters equal to the cutoff are kept first-come (like a stable sort) up to capacity
+        ties = vals[:self.capacity].count(cutoff)
+        kept: Dict[str, int] = {}
+        for k, v in counts.items():
+            if v > cutoff:
+                kept[k] = v
+            elif v == cutoff and ties > 0:
+                kept[k] = v
+                ties -= 1
+        self.counts = kept
+        self.errors = {k: v for k, v in self.errors.items() if k in kept}
+        self.floor = max(self.floor, vals[self.capacity])
+
+    def top(self, n: int) -> List[Tuple[str, int]]:
+        """Top N keys by guaranteed count (counts - errors); plain counts while exact"""
+        if not self.errors:
+            return heapq.nlargest(n, self.counts.items(), key=itemgetter(1))
+        errors = self.errors
+        return heapq.nlargest(n, ((k, v - errors.get(k, 0)) for k, v in self.counts.items()), key=itemgetter(1))
+
+class DomainSketches:
+    """
+    Top-K sketches of one metric over domains: overall and per user.
+    Loaders fill one per day and merge the days into the window.
+    """
+    __slots__ = ("overall", "users")
+
+    def __init__(self, overall: bool = True):
+        self.overall: Optional[SpaceSaving] = SpaceSaving(TOPK_CAPACITY) if overall else None
+        self.users: Dict[str, SpaceSaving] = {}
+
+    def update(self, user: str, key: str, weight: int) -> None:
+        if self.overall is not None:
+            self.overall.update(key, weight)
+        sk = self.users.get(user)
+        if sk is None:
+            sk = self.users[user] = SpaceSaving(TOPK_USER_CAPACITY)
+        sk.update(key, weight)
+
+    def merge(self, other: "DomainSketches") -> "DomainSketches":
+        if self.overall is not None and other.overall is not None:
+            self.overall.merge(other.overall)
+        for user, sk in other.users.items():
+            mine = self.users.get(user)
+            if mine is None:
+                self.users[user] = sk  # день больше не нужен — забираем скетч целиком
+            else:
+                mine.merge(sk)
+        return self
+
+def top_k(counts: Any, n: int) -> List[Tuple[str, int]]:
+    """Top N (key, value) pairs of a dict or SpaceSaving, same order as sorted(..., reverse=True)[:n]"""
+    if isinstance(counts, SpaceSaving):
+        return counts.top(n)
+    return heapq.nlargest(n, counts.items(), key=itemgetter(1))
+
+def counts_total(counts: Any) -> int:
+    """Sum of all weights of a dict or SpaceSaving"""
+    if isinstance(counts, SpaceSaving):
+        return counts.total
+    return sum(counts.values())
+
+def counts_approximate(*counts: Any) -> bool:
+    """True if any of the SpaceSaving sketches has pruned (its top values are lower bounds)"""
+    return any(isinstance(c, SpaceSaving) and not c.exact for c in counts)
 
 def _topn(d: Dict[str, int], n: int = 10) -> List[Dict[str, Any]]:
     """Get top N items with percentages"""
-    items = sorted(d.items(), key=lambda x: x[1], reverse=True)[:n]
-    total = sum(d.values()) or 0
+    items = top_k(d, n)
+    total = counts_total(d) or 0
     return [{"domain": dom, "value": v, "pct": (v / total * 100.0 if total else 0.0)} for dom, v in items]
 
 def _topn_traffic(d: Dict[str, int], n: int = 10) -> List[Dict[str, Any]]:
     """Get top N domains for traffic (ТЗ format)"""
-    items = sorted(d.items(), key=lambda x: x[1], reverse=True)[:n]
-    total = sum(d.values()) or 0
+    items = top_k(d, n)
+    total = counts_total(d) or 0
     return [{"domain": dom, "trafficBytes": v, "sharePct": round((v / total * 100.0 if total else 0.0), 2)} for dom, v in items]
 
 def _topn_conns(d: Dict[str, int], n: int = 10) -> List[Dict[str, Any]]:
     """Get top N domains for conns (ТЗ format)"""
-    items = sorted(d.items(), key=lambda x: x[1], reverse=True)[:n]
-    total = sum(d.values()) or 0
+    items = top_k(d, n)
+    total = counts_total(d) or 0
     return [{"domain": dom, "conns": v, "sharePct": round((v / total * 100.0 if total else 0.0), 2)} for dom, v in items]
 
-def load_dashboard_data(days: int = 7, user_filter: str = None) -> Dict[str, Any]:
+# ---------------------------
+# Distinct counting (user bitsets, HyperLogLog)
+# ---------------------------
+# Пользователей сотни — у каждого свой бит, множество за минуту = int-маска,
+# объединение окна = OR. Для неограниченных множеств (направления) — HLL.
+HLL_PRECISION = 12  # 4096 регистров, ~1.6% ошибки
+
+class UserIndex:
+    """
+    Stable user -> bit position mapping (append-only, persisted), so a set of
+    users is one int bitmask: union is |, count is _popcount().
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._ids: Dict[str, int] = {}
+        self._names: List[str] = []
+        self._loaded = False
+
+    def _load(self) -> None:
+        names = read_json(self.path, [])
+        self._names = [str(n) for n in names] if isinstance(names, list) else []
+        self._ids = {n: i for i, n in enumerate(self._names)}
+        self._loaded = True
+
+    def bit(self, user: str) -> int:
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            idx = self._ids.get(user)
+            if idx is None:
+                idx = self._ids[user] = len(self._names)
+                self._names.append(user)
+                try:
+                    atomic_write_json(self.path, self._names)
+                except OSError:
+                    pass  # маски в памяти остаются верными до рестарта
+            return idx
+
+    def lookup(self, user: str) -> Optional[int]:
+        """Bit of a known user, None if never seen (does not register)"""
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            return self._ids.get(user)
+
+    def mask(self, users: Any) -> int:
+        m = 0
+        for user in users:
+            if user:
+                m |= 1 << self.bit(user)
+        return m
+
+    def users(self, mask: int) -> List[str]:
+        """Names of the set bits"""
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            names = self._names
+            out = []
+            while mask:
+                low = mask & -mask
+                out.append(names[low.bit_length() - 1])
+                mask ^= low
+            return out
+
+user_index = UserIndex(LIVE_USER_IDS_PATH)
+
+def _popcount(x: int) -> int:
+    """Number of set bits (int.bit_count() needs Python 3.10, we support 3.8+)"""
+    return bin(x).count("1")
+
+def _point_mask(point: Dict[str, Any]) -> int:
+    """Online-user bitmask of a live point (points from older dumps carry a users list)"""
+    mask = point.get("mask")
+    if mask is None:
+        mask = user_index.mask(point.get("users") or ())
+    return mask
+
+class HyperLogLog:
+    """HyperLogLog distinct counter (mergeable, 2**precision one-byte registers)"""
+    __slots__ = ("p", "registers")
+
+    def __init__(self, precision: int = HLL_PRECISION):
+        self.p = precision
+        self.registers = bytearray(1 << precision)
+
+    def add(self, item: str) -> None:
+        h = int.from_bytes(hashlib.blake2b(item.encode("utf-8"), digest_size=8).digest(), "big")
+        idx = h >> (64 - self.p)
+        rest = h & ((1 << (64 - self.p)) - 1)
+        rank = (64 - self.p) - rest.bit_length() + 1
+        if rank > self.registers[idx]:
+            self.registers[idx] = rank
+
+    def merge(self, other: "HyperLogLog") -> "HyperLogLog":
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+
+    def copy(self) -> "HyperLogLog":
+        h = HyperLogLog(self.p)
+        h.registers = bytearray(self.registers)
+        return h
+
+    def count(self) -> int:
+        m = len(self.registers)
+        estimate = (0.7213 / (1 + 1.079 / m)) * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)  # linear counting на малых кардинальностях
+        return int(round(estimate))
+
+def _day_distinct(usage_dir: str, date_key: str) -> Dict[str, Any]:
+    """
+    Distinct sets of one day from usage/conns CSVs plus the open-day partial:
+    {"users": bitmask of users with traffic or connections, "dst": HyperLogLog of destinations}
+    """
+    paths = [os.path.join(usage_dir, f"{kind}_{date_key}.csv") for kind in ("usage", "conns")]
+    paths.append(os.path.join(usage_dir, f"usage_{date_key}.partial"))
+    version = path_version(*paths)
+    cache_key = f"day_distinct_{usage_dir}_{date_key}"
+    cached = get_cached(cache_key, ttl=CACHE_TTL["csv"], version=version)
+    if cached is not None:
+        return cached
+
+    users: set = set()
+    dst = HyperLogLog()
+    if os.path.exists(paths[0]):
+        for row in _read_csv_dict(paths[0]):
+            user = (row.get("user") or row.get("email") or "").strip()
+            if user and _parse_int_field(row.get("total_bytes") or row.get("bytes") or "1"):
+                users.add(user)
+    if os.path.exists(paths[1]):
+        for user, d, c in _iter_conns_rows(paths[1]):
+            if user and c:
+                users.add(user)
+            if d:
+                dst.add(d)
+    partial = _load_usage_partial(usage_dir, date_key)
+    if partial is not None:
+        users.update(u for u, b in partial["usage"].items() if b)
+        for user, d in partial["conns"]:
+            users.add(user)
+            dst.add(d)
+
+    result = {"users": user_index.mask(users), "dst": dst}
+    set_cached(cache_key, result, version=version, tags=[tag_file(p) for p in paths])
+    return result
+
+@perf_span("load_dashboard_data")
+def load_dashboard_data(days: int = 7, user_filter: str = None, group: str = "host") -> Dict[str, Any]:
     """
     Load comprehensive dashboard data matching historical structure.
     Reads usage_*.csv, conns_*.csv, report_*.csv, domains_*.csv
+    group="etld1" ranks domains by registrable domain instead of hostname.
     Returns: {meta, global, users, kpi, collector}
     """
+    group_domains = group == "etld1"
     settings = load_settings()
     usage_dir = settings["collector"].get("usage_dir", USAGE_DIR)
     
@@ -890,7 +2283,7 @@ def load_dashboard_data(days: int = 7, user_filter: str = None) -> Dict[str, Any
     prev_keys = date_keys[-14:-7] if len(date_keys) >= 14 else []
     
     # Load domains map (use most recent up to today)
-    domains_map = _load_domains_map(usage_dir, today)
+    domains_map = _load_domains_map(usage_dir, today, group_domains)
     
     # Initialize arrays
     all_users = set()
@@ -927,15 +2320,24 @@ def load_dashboard_data(days: int = 7, user_filter: str = None) -> Dict[str, Any
         fpath = os.path.join(usage_dir, f"conns_{date_key}.csv")
         if not os.path.exists(fpath):
             continue
-        for row in _read_csv_dict(fpath):
-            user = (row.get("user") or "").strip()
+        for user, _dst, c in _iter_conns_rows(fpath):
             if not user:
                 continue
             all_users.add(user)
-            try:
-                c = int(float(row.get("conn_count") or row.get("conns") or 0))
-            except (ValueError, TypeError):
-                c = 0
+            u_conns_all.setdefault(user, [0] * len(date_keys))[i] += c
+            g_conns_all[i] += c
+    
+    # usage_*.partial: the day is still open, collector appends hourly buckets
+    for i, date_key in enumerate(date_keys):
+        partial = _load_usage_partial(usage_dir, date_key)
+        if partial is None:
+            continue
+        for user, b in partial["usage"].items():
+            all_users.add(user)
+            u_bytes_all.setdefault(user, [0] * len(date_keys))[i] += b
+            g_bytes_all[i] += b
+        for (user, _dst), c in partial["conns"].items():
+            all_users.add(user)
             u_conns_all.setdefault(user, [0] * len(date_keys))[i] += c
             g_conns_all[i] += c
     
@@ -973,46 +2375,39 @@ def load_dashboard_data(days: int = 7, user_filter: str = None) -> Dict[str, Any
         cum_traffic.append(acc_t)
         cum_conns.append(acc_c)
     
-    # Top domains (only last 7 days)
-    glob_t_last: Dict[str, int] = {}  # domain -> traffic bytes
-    glob_c_last: Dict[str, int] = {}  # domain -> connections
-    per_t_last: Dict[str, Dict[str, int]] = {}  # user -> {domain -> traffic}
-    per_c_last: Dict[str, Dict[str, int]] = {}  # user -> {domain -> conns}
+    # Top domains (only last 7 days): per-day sketches merged into the window
+    window_t = DomainSketches()  # domain -> traffic bytes (overall and per user)
+    window_c = DomainSketches()  # domain -> connections
     
     for date_key in last_keys:
+        day_t, day_c = DomainSketches(), DomainSketches()
         # report_*.csv: traffic by domain
         rpath = os.path.join(usage_dir, f"report_{date_key}.csv")
         if os.path.exists(rpath):
-            for row in _read_csv_dict(rpath):
-                user = (row.get("user") or "").strip()
+            for user, dst, v in _iter_report_rows(rpath):
                 if not user:
                     continue
-                dst = (row.get("dst") or "").strip()
-                dom = _dst_to_domain(dst, domains_map)
-                try:
-                    v = int(float(row.get("traffic_bytes") or 0))
-                except (ValueError, TypeError):
-                    v = 0
-                per_t_last.setdefault(user, {})
-                per_t_last[user][dom] = per_t_last[user].get(dom, 0) + v
-                glob_t_last[dom] = glob_t_last.get(dom, 0) + v
+                day_t.update(user, _dst_to_domain(dst, domains_map, group_domains), v)
 
         # conns_*.csv: connections by domain (already read, but need domain mapping)
         cpath = os.path.join(usage_dir, f"conns_{date_key}.csv")
         if os.path.exists(cpath):
-            for row in _read_csv_dict(cpath):
-                user = (row.get("user") or "").strip()
+            for user, dst, v in _iter_conns_rows(cpath):
                 if not user:
                     continue
-                dst = (row.get("dst") or "").strip()
-                dom = _dst_to_domain(dst, domains_map)
-                try:
-                    v = int(float(row.get("conn_count") or 0))
-                except (ValueError, TypeError):
-                    v = 0
-                per_c_last.setdefault(user, {})
-                per_c_last[user][dom] = per_c_last[user].get(dom, 0) + v
-                glob_c_last[dom] = glob_c_last.get(dom, 0) + v
+                day_c.update(user, _dst_to_domain(dst, domains_map, group_domains), v)
+
+        partial = _load_usage_partial(usage_dir, date_key)
+        if partial is not None:
+            partial_map = _partial_domains_map(partial, domains_map, group_domains)
+            for (user, dst), v in partial["report"].items():
+                day_t.update(user, _dst_to_domain(dst, partial_map, group_domains), v)
+            for (user, dst), v in partial["conns"].items():
+                day_c.update(user, _dst_to_domain(dst, partial_map, group_domains), v)
+        window_t.merge(day_t)
+        window_c.merge(day_c)
+    glob_t_last, per_t_last = window_t.overall, window_t.users
+    glob_c_last, per_c_last = window_c.overall, window_c.users
     
     # Build users payload
     clients = get_xray_clients()
@@ -1088,6 +2483,9 @@ def load_dashboard_data(days: int = 7, user_filter: str = None) -> Dict[str, Any
             "days": last_keys,
             "prev_days": prev_keys,
             "users": users_sorted,
+            "groupBy": group,
+            "topDomainsApproximate": counts_approximate(glob_t_last, glob_c_last, *per_t_last.values(),
+                                                        *per_c_last.values()),
         },
         "global": {
             **g_last,
@@ -1190,11 +2588,21 @@ def api_version():
         }
     })
 
-@app.get("/api/health")
-def api_health():
-    """
-    Health check endpoint for monitoring and load balancers
-    Returns overall health status and individual component checks
+# --- Health (liveness / readiness / deep checks) ---
+
+# Deep checks run in the health_checker thread and are served from memory,
+# so monitors can poll /livez, /readyz and /api/health as often as they like.
+HEALTH_CHECK_INTERVAL = 60  # seconds (оптимизировано для слабого сервера)
+READINESS_CHECKS = ("xray_config", "data_dir")
+
+_health_state: Optional[Dict[str, Any]] = None  # last published snapshot (replaced, never mutated)
+_health_lock = threading.Lock()
+
+def _run_health_checks(services: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Run all health checks (blocking: filesystem, psutil sampling).
+
+    `services` carries the probe results of the health_checker thread
+    (xray / frontend / backend) and is reported only in the deep view.
     """
     checks = {}
     overall_healthy = True
@@ -1258,25 +2666,455 @@ def api_health():
 
     # Check 5: Metrics database (if exists)
     try:
-        metrics_db_path = os.path.join(DATA_DIR, "metrics.db")
-        if os.path.exists(metrics_db_path):
-            size = os.path.getsize(metrics_db_path)
+        if os.path.exists(METRICS_DB_PATH):
+            size = os.path.getsize(METRICS_DB_PATH)
             checks["metrics_db"] = {
                 "status": "healthy",
                 "size_mb": round(size / (1024*1024), 2)
             }
+            # Newest CPU/RAM sample of metrics_collector.py (cron, every minute)
+            try:
+                with closing(sqlite3.connect(f"file:{METRICS_DB_PATH}?mode=ro", uri=True, timeout=2)) as conn:
+                    last_sample = conn.execute("SELECT MAX(timestamp) FROM metrics_1m").fetchone()[0]
+                checks["metrics_db"]["last_sample_ts"] = last_sample
+                checks["metrics_db"]["sample_age_sec"] = round(time.time() - last_sample) if last_sample else None
+            except sqlite3.Error:
+                checks["metrics_db"]["last_sample_ts"] = None
         else:
             checks["metrics_db"] = {"status": "healthy", "note": "Not initialized yet"}
     except Exception as e:
         checks["metrics_db"] = {"status": "degraded", "error": str(e)}
 
-    return jsonify({
+    # Deep-only checks: collector freshness and service probes
+    deep_checks = {}
+    try:
+        usage_dir = settings["collector"].get("usage_dir", USAGE_DIR)
+        newest = None
+        for f in glob.glob(os.path.join(usage_dir, "usage_*.csv")):
+            d = _parse_date_from_name(f)
+            if d and (newest is None or d > newest):
+                newest = d
+        lag_days = (dt.datetime.utcnow().date() - newest).days if newest else None
+        deep_checks["collector"] = {
+            "status": "healthy" if lag_days is not None and lag_days <= 2 else "degraded",
+            "usage_dir": usage_dir,
+            "lag_days": lag_days,
+        }
+    except Exception as e:
+        deep_checks["collector"] = {"status": "degraded", "error": str(e)}
+
+    deep_checks["cache_warmer"] = {
+        "status": "degraded" if _warmer_state["error"] else "healthy",
+        "runs": _warmer_state["runs"],
+        "last_run": _warmer_state["last_run"],
+        "duration_ms": _warmer_state["duration_ms"],
+        "error": _warmer_state["error"],
+    }
+
+    # Live snapshot freshness and how long the writer holds its lock
+    live = live_snapshot()
+    live_age = time.time() - live["published"] if live["published"] else None
+    deep_checks["live"] = {
+        "status": "healthy" if live_age is not None and live_age < 180 else "degraded",
+        "snapshot_version": live["version"],
+        "snapshot_age_sec": round(live_age, 1) if live_age is not None else None,
+        "points": {metric: len(points) for metric, points in live["buffer"].items()},
+        "hires_points": len(live["hires"]),
+        "user_columns": {"users": len(live["users"].columns), "memory_bytes": live["users"].memory_bytes()},
+        "write_lock": live_write_lock.stats(),
+    }
+
+    for name, healthy in (services or {}).items():
+        deep_checks[f"service_{name}"] = {"status": "healthy" if healthy else "unhealthy"}
+
+    return {
         "status": "healthy" if overall_healthy else "unhealthy",
+        "ready": all(checks.get(name, {}).get("status") == "healthy" for name in READINESS_CHECKS),
         "timestamp": dt.datetime.utcnow().isoformat() + "Z",
+        "checked_at": time.time(),
+        "checks": checks,
+        "deep_checks": deep_checks,
+    }
+
+def _refresh_health_state(services: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Run the checks and publish a new snapshot for the health endpoints"""
+    global _health_state
+    state = _run_health_checks(services)
+    with _health_lock:
+        _health_state = state
+    return state
+
+def _get_health_state() -> Dict[str, Any]:
+    """Get the last published snapshot (runs the checks once if there is none yet)"""
+    state = _health_state
+    if state is None:
+        state = _refresh_health_state()
+    return state
+
+@app.get("/livez")
+def livez():
+    """Liveness probe: no I/O, constant time"""
+    return jsonify({"status": "ok"})
+
+@app.get("/readyz")
+def readyz():
+    """Readiness probe: cached dependency state from the background checks"""
+    state = _health_state
+    if state is None:
+        return jsonify({"status": "starting", "ready": False}), 503
+    return jsonify({
+        "status": "ready" if state["ready"] else "not_ready",
+        "ready": state["ready"],
+        "checks": {name: state["checks"].get(name, {}).get("status") for name in READINESS_CHECKS},
+        "timestamp": state["timestamp"],
+        "age_sec": round(time.time() - state["checked_at"], 1),
+    }), 200 if state["ready"] else 503
+
+@app.get("/api/health")
+def api_health():
+    """
+    Health check endpoint for monitoring and load balancers
+    Returns overall health status and individual component checks.
+    Served from the snapshot refreshed every HEALTH_CHECK_INTERVAL seconds;
+    ?deep=1 adds collector freshness and service probe results.
+    """
+    state = _get_health_state()
+    overall_healthy = state["status"] == "healthy"
+    checks = state["checks"]
+    if request.args.get("deep", "").strip().lower() in ("1", "true", "yes"):
+        checks = {**checks, **state["deep_checks"]}
+
+    return jsonify({
+        "status": state["status"],
+        "timestamp": state["timestamp"],
+        "age_sec": round(time.time() - state["checked_at"], 1),
         "version": APP_VERSION,
         "checks": checks
     }), 200 if overall_healthy else 503
 
+@app.get("/api/debug/perf")
+def api_debug_perf():
+    """
+    Request timing since start (or the last reset): per-route latency
+    histograms with p50/p95/p99, response sizes, status classes and cache
+    outcome (hit / miss / not_modified / none), named spans inside the heavy
+    functions and lock hold times of the live writer
+    """
+    report = perf_report()
+    report["locks"] = [live_write_lock.stats()]
+    return ok(report)
+
+@app.delete("/api/debug/perf")
+def api_debug_perf_reset():
+    """Start the timing statistics over"""
+    perf_reset()
+    return ok()
+
+# ---------------------------
+# Prometheus exporter
+# ---------------------------
+# /metrics renders only what is already in memory (live snapshot, Stats API
+# counters, cache, timing histograms, health snapshot): no CSV parsing, no
+# subprocesses, safe to scrape every 15 s.
+PROM_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+def _prom_escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+class PromWriter:
+    """Prometheus text exposition format, one family at a time"""
+
+    def __init__(self):
+        self.lines: List[str] = []
+
+    def family(self, name: str, kind: str, help_text: str) -> None:
+        self.lines.append(f"# HELP {name} {help_text}")
+        self.lines.append(f"# TYPE {name} {kind}")
+
+    def sample(self, name: str, value: Any, labels: Optional[Dict[str, Any]] = None) -> None:
+        if value is None:
+            return
+        if labels:
+            label_str = ",".join(f'{k}="{_prom_escape(v)}"' for k, v in labels.items())
+            self.lines.append(f"{name}{{{label_str}}} {value}")
+        else:
+            self.lines.append(f"{name} {value}")
+
+    def histogram(self, name: str, hist: LatencyHistogram, labels: Dict[str, Any]) -> None:
+        """LatencyHistogram (ms, per-bucket counts) as a cumulative histogram in seconds"""
+        cumulative = 0
+        for bound, count in zip(PERF_BUCKETS_MS, hist.counts):
+            cumulative += count
+            self.sample(f"{name}_bucket", cumulative, {**labels, "le": "%g" % (bound / 1000)})
+        self.sample(f"{name}_bucket", hist.count, {**labels, "le": "+Inf"})
+        self.sample(f"{name}_sum", round(hist.total_ms / 1000, 6), labels)
+        self.sample(f"{name}_count", hist.count, labels)
+
+    def render(self) -> str:
+        return "\n".join(self.lines) + "\n"
+
+def render_prometheus_metrics() -> str:
+    w = PromWriter()
+    now = time.time()
+
+    w.family("xray_ui_build_info", "gauge", "xray-report-ui version")
+    w.sample("xray_ui_build_info", 1, {"version": APP_VERSION})
+
+    # Live (snapshot published by live_updater)
+    live = live_snapshot()
+    buffer = live["buffer"]
+    last = {metric: points[-1] for metric, points in buffer.items() if points}
+    w.family("xray_ui_live_stats_api_up", "gauge", "1 if the last live update came from the Xray Stats API")
+    w.sample("xray_ui_live_stats_api_up", int(live["source"] == "stats"))
+    w.family("xray_ui_live_online_users", "gauge", "Users online in the last minute point")
+    w.sample("xray_ui_live_online_users", last["online_users"].get("value", 0) if "online_users" in last else None)
+    w.family("xray_ui_live_connections", "gauge", "Connections in the last minute point")
+    w.sample("xray_ui_live_connections", last["conns"].get("value", 0) if "conns" in last else None)
+    w.family("xray_ui_live_snapshot_age_seconds", "gauge", "Seconds since the live state was last published")
+    w.sample("xray_ui_live_snapshot_age_seconds", round(now - live["published"], 3) if live["published"] else None)
+    if live["traffic_available"] and "traffic" in last:
+        w.family("xray_traffic_bytes_total", "counter", "Xray Stats API traffic counters (reset on Xray restart)")
+        for direction in ("uplink", "downlink"):
+            w.sample("xray_traffic_bytes_total", last["traffic"].get(direction, 0), {"direction": direction})
+    if live["source"] == "stats" and live["user_counters"]:
+        w.family("xray_user_traffic_bytes_total", "counter", "Per-user Xray Stats API traffic counters")
+        for email in sorted(live["user_counters"]):
+            counters = live["user_counters"][email]
+            for direction in ("uplink", "downlink"):
+                w.sample("xray_user_traffic_bytes_total", counters.get(direction, 0),
+                         {"user": email, "direction": direction})
+    lock = live_write_lock.stats()
+    w.family("xray_ui_live_write_lock_acquisitions_total", "counter", "Live writer lock acquisitions")
+    w.sample("xray_ui_live_write_lock_acquisitions_total", lock["acquisitions"])
+    w.family("xray_ui_live_write_lock_hold_seconds_max", "gauge", "Longest live writer lock hold")
+    w.sample("xray_ui_live_write_lock_hold_seconds_max", round(lock["hold_ms"]["max"] / 1000, 6))
+
+    # Response cache
+    with _cache_lock:
+        entries = len(_cache_store)
+        counters = dict(_cache_counters)
+    w.family("xray_ui_cache_entries", "gauge", "Entries in the in-memory response cache")
+    w.sample("xray_ui_cache_entries", entries)
+    w.family("xray_ui_cache_lookups_total", "counter", "Response cache lookups by result")
+    w.sample("xray_ui_cache_lookups_total", counters["hits"], {"result": "hit"})
+    w.sample("xray_ui_cache_lookups_total", counters["misses"], {"result": "miss"})
+
+    # Request timing
+    with _perf_lock:
+        routes = {route: (stats["latency"], dict(stats["status"]), dict(stats["cache"]), stats["bytes_total"])
+                  for route, stats in _perf_routes.items()}
+        spans = dict(_perf_spans)
+        w.family("xray_ui_http_request_duration_seconds", "histogram", "Request latency per route")
+        for route, (hist, _status, _cache, _bytes) in sorted(routes.items()):
+            method, rule = route.split(" ", 1)
+            w.histogram("xray_ui_http_request_duration_seconds", hist, {"method": method, "route": rule})
+        w.family("xray_ui_span_duration_seconds", "histogram", "Time spent in named spans (heavy functions)")
+        for name, hist in sorted(spans.items()):
+            w.histogram("xray_ui_span_duration_seconds", hist, {"span": name})
+    w.family("xray_ui_http_responses_total", "counter", "Responses per route and status class")
+    for route, (_hist, status, _cache, _bytes) in sorted(routes.items()):
+        method, rule = route.split(" ", 1)
+        for code, count in sorted(status.items()):
+            w.sample("xray_ui_http_responses_total", count, {"method": method, "route": rule, "code": code})
+    w.family("xray_ui_http_cache_total", "counter", "Requests per route by response cache outcome")
+    for route, (_hist, _status, cache, _bytes) in sorted(routes.items()):
+        method, rule = route.split(" ", 1)
+        for outcome, count in cache.items():
+            if count:
+                w.sample("xray_ui_http_cache_total", count, {"method": method, "route": rule, "outcome": outcome})
+    w.family("xray_ui_http_response_bytes_total", "counter", "Response bytes sent per route")
+    for route, (_hist, _status, _cache, size) in sorted(routes.items()):
+        method, rule = route.split(" ", 1)
+        w.sample("xray_ui_http_response_bytes_total", size, {"method": method, "route": rule})
+
+    # Health snapshot (refreshed by the health checker thread)
+    health = _health_state
+    if health is not None:
+        w.family("xray_ui_health_age_seconds", "gauge", "Seconds since the health checks last ran")
+        w.sample("xray_ui_health_age_seconds", round(now - health["checked_at"], 3))
+        lag = health["deep_checks"].get("collector", {}).get("lag_days")
+        w.family("xray_ui_collector_lag_days", "gauge", "Days since the newest usage_*.csv")
+        w.sample("xray_ui_collector_lag_days", lag)
+        sample_ts = health["checks"].get("metrics_db", {}).get("last_sample_ts")
+        w.family("xray_ui_metrics_db_sample_age_seconds", "gauge", "Age of the newest metrics.db CPU/RAM sample")
+        w.sample("xray_ui_metrics_db_sample_age_seconds", round(now - sample_ts) if sample_ts else None)
+    return w.render()
+
+@app.get("/metrics")
+def metrics():
+    """Prometheus/OpenMetrics-compatible text exposition of the in-memory state"""
+    return Response(render_prometheus_metrics(), content_type=PROM_CONTENT_TYPE,
+                    headers={"Cache-Control": "no-store"})
+
+# ---------------------------
+# Profiling (admin only)
+# ---------------------------
+# Both tools need XRAY_REPORT_UI_ADMIN_TOKEN in the environment and the same
+# value in X-Admin-Token. Without the token the per-request hooks are not even
+# registered, so there is nothing to pay while profiling is disabled.
+PROFILE_MAX_SECONDS = 60
+PROFILE_MIN_INTERVAL_MS = 1
+PROFILE_KEEP = 20  # последних cProfile-дампов в PROFILES_DIR
+PROFILE_ID_RE = re.compile(r"^[0-9]+-[0-9a-f]{8}$")
+_profile_lock = threading.Lock()  # один сэмплер за раз
+
+def _is_admin() -> bool:
+    token = request.headers.get("X-Admin-Token", "")
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(token.encode("utf-8"), ADMIN_TOKEN.encode("utf-8"))
+
+def _admin_denied() -> Optional[Tuple[Response, int]]:
+    if not ADMIN_TOKEN:
+        return fail("profiling_disabled: set XRAY_REPORT_UI_ADMIN_TOKEN", code=403)
+    if not _is_admin():
+        return fail("admin_token_required", code=403)
+    return None
+
+def sample_stacks(seconds: float, interval: float) -> Tuple[Dict[str, int], int]:
+    """
+    Sample the Python stacks of all other threads every interval seconds.
+    Returns ({"thread;outer;...;inner": samples}, sample rounds), i.e. collapsed
+    stacks as flamegraph.pl / speedscope read them.
+    """
+    me = threading.get_ident()
+    labels: Dict[Any, str] = {}
+    stacks: Dict[str, int] = {}
+    rounds = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            parts = []
+            while frame is not None:
+                code = frame.f_code
+                label = labels.get(code)
+                if label is None:
+                    label = labels[code] = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+                parts.append(label)
+                frame = frame.f_back
+            parts.append(names.get(ident, f"thread-{ident}"))
+            key = ";".join(reversed(parts))
+            stacks[key] = stacks.get(key, 0) + 1
+        rounds += 1
+        time.sleep(interval)
+    return stacks, rounds
+
+def _top_frames(stacks: Dict[str, int], limit: int = 50) -> List[Dict[str, Any]]:
+    """Functions by self samples (leaf) and total samples (anywhere on the stack)"""
+    self_counts: Dict[str, int] = {}
+    total_counts: Dict[str, int] = {}
+    for key, n in stacks.items():
+        frames = key.split(";")[1:]  # без имени потока
+        if not frames:
+            continue
+        self_counts[frames[-1]] = self_counts.get(frames[-1], 0) + n
+        for frame in set(frames):
+            total_counts[frame] = total_counts.get(frame, 0) + n
+    return [{"frame": frame, "self": self_counts.get(frame, 0), "total": total}
+            for frame, total in top_k(total_counts, limit)]
+
+@app.get("/api/debug/profile")
+def api_debug_profile():
+    """
+    Sampling profiler: ?seconds=10&interval_ms=10&format=collapsed|json.
+    collapsed (default) is a flamegraph-compatible .folded file, json adds
+    the top functions by self/total samples.
+    """
+    denied = _admin_denied()
+    if denied is not None:
+        return denied
+    seconds = max(1, min(PROFILE_MAX_SECONDS, safe_int(request.args.get("seconds"), 10)))
+    interval_ms = max(PROFILE_MIN_INTERVAL_MS, safe_int(request.args.get("interval_ms"), 10))
+    fmt = request.args.get("format", "collapsed").strip()
+    if not _profile_lock.acquire(blocking=False):
+        return fail("profile_in_progress", code=409)
+    try:
+        stacks, rounds = sample_stacks(seconds, interval_ms / 1000)
+    finally:
+        _profile_lock.release()
+
+    if fmt == "json":
+        return ok({
+            "meta": {"seconds": seconds, "interval_ms": interval_ms, "rounds": rounds,
+                     "samples": sum(stacks.values())},
+            "top": _top_frames(stacks),
+            "stacks": stacks,
+        })
+    body = "".join(f"{key} {n}\n" for key, n in sorted(stacks.items()))
+    name = f"profile-{dt.datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')}.folded"
+    return Response(body, mimetype="text/plain", headers={
+        "Content-Disposition": f'attachment; filename="{name}"',
+        "Cache-Control": "no-store",
+    })
+
+def _profile_request_start() -> None:
+    """X-Profile: 1 (+ admin token) runs this request under cProfile"""
+    if request.headers.get("X-Profile") and _is_admin():
+        import cProfile
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+def _profile_request_finish(resp: Response) -> Response:
+    profiler = g.pop("profiler", None)
+    if profiler is None:
+        return resp
+    profiler.disable()
+    profile_id = f"{int(time.time())}-{uuid_lib.uuid4().hex[:8]}"
+    try:
+        os.makedirs(PROFILES_DIR, exist_ok=True)
+        profiler.dump_stats(os.path.join(PROFILES_DIR, f"{profile_id}.prof"))
+        old = sorted(glob.glob(os.path.join(PROFILES_DIR, "*.prof")), key=os.path.getmtime)[:-PROFILE_KEEP]
+        for path in old:
+            os.remove(path)
+        resp.headers["X-Profile-Id"] = profile_id
+    except OSError as e:
+        print(f"Warning: failed to save request profile: {e}")
+    return resp
+
+def _profile_request_teardown(_exc: Optional[BaseException]) -> None:
+    profiler = g.pop("profiler", None)  # запрос упал до after_request
+    if profiler is not None:
+        profiler.disable()
+
+if ADMIN_TOKEN:
+    app.before_request(_profile_request_start)
+    app.after_request(_profile_request_finish)
+    app.teardown_request(_profile_request_teardown)
+
+@app.get("/api/debug/profiles")
+def api_debug_profiles():
+    """Saved per-request cProfile dumps, newest first"""
+    denied = _admin_denied()
+    if denied is not None:
+        return denied
+    items = []
+    for path in glob.glob(os.path.join(PROFILES_DIR, "*.prof")):
+        st = os.stat(path)
+        items.append({"id": os.path.basename(path)[:-5], "size": st.st_size,
+                      "created": dt.datetime.utcfromtimestamp(st.st_mtime).isoformat() + "Z"})
+    items.sort(key=itemgetter("created"), reverse=True)
+    return ok({"profiles": items})
+
+@app.get("/api/debug/profiles/<profile_id>")
+def api_debug_profile_get(profile_id: str):
+    """One cProfile dump: raw .prof (pstats / snakeviz) or ?format=text (top 40 by cumulative time)"""
+    denied = _admin_denied()
+    if denied is not None:
+        return denied
+    if not PROFILE_ID_RE.match(profile_id):
+        return fail("invalid_profile_id")
+    path = os.path.join(PROFILES_DIR, f"{profile_id}.prof")
+    if not os.path.exists(path):
+        return fail("profile_not_found", code=404)
+    if request.args.get("format") == "text":
+        import io
+        import pstats
+        out = io.StringIO()
+        pstats.Stats(path, stream=out).sort_stats("cumulative").print_stats(40)
+        return Response(out.getvalue(), mimetype="text/plain")
+    return send_file(path, as_attachment=True, download_name=f"{profile_id}.prof")
+
 @app.get("/api/ports/status")
 def api_ports_status():
     """Get status of running ports and services"""
@@ -1367,8 +3205,11 @@ def api_settings_set():
                     deep_merge(dst[k], v)
                 else:
                     dst[k] = v
+        before = _usage_settings_digest(s)
         deep_merge(s, data)
         save_settings(s)
+    if _usage_settings_digest(s) != before:
+        invalidate_tags(TAG_SETTINGS)  # только collector/xray влияют на usage-ответы
     append_event({"type": "SETTINGS", "severity": "INFO", "action": "saved"})
     return ok({"settings": load_settings()})
 
@@ -1379,23 +3220,123 @@ def api_dashboard():
     """Legacy endpoint - kept for backward compatibility"""
     days = safe_int(request.args.get("days"), 7)
     user = request.args.get("user", "").strip() or None
+    group = _domain_group_arg()
     
-    # Check cache
-    cache_key = f"dashboard_{days}_{user or 'all'}"
-    cached_data = get_cached(cache_key, ttl=CACHE_TTL["dashboard"])
-    if cached_data is not None:
-        return jsonify(cached_data)
-    
-    # Load data
-    data = load_dashboard_data(days=days, user_filter=user)
+    version = sync_usage_cache()
+    not_mod = not_modified(version, CACHE_CONTROL["dashboard"])
+    if not_mod is not None:
+        return not_mod
     
-    # Cache result
-    set_cached(cache_key, data)
+    # Check cache
+    cache_key = f"dashboard_{days}_{user or 'all'}_{group}"
+    entry = get_cached_entry(cache_key, ttl=CACHE_TTL["dashboard"])
+    if entry is None:
+        # Load data and cache result
+        data = load_dashboard_data(days=days, user_filter=user, group=group)
+        tags = [TAG_USAGE, TAG_CONFIG, TAG_SETTINGS] + date_tags(dt.datetime.utcnow().date(), max(7, min(31, days)))
+        tags += [tag_user(u) for u in data.get("users") or {}]  # alias in each user's payload
+        entry = set_cached(cache_key, data, version=version, tags=tags)
     
-    return jsonify(data)
+    return with_validators(cached_json_response(entry), version, CACHE_CONTROL["dashboard"])
 
 # --- Usage (History) endpoints ---
 
+_USAGE_FILE_DATE_RE = re.compile(r"_(\d{4}-\d{2}-\d{2})\.(?:csv|partial)$")
+
+def _usage_sources() -> Dict[str, Any]:
+    """
+    Stat of everything the usage dashboards are built from: the CSV and
+    .partial files in usage_dir (name -> mtime:size), the collector/xray
+    settings, the Xray config and the current UTC date. One scandir, no file reads.
+    """
+    settings = load_settings()
+    usage_dir = settings["collector"].get("usage_dir", USAGE_DIR)
+    files: Dict[str, str] = {}
+    try:
+        with os.scandir(usage_dir) as it:
+            for entry in it:
+                if entry.name.endswith((".csv", ".partial")):
+                    st = entry.stat()
+                    files[entry.name] = f"{st.st_mtime_ns}:{st.st_size}"
+    except OSError:
+        files[":missing"] = usage_dir
+    return {
+        "date": dt.datetime.utcnow().date().isoformat(),
+        "usage_dir": usage_dir,
+        "settings": _usage_settings_digest(settings),
+        "config": path_version(settings["xray"].get("config_path", XRAY_CFG)),
+        "files": files,
+    }
+
+def _usage_settings_digest(settings: Dict[str, Any]) -> str:
+    """The settings usage responses depend on (collector and xray sections)"""
+    raw = json.dumps([settings.get("collector"), settings.get("xray")], sort_keys=True, default=str)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+def _usage_version_of(sources: Dict[str, Any]) -> str:
+    parts = [sources["date"], sources["usage_dir"], sources["settings"], sources["config"]]
+    parts += sorted(f"{name}:{sig}" for name, sig in sources["files"].items())
+    return hashlib.sha1("|".join(parts).encode("utf-8")).hexdigest()
+
+def _usage_data_version() -> str:
+    """Version of everything the usage dashboards are built from (ETags, cache warmer)"""
+    return _usage_version_of(_usage_sources())
+
+_usage_sources_seen: Dict[str, Any] = {}  # _usage_sources() as of the last sync_usage_cache
+_usage_sync_lock = threading.Lock()
+
+def note_config_written() -> None:
+    """The app rewrote the Xray config and invalidated what it changed: sync must not drop TAG_CONFIG again"""
+    settings = load_settings()
+    with _usage_sync_lock:
+        if _usage_sources_seen:
+            _usage_sources_seen["config"] = path_version(settings["xray"].get("config_path", XRAY_CFG))
+
+def sync_usage_cache() -> str:
+    """
+    Drop the cache entries whose usage sources changed since the previous
+    call and return the current _usage_data_version(). Covers writers the
+    hooks do not see (cron collector scripts, the built-in collector's
+    hourly partials, manual edits):
+      a changed/new/removed file -> its tag_file and tag_date, all-time stats;
+        a domains_<day>.csv also every later day (mappings are "as of" a date)
+      UTC day rollover            -> the old and the new day
+      collector/xray settings, config edited outside the app -> TAG_SETTINGS / TAG_CONFIG
+    Call before reading usage entries from the cache.
+    """
+    sources = _usage_sources()
+    tags = set()
+    with _usage_sync_lock:
+        seen = dict(_usage_sources_seen)
+        _usage_sources_seen.clear()
+        _usage_sources_seen.update(sources)
+    if seen:
+        if seen["usage_dir"] != sources["usage_dir"] or seen["settings"] != sources["settings"]:
+            tags.add(TAG_SETTINGS)
+        if seen["config"] != sources["config"]:
+            tags.add(TAG_CONFIG)
+        if seen["date"] != sources["date"]:
+            tags.update((tag_date(seen["date"]), tag_date(sources["date"])))
+        old_files, new_files = seen["files"], sources["files"]
+        today = dt.date.fromisoformat(sources["date"])
+        for name in old_files.keys() | new_files.keys():
+            if old_files.get(name) == new_files.get(name):
+                continue
+            tags.update((tag_file(os.path.join(sources["usage_dir"], name)), TAG_ALLTIME))
+            m = _USAGE_FILE_DATE_RE.search(name)
+            if not m:
+                continue
+            tags.add(tag_date(m.group(1)))
+            if name.startswith("domains_"):
+                try:
+                    day = dt.date.fromisoformat(m.group(1))
+                except ValueError:
+                    continue
+                tags.update(date_tags(today, min(366, (today - day).days + 1)))
+    if tags:
+        invalidate_tags(*tags)
+    return _usage_version_of(sources)
+
 def _list_usage_dates() -> List[str]:
     """Get list of available dates from usage CSV files, including recent days even without files"""
     settings = load_settings()
@@ -1429,47 +3370,21 @@ def api_usage_dates():
         traceback.print_exc()
         return fail(f"Error listing dates: {str(e)}", code=500)
 
-def load_usage_dashboard(date_str: str, mode: str = "daily", window_days: int = 7) -> Dict[str, Any]:
+def _aggregate_usage_window(usage_dir: str, report_date: dt.date, window_days: int,
+                            group: str = "host") -> Dict[str, Any]:
     """
-    Load usage dashboard data according to new contract from ТЗ.
-    
-    Args:
-        date_str: Report date in YYYY-MM-DD format (D in ТЗ)
-        mode: "daily" or "cumulative"
-        window_days: Window size (default 7)
-    
-    Returns:
-        Data structure matching ТЗ contract
+    Read usage/conns/report CSVs of the current and previous window once and
+    return the aggregates shared by the dashboard and the per-user details.
+    Cached per (date, window, domain grouping) until its dates change; independent of mode.
     """
-    settings = load_settings()
-    usage_dir = settings["collector"].get("usage_dir", USAGE_DIR)
-    
-    if not os.path.isdir(usage_dir):
-        return {
-            "ok": False,
-            "error": f"Directory not found: {usage_dir}",
-            "meta": {},
-            "summary": {},
-            "trends": {},
-            "topDomains": {},
-            "users": [],
-            "userDetails": {},
-        }
-    
-    try:
-        report_date = dt.date.fromisoformat(date_str)
-    except (ValueError, TypeError):
-        report_date = dt.datetime.utcnow().date()
-    
-    window_days = max(7, min(31, int(window_days)))
+    cache_key = f"usage_agg_{report_date.isoformat()}_{window_days}_{group}"
+    cached = get_cached(cache_key, ttl=CACHE_TTL["usage"])
+    if cached is not None:
+        return cached
     
     # Build windows according to ТЗ:
     # Current window (7d): D-6 ... D (7 days, including D)
     # Previous window (7d prev): D-13 ... D-7
-    # But if report_date is today and today has no data, use D-7 ... D-1 (7 full days)
-    today = dt.datetime.utcnow().date()
-    is_today = (report_date == today)
-    
     current_dates = [report_date - dt.timedelta(days=i) for i in range(window_days - 1, -1, -1)]
     prev_dates = [report_date - dt.timedelta(days=i) for i in range(window_days * 2 - 1, window_days - 1, -1)]
     
@@ -1477,11 +3392,8 @@ def load_usage_dashboard(date_str: str, mode: str = "daily", window_days: int =
     prev_keys = [d.isoformat() for d in prev_dates]
     
     # Load domains map
-    domains_map = _load_domains_map(usage_dir, report_date)
-    
-    # Get clients for display names
-    clients = get_xray_clients()
-    clients_by_email = {c.get("email", ""): c for c in clients}
+    group_domains = group == "etld1"
+    domains_map = _load_domains_map(usage_dir, report_date, group_domains)
     
     # Aggregate data
     all_users = set()
@@ -1489,10 +3401,10 @@ def load_usage_dashboard(date_str: str, mode: str = "daily", window_days: int =
     g_conns_all: Dict[str, int] = {}  # date -> count
     u_traffic_all: Dict[str, Dict[str, int]] = {}  # user -> {date -> bytes}
     u_conns_all: Dict[str, Dict[str, int]] = {}  # user -> {date -> count}
-    domain_traffic: Dict[str, int] = {}  # domain -> bytes (for current window)
-    domain_conns: Dict[str, int] = {}  # domain -> count (for current window)
-    u_domain_traffic: Dict[str, Dict[str, int]] = {}  # user -> {domain -> bytes}
-    u_domain_conns: Dict[str, Dict[str, int]] = {}  # user -> {domain -> count}
+    # Domain rankings: top-K sketches per day, merged into the current window
+    # (neither full domain maps nor a sort of every domain)
+    window_traffic = DomainSketches()  # domain -> bytes, overall and per user
+    window_conns = DomainSketches()  # domain -> count
     
     # Initialize all dates in current_keys and prev_keys to 0 - this ensures all dates appear in graph
     # even if CSV files don't exist
@@ -1500,10 +3412,14 @@ def load_usage_dashboard(date_str: str, mode: str = "daily", window_days: int =
     for date_key in all_dates:
         g_traffic_all[date_key] = 0
         g_conns_all[date_key] = 0
+    data_dates = set()  # dates with usage/conns CSV or a partial snapshot (dataCompleteness)
+    partial_dates = set()  # dates whose numbers include a partial snapshot
     for date_key in all_dates:
+        day_traffic, day_conns = DomainSketches(), DomainSketches()
         # Usage CSV
         fpath = os.path.join(usage_dir, f"usage_{date_key}.csv")
         if os.path.exists(fpath):
+            data_dates.add(date_key)
             # Initialize to 0 if file exists (to ensure date appears in graph even if empty)
             if date_key not in g_traffic_all:
                 g_traffic_all[date_key] = 0
@@ -1533,145 +3449,209 @@ def load_usage_dashboard(date_str: str, mode: str = "daily", window_days: int =
         # So even if file doesn't exist, the date will appear in graph with 0
         conns_file_exists = os.path.exists(fpath)
         if conns_file_exists:
+            data_dates.add(date_key)
             # File exists - read and sum data
             # If file is empty, date_key already has 0, so it will stay 0
-            for row in _read_csv_dict(fpath):
-                # Safety check: ensure row is a dict
-                if not isinstance(row, dict):
-                    continue
-                user = (row.get("user") or "").strip()
+            for user, dst, c in _iter_conns_rows(fpath):
                 if not user:
                     continue
                 all_users.add(user)
-                try:
-                    # Try multiple possible field names for connection count
-                    c = int(float(row.get("conn_count") or row.get("conns") or row.get("count") or 0))
-                except (ValueError, TypeError):
-                    c = 0
                 # Add to totals (date_key is guaranteed to exist from initialization above)
                 g_conns_all[date_key] = g_conns_all[date_key] + c
                 u_conns_all.setdefault(user, {})[date_key] = u_conns_all.get(user, {}).get(date_key, 0) + c
                 
                 # Domain mapping for conns (only if we have connections)
                 if date_key in current_keys and c > 0:
-                    dst = (row.get("dst") or "").strip()
-                    dom = _dst_to_domain(dst, domains_map)
-                    domain_conns[dom] = domain_conns.get(dom, 0) + c
-                    u_domain_conns.setdefault(user, {})[dom] = u_domain_conns.get(user, {}).get(dom, 0) + c
+                    day_conns.update(user, _dst_to_domain(dst, domains_map, group_domains), c)
         
-        # FALLBACK: If conns file doesn't exist but we have traffic, estimate connections
+        # Intra-day partial snapshot (the day is still open): real numbers, no estimates
+        partial = _load_usage_partial(usage_dir, date_key)
+        if partial is not None:
+            data_dates.add(date_key)
+            partial_dates.add(date_key)
+            for user, b in partial["usage"].items():
+                all_users.add(user)
+                g_traffic_all[date_key] += b
+                u_traffic_all.setdefault(user, {})[date_key] = u_traffic_all.get(user, {}).get(date_key, 0) + b
+            partial_map = _partial_domains_map(partial, domains_map, group_domains)
+            in_window = date_key in current_keys
+            for (user, dst), c in partial["conns"].items():
+                all_users.add(user)
+                g_conns_all[date_key] += c
+                u_conns_all.setdefault(user, {})[date_key] = u_conns_all.get(user, {}).get(date_key, 0) + c
+                if in_window and c > 0:
+                    day_conns.update(user, _dst_to_domain(dst, partial_map, group_domains), c)
+            if in_window:
+                for (user, dst), v in partial["report"].items():
+                    day_traffic.update(user, _dst_to_domain(dst, partial_map, group_domains), v)
+        
+        # FALLBACK: no conns file and no partial snapshot (legacy xray_daily_*.sh scripts), estimate connections
         # First try report_*.csv (more accurate - counts unique user+dst pairs)
         # If that doesn't exist, estimate from usage_*.csv (count users with traffic as minimum)
-        if not conns_file_exists and date_key in current_keys:
+        if not conns_file_exists and partial is None and date_key in current_keys:
             report_fpath = os.path.join(usage_dir, f"report_{date_key}.csv")
             if os.path.exists(report_fpath):
                 # Count unique user+dst combinations as connections (each pair represents a connection to a domain)
                 unique_conns = set()
-                for row in _read_csv_dict(report_fpath):
-                    # Safety check: ensure row is a dict
-                    if not isinstance(row, dict):
-                        continue
-                    user = (row.get("user") or "").strip()
-                    dst = (row.get("dst") or "").strip()
+                user_conns_count = {}  # rows per user
+                for user, dst, _v in _iter_report_rows(report_fpath):
                     if user and dst:
                         unique_conns.add((user, dst))
+                        user_conns_count[user] = user_conns_count.get(user, 0) + 1
                         # Also count per domain for domain_conns
-                        dom = _dst_to_domain(dst, domains_map)
-                        domain_conns[dom] = domain_conns.get(dom, 0) + 1
-                        u_domain_conns.setdefault(user, {})[dom] = u_domain_conns.get(user, {}).get(dom, 0) + 1
+                        day_conns.update(user, _dst_to_domain(dst, domains_map, group_domains), 1)
                 
                 # Add estimated connections to totals
                 estimated_conns = len(unique_conns)
                 if estimated_conns > 0:
                     g_conns_all[date_key] = g_conns_all[date_key] + estimated_conns
                     # Distribute connections to users (count per user)
-                    user_conns_count = {}
-                    for row in _read_csv_dict(report_fpath):
-                        # Safety check: ensure row is a dict
-                        if not isinstance(row, dict):
-                            continue
-                        user = (row.get("user") or "").strip()
-                        dst = (row.get("dst") or "").strip()
-                        if user and dst:
-                            user_conns_count[user] = user_conns_count.get(user, 0) + 1
                     for user, count in user_conns_count.items():
                         u_conns_all.setdefault(user, {})[date_key] = u_conns_all.get(user, {}).get(date_key, 0) + count
             else:
                 # FALLBACK 2: If report_*.csv also doesn't exist, estimate from usage_*.csv
-                # Count users with traffic - each user with traffic had at least some connections
-                usage_fpath = os.path.join(usage_dir, f"usage_{date_key}.csv")
-                if os.path.exists(usage_fpath):
-                    users_with_traffic = set()
-                    for row in _read_csv_dict(usage_fpath):
-                        # Safety check: ensure row is a dict
-                        if not isinstance(row, dict):
-                            continue
-                        user = (row.get("user") or row.get("email") or "").strip()
-                        if not user:
-                            continue
-                        try:
-                            # Check if user has any traffic
-                            b = int(float(row.get("total_bytes") or row.get("bytes") or 0))
-                            if b > 0:
-                                users_with_traffic.add(user)
-                        except (ValueError, TypeError):
-                            try:
-                                up = int(float(row.get("uplink_bytes") or row.get("up_bytes") or 0))
-                                down = int(float(row.get("downlink_bytes") or row.get("down_bytes") or 0))
-                                if up + down > 0:
-                                    users_with_traffic.add(user)
-                            except (ValueError, TypeError):
-                                pass
+                # Each user with traffic that day had at least some connections
+                users_with_traffic = [u for u, days in u_traffic_all.items() if days.get(date_key, 0) > 0]
+                estimated_conns = len(users_with_traffic)
+                if estimated_conns > 0:
+                    # Conservative: use 2 conns per MB (0.5 MB per connection)
+                    total_traffic = g_traffic_all.get(date_key, 0)
+                    if total_traffic > 0:
+                        avg_bytes_per_conn = 512 * 1024
+                        estimated_conns = max(estimated_conns, int(total_traffic / avg_bytes_per_conn))
                     
-                    # Estimate: each user with traffic had at least 1 connection
-                    # Use a multiplier based on average traffic per connection (rough estimate)
-                    # If we have traffic data, estimate connections based on historical patterns
-                    estimated_conns = len(users_with_traffic)
-                    if estimated_conns > 0:
-                        # Better estimate: use historical data to calculate average ratio
-                        # Look at previous days to estimate connections/traffic ratio
-                        total_traffic = g_traffic_all.get(date_key, 0)
-                        if total_traffic > 0:
-                            # Calculate average conns/traffic ratio from previous days (if available)
-                            # Use a more realistic estimate: ~2-5 conns per MB based on historical data
-                            # Conservative: use 2 conns per MB (0.5 MB per connection)
-                            avg_bytes_per_conn = 512 * 1024  # 0.5 MB per connection (more realistic)
-                            estimated_conns = max(estimated_conns, int(total_traffic / avg_bytes_per_conn))
-                        
-                        g_conns_all[date_key] = g_conns_all[date_key] + estimated_conns
-                        # Distribute evenly among users with traffic (rough estimate)
-                        conns_per_user = estimated_conns // len(users_with_traffic) if users_with_traffic else 0
-                        for user in users_with_traffic:
-                            u_conns_all.setdefault(user, {})[date_key] = u_conns_all.get(user, {}).get(date_key, 0) + conns_per_user
+                    g_conns_all[date_key] = g_conns_all[date_key] + estimated_conns
+                    # Distribute evenly among users with traffic (rough estimate)
+                    conns_per_user = estimated_conns // len(users_with_traffic)
+                    for user in users_with_traffic:
+                        u_conns_all.setdefault(user, {})[date_key] = u_conns_all.get(user, {}).get(date_key, 0) + conns_per_user
         
         # Report CSV (for domain traffic)
         if date_key in current_keys:
             fpath = os.path.join(usage_dir, f"report_{date_key}.csv")
             if os.path.exists(fpath):
-                for row in _read_csv_dict(fpath):
-                    # Safety check: ensure row is a dict
-                    if not isinstance(row, dict):
-                        continue
-                    user = (row.get("user") or "").strip()
+                for user, dst, v in _iter_report_rows(fpath):
                     if not user:
                         continue
-                    dst = (row.get("dst") or "").strip()
-                    dom = _dst_to_domain(dst, domains_map)
-                    try:
-                        v = int(float(row.get("traffic_bytes") or 0))
-                    except (ValueError, TypeError):
-                        v = 0
-                    domain_traffic[dom] = domain_traffic.get(dom, 0) + v
-                    u_domain_traffic.setdefault(user, {})[dom] = u_domain_traffic.get(user, {}).get(dom, 0) + v
+                    day_traffic.update(user, _dst_to_domain(dst, domains_map, group_domains), v)
+            window_traffic.merge(day_traffic)
+            window_conns.merge(day_conns)
+    
+    agg = {
+        "current_keys": current_keys,
+        "prev_keys": prev_keys,
+        "users": sorted(all_users),
+        "data_dates": data_dates,
+        "partial_dates": partial_dates,
+        "g_traffic_all": g_traffic_all,
+        "g_conns_all": g_conns_all,
+        "u_traffic_all": u_traffic_all,
+        "u_conns_all": u_conns_all,
+        "domain_traffic": window_traffic.overall,
+        "domain_conns": window_conns.overall,
+        "u_domain_traffic": window_traffic.users,
+        "u_domain_conns": window_conns.users,
+    }
+    set_cached(cache_key, agg, tags=[TAG_USAGE, TAG_SETTINGS] + date_tags(report_date, window_days * 2))
+    return agg
+
+def _build_usage_user_detail(agg: Dict[str, Any], user: str, mode: str) -> Dict[str, Any]:
+    """Trends and top domains of one user from the shared window aggregates"""
+    current_keys = agg["current_keys"]
+    u_traffic = agg["u_traffic_all"].get(user, {})
+    u_conns = agg["u_conns_all"].get(user, {})
+    traffic_trend = [{"date": d, "value": u_traffic.get(d, 0)} for d in current_keys]
+    conns_trend = [{"date": d, "value": u_conns.get(d, 0)} for d in current_keys]
+    
+    if mode == "cumulative":
+        acc_t = 0
+        acc_c = 0
+        for item in traffic_trend:
+            acc_t += item["value"]
+            item["value"] = acc_t
+        for item in conns_trend:
+            acc_c += item["value"]
+            item["value"] = acc_c
+    
+    user_domain_traffic = agg["u_domain_traffic"].get(user, {})
+    user_domain_conns = agg["u_domain_conns"].get(user, {})
+    user_total_traffic = counts_total(user_domain_traffic)
+    user_total_conns = counts_total(user_domain_conns)
+    
+    # Top domains for user (with share %)
+    user_top_traffic = []
+    for dom, val in top_k(user_domain_traffic, 10):
+        share = (val / user_total_traffic * 100.0) if user_total_traffic > 0 else 0.0
+        user_top_traffic.append({"domain": dom, "trafficBytes": val, "sharePct": round(share, 2)})
+    
+    user_top_conns = []
+    for dom, val in top_k(user_domain_conns, 10):
+        share = (val / user_total_conns * 100.0) if user_total_conns > 0 else 0.0
+        user_top_conns.append({"domain": dom, "conns": val, "sharePct": round(share, 2)})
+    
+    return {
+        "trafficTrendDailyBytes": traffic_trend,
+        "connsTrendDaily": conns_trend,
+        "topDomainsTraffic": user_top_traffic,
+        "topDomainsConns": user_top_conns,
+        "topDomainsApproximate": counts_approximate(user_domain_traffic, user_domain_conns),
+    }
+
+@perf_span("load_usage_dashboard")
+def load_usage_dashboard(date_str: str, mode: str = "daily", window_days: int = 7,
+                         include_details: bool = False, group: str = "host") -> Dict[str, Any]:
+    """
+    Load usage dashboard data according to new contract from ТЗ.
+    
+    Args:
+        date_str: Report date in YYYY-MM-DD format (D in ТЗ)
+        mode: "daily" or "cumulative"
+        window_days: Window size (default 7)
+        include_details: Also build userDetails for every user (legacy payload;
+            the UI loads one user at a time via /api/usage/user/<id>)
+        group: "host" or "etld1" (top domains grouped by registrable domain)
+    
+    Returns:
+        Data structure matching ТЗ contract
+    """
+    settings = load_settings()
+    usage_dir = settings["collector"].get("usage_dir", USAGE_DIR)
+    
+    if not os.path.isdir(usage_dir):
+        return {
+            "ok": False,
+            "error": f"Directory not found: {usage_dir}",
+            "meta": {},
+            "summary": {},
+            "trends": {},
+            "topDomains": {},
+            "users": [],
+            "userDetails": {},
+        }
+    
+    try:
+        report_date = dt.date.fromisoformat(date_str)
+    except (ValueError, TypeError):
+        report_date = dt.datetime.utcnow().date()
+    
+    window_days = max(7, min(31, int(window_days)))
+    
+    agg = _aggregate_usage_window(usage_dir, report_date, window_days, group)
+    current_keys = agg["current_keys"]
+    prev_keys = agg["prev_keys"]
+    g_traffic_all = agg["g_traffic_all"]
+    g_conns_all = agg["g_conns_all"]
+    u_traffic_all = agg["u_traffic_all"]
+    u_conns_all = agg["u_conns_all"]
+    
+    # Get clients for display names
+    clients = get_xray_clients()
+    clients_by_email = {c.get("email", ""): c for c in clients}
     
     # Calculate summary KPIs
     today_key = report_date.isoformat()
     yesterday_key = (report_date - dt.timedelta(days=1)).isoformat()
     
-    # Check if report_date is actually today (real current date)
-    real_today = dt.datetime.utcnow().date()
-    is_report_date_today = (report_date == real_today)
-    
     today_traffic = g_traffic_all.get(today_key, 0)
     yesterday_traffic = g_traffic_all.get(yesterday_key, 0)
     today_conns = g_conns_all.get(today_key, 0)
@@ -1694,37 +3674,26 @@ def load_usage_dashboard(date_str: str, mode: str = "daily", window_days: int =
         return round((current - prev) * 100.0 / prev, 2)
     
     # Build trends (daily or cumulative)
-    # Only exclude report_date if it's actually today AND has no data
-    # For past dates, always include them even if data is 0 (they might be incomplete but should be shown)
-    if is_report_date_today:
+    # With the built-in collector today comes from the partial snapshot, so it is never dropped.
+    # Otherwise (legacy scripts, no partial) only exclude report_date if it's actually today AND has no data;
+    # past dates are always included even if data is 0 (they might be incomplete but should be shown)
+    real_today = dt.datetime.utcnow().date()
+    today_live = settings["collector"].get("builtin", False) and today_key in agg["partial_dates"]
+    if report_date == real_today and not today_live:
         # Check if today has meaningful data (non-zero values)
-        today_has_data = (today_key in g_traffic_all and g_traffic_all[today_key] > 0) or \
-                         (today_key in g_conns_all and g_conns_all[today_key] > 0)
+        today_has_data = g_traffic_all.get(today_key, 0) > 0 or g_conns_all.get(today_key, 0) > 0
         # Filter out today only if it has no data (incomplete day)
         trend_keys = current_keys if today_has_data else [d for d in current_keys if d != today_key]
     else:
-        # For past dates, always include all days (even with 0 values)
         trend_keys = current_keys
     
-    # CRITICAL: Ensure all dates in trend_keys are initialized in dictionaries
-    # This guarantees that all dates appear in the graph, even if CSV files don't exist
-    for date_key in trend_keys:
-        if date_key not in g_traffic_all:
-            g_traffic_all[date_key] = 0
-        if date_key not in g_conns_all:
-            g_conns_all[date_key] = 0
-    
-    # Build daily arrays - use direct access since all dates are guaranteed to be initialized
+    # Build daily arrays - every date appears in the graph, even if CSV files don't exist
+    # (aggregates are shared via cache, so read with defaults instead of filling them in)
     traffic_daily = []
     conns_daily = []
     for d in trend_keys:
-        # Ensure date is in dictionaries (double-check)
-        if d not in g_traffic_all:
-            g_traffic_all[d] = 0
-        if d not in g_conns_all:
-            g_conns_all[d] = 0
-        traffic_daily.append({"date": d, "value": g_traffic_all[d]})
-        conns_daily.append({"date": d, "value": g_conns_all[d]})
+        traffic_daily.append({"date": d, "value": g_traffic_all.get(d, 0)})
+        conns_daily.append({"date": d, "value": g_conns_all.get(d, 0)})
     
     if mode == "cumulative":
         acc_t = 0
@@ -1737,14 +3706,14 @@ def load_usage_dashboard(date_str: str, mode: str = "daily", window_days: int =
             item["value"] = acc_c
     
     # Top domains (ТЗ format: trafficBytes/conns, sharePct)
-    top_domains_traffic = _topn_traffic(domain_traffic, 10)
-    top_domains_conns = _topn_conns(domain_conns, 10)
+    top_domains_traffic = _topn_traffic(agg["domain_traffic"], 10)
+    top_domains_conns = _topn_conns(agg["domain_conns"], 10)
     top3_traffic = [d["domain"] for d in top_domains_traffic[:3]]
     top3_conns = [d["domain"] for d in top_domains_conns[:3]]
     
     # Users list with summary
     users_list = []
-    users_sorted = sorted(all_users)
+    users_sorted = agg["users"]
     
     for user in users_sorted:
         client = clients_by_email.get(user, {})
@@ -1774,59 +3743,26 @@ def load_usage_dashboard(date_str: str, mode: str = "daily", window_days: int =
             "status": "anomaly" if is_anomaly else "ok",
         })
     
-    # User details (trends and top domains per user)
-    user_details = {}
-    for user in users_sorted:
-        traffic_trend = [{"date": d, "value": u_traffic_all.get(user, {}).get(d, 0)} for d in current_keys]
-        conns_trend = [{"date": d, "value": u_conns_all.get(user, {}).get(d, 0)} for d in current_keys]
-        
-        if mode == "cumulative":
-            acc_t = 0
-            acc_c = 0
-            for item in traffic_trend:
-                acc_t += item["value"]
-                item["value"] = acc_t
-            for item in conns_trend:
-                acc_c += item["value"]
-                item["value"] = acc_c
-        
-        user_total_traffic = sum(u_domain_traffic.get(user, {}).values())
-        user_total_conns = sum(u_domain_conns.get(user, {}).values())
-        
-        # Top domains for user (with share %)
-        user_top_traffic = []
-        for dom, val in sorted(u_domain_traffic.get(user, {}).items(), key=lambda x: x[1], reverse=True)[:10]:
-            share = (val / user_total_traffic * 100.0) if user_total_traffic > 0 else 0.0
-            user_top_traffic.append({"domain": dom, "trafficBytes": val, "sharePct": round(share, 2)})
-        
-        user_top_conns = []
-        for dom, val in sorted(u_domain_conns.get(user, {}).items(), key=lambda x: x[1], reverse=True)[:10]:
-            share = (val / user_total_conns * 100.0) if user_total_conns > 0 else 0.0
-            user_top_conns.append({"domain": dom, "conns": val, "sharePct": round(share, 2)})
-        
-        user_details[user] = {
-            "trafficTrendDailyBytes": traffic_trend,
-            "connsTrendDaily": conns_trend,
-            "topDomainsTraffic": user_top_traffic,
-            "topDomainsConns": user_top_conns,
-        }
-    
-    # Check data completeness
+    # Check data completeness: a day counts as present if its CSVs exist, even with zero traffic
+    # (the current UTC day is still open and may have no snapshot yet)
     data_completeness = "full"
-    missing_dates = [d for d in current_keys if d not in g_traffic_all and d not in g_conns_all]
+    open_day = dt.datetime.utcnow().date().isoformat()
+    missing_dates = [d for d in current_keys if d not in agg["data_dates"] and d != open_day]
     if missing_dates:
         data_completeness = "partial"
     
-    return {
+    result = {
         "ok": True,
         "meta": {
             "date": date_str,
             "mode": mode,
             "windowDays": window_days,
+            "groupBy": group,
             "unitBase": "bytes",
             "gbBase": 1000000000,
             "generatedAt": now_utc_iso(),
             "dataCompleteness": data_completeness,
+            "topDomainsApproximate": counts_approximate(agg["domain_traffic"], agg["domain_conns"]),
         },
         "summary": {
             "todayTrafficBytes": today_traffic,
@@ -1855,49 +3791,156 @@ def load_usage_dashboard(date_str: str, mode: str = "daily", window_days: int =
             "top3ConnsDomains": top3_conns,
         },
         "users": users_list,
-        "userDetails": user_details,
     }
+    
+    if include_details:
+        result["userDetails"] = {user: _build_usage_user_detail(agg, user, mode) for user in users_sorted}
+    
+    return result
 
-@app.get("/api/usage/dashboard")
-def api_usage_dashboard():
-    """Get usage dashboard data according to ТЗ contract"""
-    date_str = request.args.get("date", "").strip()
-    if not date_str:
-        # Default to last available date
-        dates = _list_usage_dates()
-        if dates:
-            date_str = dates[0]
-        else:
-            date_str = dt.datetime.utcnow().date().isoformat()
+def load_usage_user_detail(date_str: str, user: str, mode: str = "daily", window_days: int = 7,
+                           group: str = "host") -> Optional[Dict[str, Any]]:
+    """
+    Detail (trends, top domains) for one user, built from the same cached
+    window aggregates as the dashboard. None if the user has no data.
+    """
+    settings = load_settings()
+    usage_dir = settings["collector"].get("usage_dir", USAGE_DIR)
+    if not os.path.isdir(usage_dir):
+        return None
+    
+    try:
+        report_date = dt.date.fromisoformat(date_str)
+    except (ValueError, TypeError):
+        report_date = dt.datetime.utcnow().date()
+    
+    window_days = max(7, min(31, int(window_days)))
+    
+    agg = _aggregate_usage_window(usage_dir, report_date, window_days, group)
+    if user not in agg["u_traffic_all"] and user not in agg["u_conns_all"]:
+        return None
+    
+    client = next((c for c in get_xray_clients() if c.get("email", "") == user), {})
+    return {
+        "ok": True,
+        "meta": {
+            "date": date_str,
+            "mode": mode,
+            "windowDays": window_days,
+            "groupBy": group,
+            "userId": user,
+            "displayName": client.get("alias") or user,
+            "generatedAt": now_utc_iso(),
+        },
+        **_build_usage_user_detail(agg, user, mode),
+    }
+
+def _default_usage_date() -> str:
+    """Last available date (what the dashboard opens with)"""
+    dates = _list_usage_dates()
+    if dates:
+        return dates[0]
+    return dt.datetime.utcnow().date().isoformat()
+
+def _usage_window_tags(date_str: str, window_days: int, users: Any = ()) -> List[str]:
+    """Tags of a usage response: its current + previous window dates, config, settings, users (displayName)"""
+    try:
+        report_date = dt.date.fromisoformat(date_str)
+    except (ValueError, TypeError):
+        report_date = dt.datetime.utcnow().date()
+    window_days = max(7, min(31, int(window_days)))
+    return ([TAG_USAGE, TAG_CONFIG, TAG_SETTINGS] + date_tags(report_date, window_days * 2)
+            + [tag_user(u) for u in users])
+
+def _usage_dashboard_key(date_str: str, mode: str, window_days: int, group: str, include_details: bool) -> str:
+    return f"usage_dashboard_{date_str}_{mode}_{window_days}_{group}_{int(include_details)}"
+
+def usage_dashboard_entry(date_str: str, mode: str = "daily", window_days: int = 7, group: str = "host",
+                          include_details: bool = False, version: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Cache entry of /api/usage/dashboard for these params, built if missing
+    (never built, invalidated or expired). Callers run sync_usage_cache() first.
+    """
+    if version is None:
+        version = _usage_data_version()
+    cache_key = _usage_dashboard_key(date_str, mode, window_days, group, include_details)
+    entry = get_cached_entry(cache_key, ttl=CACHE_TTL["usage"])
+    if entry is not None:
+        return entry
+    data = load_usage_dashboard(date_str, mode, window_days, include_details=include_details, group=group)
+    users = [u.get("userId", "") for u in data.get("users") or ()]
+    return set_cached(cache_key, data, version=version, tags=_usage_window_tags(date_str, window_days, users))
+
+def _domain_group_arg() -> str:
+    """?group=etld1 groups top domains by registrable domain, default is by hostname"""
+    group = request.args.get("group", "host").strip().lower()
+    return group if group in DOMAIN_GROUPS else "host"
+
+def _usage_request_args() -> Tuple[str, str, int, str]:
+    """Parse date / mode / windowDays / group query params shared by usage endpoints"""
+    date_str = request.args.get("date", "").strip() or _default_usage_date()
     
     mode = request.args.get("mode", "daily").strip()
     if mode not in ["daily", "cumulative"]:
         mode = "daily"
     
     window_days = safe_int(request.args.get("windowDays"), 7)
+    return date_str, mode, window_days, _domain_group_arg()
+
+@app.get("/api/usage/dashboard")
+def api_usage_dashboard():
+    """Get usage dashboard data according to ТЗ contract (summaries only, ?details=1 adds userDetails)"""
+    date_str, mode, window_days, group = _usage_request_args()
+    include_details = request.args.get("details", "").strip().lower() in ("1", "true", "yes")
     
-    # Check cache
-    cache_key = f"usage_dashboard_{date_str}_{mode}_{window_days}"
-    cached_data = get_cached(cache_key, ttl=CACHE_TTL["usage"])
-    if cached_data is not None:
-        return jsonify(cached_data)
+    version = sync_usage_cache()
+    not_mod = not_modified(version, CACHE_CONTROL["usage"])
+    if not_mod is not None:
+        return not_mod
     
     try:
-        data = load_usage_dashboard(date_str, mode, window_days)
-        
-        # Cache result
-        set_cached(cache_key, data)
-        
-        return jsonify(data)
+        entry = usage_dashboard_entry(date_str, mode, window_days, group, include_details, version)
+        return with_validators(cached_json_response(entry), version, CACHE_CONTROL["usage"])
     except Exception as e:
         import traceback
         traceback.print_exc()
         return fail(f"Error loading dashboard: {str(e)}", code=500)
 
+@app.get("/api/usage/user/<path:user_id>")
+def api_usage_user(user_id: str):
+    """Get one user's usage detail (trends, top domains) for the dashboard window"""
+    date_str, mode, window_days, group = _usage_request_args()
+    
+    version = sync_usage_cache()
+    not_mod = not_modified(version, CACHE_CONTROL["usage"])
+    if not_mod is not None:
+        return not_mod
+    
+    cache_key = f"usage_user_{user_id}_{date_str}_{mode}_{window_days}_{group}"
+    entry = get_cached_entry(cache_key, ttl=CACHE_TTL["usage"])
+    if entry is not None:
+        return with_validators(cached_json_response(entry), version, CACHE_CONTROL["usage"])
+    
+    try:
+        data = load_usage_user_detail(date_str, user_id, mode, window_days, group)
+        if data is None:
+            return fail("user_not_found", code=404)
+        entry = set_cached(cache_key, data, version=version,
+                           tags=_usage_window_tags(date_str, window_days, (user_id,)))
+        return with_validators(cached_json_response(entry), version, CACHE_CONTROL["usage"])
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        return fail(f"Error loading user detail: {str(e)}", code=500)
+
+USER_ALLTIME_STATS_KEY = "user_alltime_stats"
+
+@perf_span("user_alltime_stats")
 def _calculate_user_alltime_stats() -> Dict[str, Dict[str, Any]]:
     """Calculate all-time statistics for all users from CSV files"""
-    # Check cache first (тяжёлая операция - кешируем на 5 минут)
-    cache_key = "user_alltime_stats"
+    # Check cache first (тяжёлая операция)
+    cache_key = USER_ALLTIME_STATS_KEY
+    version = _usage_data_version()
     cached = get_cached(cache_key, ttl=CACHE_TTL.get("user_stats", 300.0))
     if cached is not None:
         return cached
@@ -1912,17 +3955,10 @@ def _calculate_user_alltime_stats() -> Dict[str, Dict[str, Any]]:
     user_stats: Dict[str, Dict[str, Any]] = {}
     user_days: Dict[str, set] = {}  # user -> set of dates
     user_traffic: Dict[str, int] = {}  # user -> total bytes
-    user_domain_traffic: Dict[str, Dict[str, int]] = {}  # user -> {domain -> bytes}
-    
-    # Load all domains maps (merge all available)
-    domains_map: Dict[str, str] = {}
-    domains_files = sorted(glob.glob(os.path.join(usage_dir, "domains_*.csv")))
-    for f in domains_files:
-        for row in _read_csv_dict(f):
-            ip = (row.get("ip") or "").strip()
-            domain = (row.get("domain") or "").strip()
-            if ip and domain:
-                domains_map[ip] = domain
+    domain_sketches = DomainSketches(overall=False)  # user -> top-K sketch {domain -> bytes}, days merged
+    
+    # Latest known domain for every IP
+    domains_map = _load_domains_map(usage_dir, None)
     
     # Process all usage_*.csv files
     usage_files = glob.glob(os.path.join(usage_dir, "usage_*.csv"))
@@ -1962,29 +3998,20 @@ def _calculate_user_alltime_stats() -> Dict[str, Dict[str, Any]]:
         if not date_key:
             continue
         
-        for row in _read_csv_dict(fpath):
-            if not isinstance(row, dict):
-                continue
-            user = (row.get("user") or "").strip()
-            if not user:
-                continue
-            
-            dst = (row.get("dst") or "").strip()
-            if not dst:
+        day = DomainSketches(overall=False)
+        for user, dst, v in _iter_report_rows(fpath):
+            if not user or not dst:
                 continue
             
             # Map IP to domain
             domain = domains_map.get(dst, dst)
             if domain == dst and _looks_like_ip(dst):
                 domain = "__no_domains__"
-            
-            try:
-                v = int(float(row.get("traffic_bytes") or 0))
-            except (ValueError, TypeError):
-                v = 0
 
             if v > 0:
-                user_domain_traffic.setdefault(user, {})[domain] = user_domain_traffic.get(user, {}).get(domain, 0) + v
+                day.update(user, domain, v)
+        domain_sketches.merge(day)
+    user_domain_traffic = domain_sketches.users
     
     # Build final stats
     all_users = set(list(user_days.keys()) + list(user_traffic.keys()) + list(user_domain_traffic.keys()))
@@ -1995,9 +4022,9 @@ def _calculate_user_alltime_stats() -> Dict[str, Dict[str, Any]]:
         domain_traffic = user_domain_traffic.get(user, {})
         
         # Calculate top 3 domains
-        top_domains = sorted(domain_traffic.items(), key=lambda x: x[1], reverse=True)[:3]
+        top_domains = top_k(domain_traffic, 3)
         top3_list = []
-        total_domain_traffic = sum(domain_traffic.values()) or 1
+        total_domain_traffic = counts_total(domain_traffic) or 1
         
         for domain, bytes_val in top_domains:
             share_pct = round((bytes_val / total_domain_traffic) * 100.0, 2) if total_domain_traffic > 0 else 0.0
@@ -2019,12 +4046,13 @@ def _calculate_user_alltime_stats() -> Dict[str, Dict[str, Any]]:
             "daysUsed": len(days_set),
             "totalTrafficBytes": total_bytes,
             "top3Domains": top3_list,
+            "topDomainsApproximate": counts_approximate(domain_traffic),
             "firstSeenAt": first_seen_at,
             "lastSeenAt": last_seen_at
         }
     
     # Cache result
-    set_cached(cache_key, user_stats)
+    set_cached(cache_key, user_stats, version=version, tags=(TAG_USAGE, TAG_ALLTIME, TAG_SETTINGS))
     return user_stats
 
 @app.get("/api/users")
@@ -2179,6 +4207,10 @@ def api_users_link():
 @app.get("/api/users/stats")
 def api_users_stats():
     """Get all-time statistics for all users"""
+    version = f"{sync_usage_cache()}|live:{live_snapshot()['version']}"
+    not_mod = not_modified(version, CACHE_CONTROL["user_stats"])
+    if not_mod is not None:
+        return not_mod
     try:
         # Get online users
         now_data = _get_live_now()
@@ -2207,12 +4239,13 @@ def api_users_stats():
                 "daysUsed": user_stat["daysUsed"],
                 "totalTrafficBytes": user_stat["totalTrafficBytes"],
                 "top3Domains": user_stat["top3Domains"],
+                "topDomainsApproximate": user_stat.get("topDomainsApproximate", False),
                 "firstSeenAt": user_stat.get("firstSeenAt"),
                 "lastSeenAt": user_stat.get("lastSeenAt"),
                 "isOnline": email in online_users_set
             })
         
-        return ok({"users": users_stats})
+        return with_validators(ok({"users": users_stats}), version, CACHE_CONTROL["user_stats"])
     except Exception as e:
         import traceback
         traceback.print_exc()
@@ -2265,6 +4298,11 @@ def api_events():
     limit = safe_int(request.args.get("limit"), 100)
     text_filter = request.args.get("text", "").strip().lower()
     
+    version = path_version(EVENTS_PATH)
+    not_mod = not_modified(version, CACHE_CONTROL["events"])
+    if not_mod is not None:
+        return not_mod
+    
     events = []
     if os.path.exists(EVENTS_PATH):
         try:
@@ -2289,13 +4327,19 @@ def api_events():
     # Limit
     events = events[:limit]
     
-    return ok({"events": events})
+    return with_validators(ok({"events": events}), version, CACHE_CONTROL["events"])
 
 @app.get("/api/events/stats")
 def api_events_stats():
     """Get statistics about events for dashboard"""
     hours = safe_int(request.args.get("hours"), 24)
     
+    # Buckets are relative to "now", so the version also rolls every minute
+    version = f"{path_version(EVENTS_PATH)}|{int(time.time() // 60)}"
+    not_mod = not_modified(version, CACHE_CONTROL["events"])
+    if not_mod is not None:
+        return not_mod
+    
     events = []
     if os.path.exists(EVENTS_PATH):
         try:
@@ -2409,7 +4453,7 @@ def api_events_stats():
                 "warnings": sum(1 for e in bucket_events if e.get("severity") == "WARN")
             })
     
-    return ok({
+    return with_validators(ok({
         "total": total,
         "errors": errors,
         "warnings": warnings,
@@ -2417,13 +4461,14 @@ def api_events_stats():
         "byType": by_type,
         "recentCritical": recent_critical,
         "timeline": timeline
-    })
+    }), version, CACHE_CONTROL["events"])
 
 # --- Collector ---
 
 def _get_script_description(script_name: str) -> str:
     """Get description for collector script"""
     descriptions = {
+        "xray_collector.py": "Встроенный сборщик: один проход по access.log и Stats API. Создаёт usage_*, conns_*, report_* и domains_*.csv",
         "xray_daily_usage.sh": "Собирает суточный трафик по пользователям из access.log. Создаёт usage_*.csv",
         "xray_daily_conns.sh": "Собирает количество подключений по доменам/IP. Создаёт conns_*.csv",
         "xray_daily_report.sh": "Генерирует отчёт user/day/domain/traffic_bytes. Создаёт report_*.csv и domains_*.csv",
@@ -2919,12 +4964,176 @@ def api_collector_toggle():
     except Exception as e:
         return fail(f"Error modifying cron: {str(e)}", code=500)
 
+# --- Collector jobs ---
+
+COLLECTOR_SCRIPT_TIMEOUT = 120  # seconds per script
+COLLECTOR_JOBS_KEEP = 20
+COLLECTOR_OUTPUT_LIMIT = 4000
+
+# job_id -> {"id", "status", "finished", "seq", "scripts": [...], ...}; "seq" bumps on every change
+_collector_jobs: Dict[str, Dict[str, Any]] = {}
+_collector_jobs_lock = threading.Lock()
+_collector_jobs_cond = threading.Condition(_collector_jobs_lock)
+
+def _collector_job_view(job: Dict[str, Any]) -> Dict[str, Any]:
+    """JSON-safe snapshot of a job (caller holds _collector_jobs_lock)"""
+    view = {k: v for k, v in job.items() if k != "scripts" and not k.startswith("_")}
+    view["scripts"] = [{k: v for k, v in sc.items() if k != "output"} for sc in job["scripts"]]
+    return view
+
+def _collector_job_update(job: Dict[str, Any], script: Optional[Dict[str, Any]] = None, **fields: Any) -> None:
+    with _collector_jobs_cond:
+        (script if script is not None else job).update(fields)
+        job["seq"] += 1
+        _collector_jobs_cond.notify_all()
+
+def _run_collector_script(job: Dict[str, Any], script: Dict[str, Any], env: Dict[str, str]) -> None:
+    path = script["path"]
+    started = time.time()
+    _collector_job_update(job, script, status="running", started_at=now_utc_iso())
+    status, return_code = "failed", None
+    try:
+        cp = subprocess.run(
+            [sys.executable, path] if path.endswith(".py") else [path],
+            capture_output=True,
+            text=True,
+            timeout=COLLECTOR_SCRIPT_TIMEOUT,
+            cwd=os.path.dirname(path) or "/tmp",
+            env=env
+        )
+        output = (cp.stdout or "") + (cp.stderr or "")
+        return_code = cp.returncode
+        status = "success" if cp.returncode == 0 else "failed"
+    except subprocess.TimeoutExpired:
+        output = f"[TIMEOUT] Script timed out after {COLLECTOR_SCRIPT_TIMEOUT}s"
+        status = "timeout"
+    except Exception as e:
+        output = f"[ERROR] {str(e)}"
+        status = "error"
+    _collector_job_update(
+        job, script,
+        status=status,
+        return_code=return_code,
+        finished_at=now_utc_iso(),
+        duration_ms=round((time.time() - started) * 1000, 1),
+        output_bytes=len(output.encode("utf-8", "replace")),
+        output=output,
+    )
+
+def _run_collector_job(job: Dict[str, Any], env: Dict[str, str], parallelism: int) -> None:
+    scripts = job["scripts"]
+    append_event({
+        "type": "COLLECTOR",
+        "severity": "INFO",
+        "action": "manual_run_started",
+        "job_id": job["id"],
+        "message": f"Manual collector run started: {len(scripts)} scripts (parallelism {parallelism})"
+    })
+    _collector_job_update(job, status="running")
+    
+    # Scripts write separate usage/conns/report files, so they can run side by side
+    with ThreadPoolExecutor(max_workers=min(parallelism, len(scripts)), thread_name_prefix="collector") as pool:
+        list(pool.map(lambda sc: _run_collector_script(job, sc, env), scripts))
+    
+    failed_scripts = [sc["name"] for sc in scripts if sc["status"] != "success"]
+    all_success = not failed_scripts
+    
+    if job["include_today"]:
+        all_outputs = [f"[INFO] Collecting data for TODAY: {job['label_date']} (incomplete day)\n"]
+    else:
+        all_outputs = [f"[INFO] Collecting data for yesterday: {job['label_date']}\n"]
+    for sc in scripts:
+        all_outputs.append(f"=== Running {sc['name']} ===")
+        all_outputs.append(sc["output"] if sc["output"].strip() else "(no output)")
+        if sc["status"] == "success":
+            all_outputs.append("[OK] Completed successfully")
+        elif sc["status"] == "failed":
+            all_outputs.append(f"[FAILED] Exit code: {sc['return_code']}")
+        all_outputs.append("")  # Empty line between scripts
+    combined_output = "\n".join(all_outputs)
+    
+    # Only results covering the collected day (and all-time stats) are stale
+    invalidate_tags(tag_date(job["label_date"]), TAG_ALLTIME)
+    request_cache_warm()
+    
+    append_event({
+        "type": "COLLECTOR",
+        "severity": "INFO" if all_success else "WARNING",
+        "action": "manual_run_completed",
+        "result": "success" if all_success else "partial",
+        "job_id": job["id"],
+        "scripts_run": len(scripts),
+        "scripts_failed": len(failed_scripts),
+        "message": f"Completed {len(scripts)} scripts, {len(failed_scripts)} failed"
+    })
+    
+    if all_success:
+        message = f"Все {len(scripts)} скрипта успешно выполнены"
+    else:
+        message = f"Выполнено {len(scripts) - len(failed_scripts)}/{len(scripts)} скриптов. Ошибки: {', '.join(failed_scripts)}"
+    
+    _collector_job_update(
+        job,
+        status="success" if all_success else "partial",
+        finished=True,
+        finished_at=now_utc_iso(),
+        duration_ms=round((time.time() - job["_started"]) * 1000, 1),
+        success=all_success,
+        scripts_run=len(scripts),
+        scripts_failed=failed_scripts,
+        return_code=0 if all_success else 1,
+        output=combined_output[:COLLECTOR_OUTPUT_LIMIT] if combined_output else "No output",
+        message=message,
+    )
+
+def _start_collector_job(scripts: List[str], env: Dict[str, str], label_date: str,
+                         include_today: bool, parallelism: int) -> Tuple[Dict[str, Any], bool]:
+    """Register a job and run it in a background thread; (running job, False) if one is in progress"""
+    job = {
+        "id": uuid_lib.uuid4().hex[:12],
+        "status": "queued",
+        "finished": False,
+        "seq": 0,
+        "created_at": now_utc_iso(),
+        "label_date": label_date,
+        "include_today": include_today,
+        "parallelism": parallelism,
+        "scripts": [
+            {"name": os.path.basename(p), "path": p, "status": "queued", "started_at": None,
+             "finished_at": None, "duration_ms": None, "return_code": None, "output_bytes": 0, "output": ""}
+            for p in scripts
+        ],
+        "_started": time.time(),
+    }
+    with _collector_jobs_lock:
+        running = next((j for j in _collector_jobs.values() if not j["finished"]), None)
+        if running is not None:
+            return running, False
+        _collector_jobs[job["id"]] = job
+        while len(_collector_jobs) > COLLECTOR_JOBS_KEEP:
+            oldest = next((k for k, j in _collector_jobs.items() if j["finished"]), None)
+            if oldest is None:
+                break
+            del _collector_jobs[oldest]
+    
+    def runner():
+        try:
+            _run_collector_job(job, env, parallelism)
+        except Exception as e:
+            _collector_job_update(job, status="error", finished=True, finished_at=now_utc_iso(),
+                                  success=False, message=f"Error running collector: {str(e)}")
+    
+    threading.Thread(target=runner, name=f"collector-job-{job['id']}", daemon=True).start()
+    return job, True
+
 @app.post("/api/collector/run")
 def api_collector_run():
-    """Manually trigger ALL collector scripts to run now
+    """Start ALL collector scripts as a background job, returns its id (202)
     
     Optional JSON body:
     - include_today: bool - if true, collect data for today (incomplete day) instead of yesterday
+    
+    Progress: GET /api/collector/jobs/<job_id> or SSE /api/collector/jobs/<job_id>/stream
     """
     j = request.get_json(silent=True) or {}
     include_today = bool(j.get("include_today", False))
@@ -2947,6 +5156,12 @@ def api_collector_run():
                         scripts_to_run.append(part)
                         break
     
+    if s["collector"].get("builtin", False) and os.path.exists(BUILTIN_COLLECTOR):
+        # Встроенный коллектор заменяет xray_daily_*.sh — не запускаем их параллельно с ним
+        scripts_to_run = [p for p in scripts_to_run
+                          if os.path.basename(p) not in LEGACY_COLLECTOR_SCRIPTS and p != BUILTIN_COLLECTOR]
+        scripts_to_run.insert(0, BUILTIN_COLLECTOR)
+    
     if not scripts_to_run:
         # Try common locations
         common_scripts = [
@@ -2962,94 +5177,68 @@ def api_collector_run():
     if not scripts_to_run:
         return fail("Collector scripts not found. Check cron configuration.", code=404)
     
-    try:
-        # Run ALL scripts sequentially
-        append_event({
-            "type": "COLLECTOR",
-            "severity": "INFO",
-            "action": "manual_run_started",
-            "message": f"Manual collector run started: {len(scripts_to_run)} scripts"
-        })
-        
-        all_outputs = []
-        all_success = True
-        failed_scripts = []
-        
-        # Set environment for date override
-        env = os.environ.copy()
-        if include_today:
-            today = dt.datetime.now().strftime("%Y-%m-%d")
-            env["LABEL_DATE"] = today
-            all_outputs.append(f"[INFO] Collecting data for TODAY: {today} (incomplete day)\n")
-        else:
-            yesterday = (dt.datetime.now() - dt.timedelta(days=1)).strftime("%Y-%m-%d")
-            all_outputs.append(f"[INFO] Collecting data for yesterday: {yesterday}\n")
-        
-        for script_to_run in scripts_to_run:
-            script_name = os.path.basename(script_to_run)
-            all_outputs.append(f"=== Running {script_name} ===")
-            
-            try:
-                cp = subprocess.run(
-                    [script_to_run],
-                    capture_output=True,
-                    text=True,
-                    timeout=120,  # 2 minutes timeout per script
-                    cwd=os.path.dirname(script_to_run) or "/tmp",
-                    env=env
-                )
-                
-                output = (cp.stdout or "") + (cp.stderr or "")
-                all_outputs.append(output if output.strip() else "(no output)")
-                
-                if cp.returncode != 0:
-                    all_success = False
-                    failed_scripts.append(script_name)
-                    all_outputs.append(f"[FAILED] Exit code: {cp.returncode}")
-                else:
-                    all_outputs.append(f"[OK] Completed successfully")
-                    
-            except subprocess.TimeoutExpired:
-                all_success = False
-                failed_scripts.append(script_name)
-                all_outputs.append(f"[TIMEOUT] Script timed out after 120s")
-            except Exception as e:
-                all_success = False
-                failed_scripts.append(script_name)
-                all_outputs.append(f"[ERROR] {str(e)}")
-            
-            all_outputs.append("")  # Empty line between scripts
-        
-        combined_output = "\n".join(all_outputs)
-        
-        append_event({
-            "type": "COLLECTOR",
-            "severity": "INFO" if all_success else "WARNING",
-            "action": "manual_run_completed",
-            "result": "success" if all_success else "partial",
-            "scripts_run": len(scripts_to_run),
-            "scripts_failed": len(failed_scripts),
-            "message": f"Completed {len(scripts_to_run)} scripts, {len(failed_scripts)} failed"
-        })
-        
-        if all_success:
-            message = f"Все {len(scripts_to_run)} скрипта успешно выполнены"
-        elif failed_scripts:
-            message = f"Выполнено {len(scripts_to_run) - len(failed_scripts)}/{len(scripts_to_run)} скриптов. Ошибки: {', '.join(failed_scripts)}"
-        else:
-            message = "Collector run completed"
-        
-        return ok({
-            "success": all_success,
-            "scripts_run": len(scripts_to_run),
-            "scripts_failed": failed_scripts,
-            "return_code": 0 if all_success else 1,
-            "output": combined_output[:4000] if combined_output else "No output",
-            "message": message
-        })
-        
-    except Exception as e:
-        return fail(f"Error running collector: {str(e)}", code=500)
+    # Set environment for date override
+    env = os.environ.copy()
+    if include_today:
+        label_date = dt.datetime.now().strftime("%Y-%m-%d")
+        env["LABEL_DATE"] = label_date
+    else:
+        label_date = (dt.datetime.now() - dt.timedelta(days=1)).strftime("%Y-%m-%d")
+    
+    parallelism = max(1, safe_int(str(s["collector"].get("parallelism", 3)), 3))
+    job, started = _start_collector_job(scripts_to_run, env, label_date, include_today, parallelism)
+    with _collector_jobs_lock:
+        view = _collector_job_view(job)
+    return ok({"job_id": job["id"], "already_running": not started, "job": view}), 202
+
+@app.get("/api/collector/jobs")
+def api_collector_jobs():
+    """Recent collector jobs, newest first"""
+    with _collector_jobs_lock:
+        jobs = [_collector_job_view(j) for j in reversed(list(_collector_jobs.values()))]
+    return ok({"jobs": jobs})
+
+@app.get("/api/collector/jobs/<job_id>")
+def api_collector_job(job_id: str):
+    """Progress of a collector job: per-script status, duration, output size"""
+    with _collector_jobs_lock:
+        job = _collector_jobs.get(job_id)
+        if job is None:
+            return fail("job_not_found", code=404)
+        return ok({"job": _collector_job_view(job)})
+
+@app.get("/api/collector/jobs/<job_id>/stream")
+def api_collector_job_stream(job_id: str):
+    """SSE: "progress" on every change of the job, "done" when it has finished"""
+    with _collector_jobs_lock:
+        if job_id not in _collector_jobs:
+            return fail("job_not_found", code=404)
+    
+    def gen():
+        seq = -1
+        while True:
+            with _collector_jobs_cond:
+                job = _collector_jobs.get(job_id)
+                if job is None:
+                    return
+                _collector_jobs_cond.wait_for(lambda: job["seq"] != seq, timeout=15)
+                changed = job["seq"] != seq
+                seq = job["seq"]
+                view = _collector_job_view(job)
+            if not changed:
+                yield "event: ping\ndata: {}\n\n"
+                continue
+            payload = json.dumps(view, ensure_ascii=False)
+            yield "event: progress\ndata: " + payload + "\n\n"
+            if view["finished"]:
+                yield "event: done\ndata: " + payload + "\n\n"
+                return
+    
+    return Response(gen(), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+        "Connection": "keep-alive",
+    })
 
 @app.post("/api/collector/update-schedule")
 def api_collector_update_schedule():
@@ -3159,6 +5348,7 @@ def api_xray_restart():
 
 # --- System ---
 
+@perf_span("systemctl_get_uptime")
 def systemctl_get_uptime(service: str) -> Tuple[Optional[str], Optional[int]]:
     """Get service uptime and restart count"""
     # Validate service name format to prevent command injection
@@ -3700,6 +5890,10 @@ def api_system_journal():
 @app.get("/api/backups")
 def api_backups_list():
     ensure_dirs()
+    version = path_version(BACKUPS_DIR)
+    not_mod = not_modified(version, CACHE_CONTROL["backups"])
+    if not_mod is not None:
+        return not_mod
     items = []
     for p in sorted(glob.glob(os.path.join(BACKUPS_DIR, "*")), reverse=True)[:100]:
         try:
@@ -3711,7 +5905,7 @@ def api_backups_list():
             })
         except OSError:
             pass
-    return ok({"backups": items})
+    return with_validators(ok({"backups": items}), version, CACHE_CONTROL["backups"])
 
 @app.get("/api/backups/preview")
 def api_backups_preview():
@@ -3984,11 +6178,12 @@ def api_backups_restore():
                 pre_restore_backup = None
 
             # Write backup content to config
+            change_tags = _clients_change_tags(get_xray_clients(), get_xray_clients(backup_cfg))
             save_xray_config(backup_cfg, config_path)
 
             # Clear relevant caches
-            clear_cache("users")
-            clear_cache("dashboard")
+            invalidate_tags(*change_tags)
+            note_config_written()
 
             # Optionally restart Xray
             restart_result = None
@@ -4001,6 +6196,8 @@ def api_backups_restore():
                     # Rollback on failure
                     if pre_restore_backup and os.path.exists(pre_restore_backup):
                         shutil.copy2(pre_restore_backup, config_path)
+                        invalidate_tags(*change_tags)
+                        note_config_written()
                         systemctl_restart(srv)
                         append_event({
                             "type": "SYSTEM",
@@ -4098,16 +6295,57 @@ def api_live():
 
 # In-memory ring buffer for live data (24h, 1-minute granularity = 1440 points)
 LIVE_BUFFER_SIZE = 1440
-live_buffer: Dict[str, List[Dict[str, Any]]] = {}  # metric -> list of {ts, value, users}
-live_buffer_lock = threading.Lock()
-live_source = "fallback_access_log"  # "stats" or "fallback_access_log"
-live_traffic_available = False
+
+class TimedLock:
+    """threading.Lock that records how long it was waited for and held"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self._acquired = 0.0
+        self.count = 0
+        self.wait_total = self.wait_max = 0.0
+        self.hold_total = self.hold_max = self.hold_last = 0.0
+
+    def __enter__(self) -> "TimedLock":
+        t0 = time.perf_counter()
+        self._lock.acquire()
+        self._acquired = time.perf_counter()
+        wait = self._acquired - t0
+        self.wait_total += wait
+        self.wait_max = max(self.wait_max, wait)
+        return self
+
+    def __exit__(self, *exc) -> None:
+        held = time.perf_counter() - self._acquired
+        self.count += 1  # счётчики меняет только держатель блокировки
+        self.hold_total += held
+        self.hold_last = held
+        self.hold_max = max(self.hold_max, held)
+        self._lock.release()
+
+    def stats(self) -> Dict[str, Any]:
+        n = self.count or 1
+        return {
+            "name": self.name,
+            "acquisitions": self.count,
+            "hold_ms": {"last": round(self.hold_last * 1000, 3), "avg": round(self.hold_total * 1000 / n, 3),
+                        "max": round(self.hold_max * 1000, 3)},
+            "wait_ms": {"avg": round(self.wait_total * 1000 / n, 3), "max": round(self.wait_max * 1000, 3)},
+        }
+
+# Live state is published copy-on-write: writers (live_updater, the startup dump
+# load) build a new snapshot under live_write_lock and swap the reference;
+# readers take live_snapshot() once and never lock. Nothing reachable from a
+# published snapshot is modified afterwards.
+live_write_lock = TimedLock("live_write")
 
 # Access.log parsing patterns
 TS_RE = re.compile(r"^(?P<y>\d{4})[/-](?P<m>\d{2})[/-](?P<d>\d{2})\s+(?P<h>\d{2}):(?P<mi>\d{2}):(?P<s>\d{2})")
 EMAIL_RE1 = re.compile(r"(?:email|user)[:=]\s*(?P<email>[A-Za-z0-9_\-\.]+)")
 EMAIL_RE2 = re.compile(r"\s(?P<email>user_\d{2})\s*$")
 
+@perf_span("stats_api")
 def _try_stats_api() -> Tuple[bool, Dict[str, Any]]:
     """Try to connect to Xray Stats API (Режим 1: Read-only)
 
@@ -4265,10 +6503,11 @@ def _tail_file(filepath: str, n_lines: int = 1000) -> List[str]:
 def _parse_access_log_recent(minutes: int = 5) -> Dict[str, Any]:
     """Parse access.log for recent activity (fallback)"""
     if not os.path.exists(ACCESS_LOG):
-        return {"users": set(), "conns": 0, "traffic": 0}
+        return {"users": set(), "conns": 0, "traffic": 0, "user_conns": {}}
 
     cutoff_ts = time.time() - (minutes * 60)
     users = set()
+    user_conns: Dict[str, int] = {}
     conns = 0
     traffic = 0
 
@@ -4295,22 +6534,373 @@ def _parse_access_log_recent(minutes: int = 5) -> Dict[str, Any]:
                 email = (em.group("email") or "").strip()
                 if email:
                     users.add(email)
+                    user_conns[email] = user_conns.get(email, 0) + 1
                     conns += 1
     except Exception:
         pass
     
-    return {"users": users, "conns": conns, "traffic": traffic}
+    return {"users": users, "conns": conns, "traffic": traffic, "user_conns": user_conns}
+
+# Long-term live history: points evicted from the ring are rolled up into
+# metrics.db tiers (table, bucket seconds, retention seconds)
+LIVE_TIERS = (
+    ("live_5m", 300, 14 * 86400),
+    ("live_1h", 3600, 90 * 86400),
+)
+LIVE_SERIES_PERIODS = {3600: None, 21600: None, 86400: None, 7 * 86400: "live_5m", 30 * 86400: "live_1h"}
+_live_tiers_lock = threading.Lock()
+_live_tiers_state: Dict[str, Any] = {"prev_traffic": None, "pruned_hour": 0}
+
+def _append_live_points(buffer: Dict[str, Tuple[Dict[str, Any], ...]],
+                        points: Dict[str, Dict[str, Any]]) -> Tuple[Dict[str, Tuple[Dict[str, Any], ...]],
+                                                                     Dict[str, List[Dict[str, Any]]]]:
+    """New buffer with one point per metric appended and cut to LIVE_BUFFER_SIZE, plus what fell off"""
+    new_buffer = dict(buffer)
+    evicted = {}
+    for metric, point in points.items():
+        series = tuple(buffer.get(metric, ())) + (point,)
+        excess = len(series) - LIVE_BUFFER_SIZE
+        if excess > 0:
+            evicted[metric] = list(series[:excess])
+            series = series[excess:]
+        new_buffer[metric] = series
+    return new_buffer, evicted
+
+def _live_tiers_db() -> sqlite3.Connection:
+    conn = sqlite3.connect(METRICS_DB_PATH, timeout=10)
+    for table, _res, _keep in LIVE_TIERS:
+        # traffic — байты за бакет (дельты счётчиков Stats API), users — online_users через "\n"
+        conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                ts INTEGER PRIMARY KEY,
+                traffic INTEGER,
+                conns INTEGER NOT NULL DEFAULT 0,
+                users TEXT NOT NULL DEFAULT ''
+            ) WITHOUT ROWID
+        """)
+    return conn
+
+def _persist_live_evicted(evicted: Dict[str, List[Dict[str, Any]]]) -> None:
+    """Roll evicted ring points into every tier (read-modify-write: a bucket fills over several evictions)"""
+    if not evicted:
+        return
+    samples: Dict[int, Dict[str, Any]] = {}  # minute ts -> {traffic, conns, users}
+    with _live_tiers_lock:
+        for point in evicted.get("traffic", []):
+            value = point.get("value", 0)
+            prev = _live_tiers_state["prev_traffic"]
+            _live_tiers_state["prev_traffic"] = value
+            if prev is None:
+                continue
+            delta = value - prev if value >= prev else value
+            samples.setdefault(point.get("ts", 0), {})["traffic"] = delta
+    for point in evicted.get("conns", []):
+        samples.setdefault(point.get("ts", 0), {})["conns"] = point.get("value", 0)
+    for point in evicted.get("online_users", []):
+        samples.setdefault(point.get("ts", 0), {})["users"] = user_index.users(_point_mask(point))
+
+    try:
+        with _live_tiers_lock, closing(_live_tiers_db()) as conn:
+            for table, res, keep in LIVE_TIERS:
+                buckets: Dict[int, List[Any]] = {}
+                for ts, sample in samples.items():
+                    bucket = buckets.setdefault(int(ts) // res * res, [None, 0, set()])
+                    if "traffic" in sample:
+                        bucket[0] = (bucket[0] or 0) + sample["traffic"]
+                    bucket[1] += sample.get("conns", 0)
+                    bucket[2].update(sample.get("users", ()))
+                for bucket_ts, (traffic, conns, users) in buckets.items():
+                    row = conn.execute(f"SELECT traffic, conns, users FROM {table} WHERE ts = ?",
+                                       (bucket_ts,)).fetchone()
+                    if row is not None:
+                        if row[0] is not None:
+                            traffic = (traffic or 0) + row[0]
+                        conns += row[1]
+                        users.update(u for u in row[2].split("\n") if u)
+                    conn.execute(f"INSERT OR REPLACE INTO {table} (ts, traffic, conns, users) VALUES (?, ?, ?, ?)",
+                                 (bucket_ts, traffic, conns, "\n".join(sorted(users))))
+            now_hour = int(time.time() // 3600)
+            if now_hour > _live_tiers_state["pruned_hour"]:
+                for table, _res, keep in LIVE_TIERS:
+                    conn.execute(f"DELETE FROM {table} WHERE ts < ?", (int(time.time()) - keep,))
+                _live_tiers_state["pruned_hour"] = now_hour
+            conn.commit()
+    except (sqlite3.Error, OSError) as e:
+        print(f"Warning: failed to persist live history: {e}")
+
+# High-resolution ring: 10-second points for the last hour next to the minute
+# ring. Fed by an incremental access.log reader (file read only, no subprocess);
+# the Stats API is still queried once a minute for the minute ring.
+LIVE_HIRES_RES = 10
+LIVE_HIRES_SECONDS = 3600
+LIVE_SAMPLE_MIN_SEC = 5
+LIVE_HIRES_MAX_READ = 4 * 1024 * 1024  # больше за один сэмпл не читаем (первый запуск, всплеск)
+_hires_log_state: Dict[str, Any] = {"inode": None, "offset": 0}
+
+def _live_sample_interval() -> int:
+    """live.sample_sec clamped to [LIVE_SAMPLE_MIN_SEC, 60]"""
+    sec = safe_int(str(load_settings().get("live", {}).get("sample_sec", 10)), 10)
+    return max(LIVE_SAMPLE_MIN_SEC, min(60, sec))
+
+def _read_access_log_increment() -> Dict[str, int]:
+    """Lines per user appended to access.log since the previous call"""
+    try:
+        st = os.stat(ACCESS_LOG)
+    except OSError:
+        return {}
+    state = _hires_log_state
+    if state["inode"] is None:
+        state.update(inode=st.st_ino, offset=st.st_size)  # история уже в минутном кольце
+        return {}
+    if state["inode"] != st.st_ino or st.st_size < state["offset"]:
+        state.update(inode=st.st_ino, offset=0)  # ротация / truncate
+    start = max(state["offset"], st.st_size - LIVE_HIRES_MAX_READ)
+    if start >= st.st_size:
+        return {}
+    with open(ACCESS_LOG, "rb") as f:
+        f.seek(start)
+        chunk = f.read(st.st_size - start)
+    end = chunk.rfind(b"\n") + 1  # незаконченная строка — в следующий раз
+    if start > state["offset"]:
+        chunk = chunk[chunk.find(b"\n") + 1:end]  # пропустили хвост: начинаем с целой строки
+    else:
+        chunk = chunk[:end]
+    state["offset"] = start + end if end else state["offset"]
+    user_conns: Dict[str, int] = {}
+    for line in chunk.decode("utf-8", errors="replace").splitlines():
+        em = EMAIL_RE1.search(line) or EMAIL_RE2.search(line)
+        if em:
+            email = (em.group("email") or "").strip()
+            if email:
+                user_conns[email] = user_conns.get(email, 0) + 1
+    return user_conns
+
+def _sample_live_hires() -> None:
+    """Take one high-resolution sample into the current 10-second bucket"""
+    user_conns = _read_access_log_increment()
+    conns = sum(user_conns.values())
+    mask = user_index.mask(user_conns)
+    now_ts = time.time()
+    bucket = int(now_ts // LIVE_HIRES_RES) * LIVE_HIRES_RES
+    with live_write_lock:
+        state = _live_state
+        hires = state["hires"]
+        if hires and hires[-1]["ts"] == bucket:
+            last = hires[-1]
+            merged = dict(last["users"])
+            for user, c in user_conns.items():
+                merged[user] = merged.get(user, 0) + c
+            hires = hires[:-1] + ({"ts": bucket, "value": last["value"] + conns,
+                                   "mask": last["mask"] | mask, "users": merged},)
+        else:
+            hires = hires + ({"ts": bucket, "value": conns, "mask": mask, "users": user_conns},)
+        cutoff = now_ts - LIVE_HIRES_SECONDS
+        drop = 0
+        while drop < len(hires) and hires[drop]["ts"] < cutoff:
+            drop += 1
+        _publish_live(hires=hires[drop:], hires_version=state["hires_version"] + 1,
+                      hires_since=state["hires_since"] or now_ts)
+
+def _live_recent_from_hires(seconds: int) -> Optional[Dict[str, Any]]:
+    """_parse_access_log_recent() equivalent from the high-res ring, None until it covers the window"""
+    now_ts = time.time()
+    state = live_snapshot()
+    since = state["hires_since"]
+    if since is None or since > now_ts - seconds:
+        return None
+    cutoff = now_ts - seconds
+    mask = 0
+    conns = 0
+    user_conns: Dict[str, int] = {}
+    for point in state["hires"]:
+        if point["ts"] >= cutoff:
+            conns += point["value"]
+            mask |= point["mask"]
+            for user, c in point.get("users", {}).items():
+                user_conns[user] = user_conns.get(user, 0) + c
+    return {"users": set(user_index.users(mask)), "conns": conns, "traffic": 0, "user_conns": user_conns}
+
+def _live_tier_samples(table: str, start_ts: float, end_ts: float) -> List[Tuple[int, Optional[int], int, List[str]]]:
+    """(ts, traffic, conns, users) rows of a live history tier in [start_ts, end_ts)"""
+    if not os.path.exists(METRICS_DB_PATH):
+        return []
+    try:
+        with _live_tiers_lock, closing(_live_tiers_db()) as conn:
+            rows = conn.execute(f"SELECT ts, traffic, conns, users FROM {table} WHERE ts >= ? AND ts < ? ORDER BY ts",
+                                (int(start_ts), int(end_ts))).fetchall()
+    except sqlite3.Error:
+        return []
+    return [(ts, traffic, conns, [u for u in users.split("\n") if u]) for ts, traffic, conns, users in rows]
+
+# Per-user live columns: for every user only the minutes they were active in,
+# packed into arrays (minute mod 2**16, bytes, conns). Idle users cost nothing,
+# an active user-minute costs 8 bytes. Memory only: rebuilt after a restart.
+LIVE_USER_CONNS_MAX = 0xFFFF
+
+class _UserColumn:
+    __slots__ = ("minutes", "traffic", "conns")
+
+    def __init__(self, minutes: Optional[array] = None, traffic: Optional[array] = None,
+                 conns: Optional[array] = None):
+        self.minutes = minutes if minutes is not None else array("H")
+        self.traffic = traffic if traffic is not None else array("I")  # "Q", если за минуту больше 4 GiB
+        self.conns = conns if conns is not None else array("H")
+
+    def sliced(self, start: int) -> "_UserColumn":
+        return _UserColumn(self.minutes[start:], self.traffic[start:], self.conns[start:])
+
+    def extended(self, start: int, minute: int, b: int, c: int) -> "_UserColumn":
+        """Copy from start on with one more minute (the original is left untouched)"""
+        col = self.sliced(start)
+        if b > 0xFFFFFFFF and col.traffic.typecode == "I":
+            col.traffic = array("Q", col.traffic)
+        col.minutes.append(minute & 0xFFFF)
+        col.traffic.append(b)
+        col.conns.append(c)
+        return col
+
+class LiveUserColumns:
+    """
+    Sparse per-user minute series next to the live ring. Immutable once
+    published: appended() returns a new instance sharing the columns of users
+    that did not change. Minutes are stored mod 2**16 and decoded against the
+    newest one, which is unambiguous while the window is shorter than 45 days.
+    """
+
+    def __init__(self):
+        self.columns: Dict[str, _UserColumn] = {}
+        self.last_minute = 0
+        self.first_minute: Optional[int] = None  # columns are complete from this minute on (since start, within the window)
+
+    def _minute(self, stored: int) -> int:
+        return self.last_minute - ((self.last_minute - stored) & 0xFFFF)
+
+    def _first_at(self, col: _UserColumn, ts: float) -> int:
+        """Index of the first minute >= ts (binary search, minutes are increasing)"""
+        minute = ts // 60
+        lo, hi = 0, len(col.minutes)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._minute(col.minutes[mid]) < minute:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def appended(self, ts: float, traffic: Dict[str, int], conns: Dict[str, int],
+                 cutoff_ts: float) -> "LiveUserColumns":
+        """
+        Columns with one minute added (traffic = bytes per user in that minute,
+        conns = connections per user) and minutes before cutoff_ts dropped
+        """
+        minute = int(ts // 60)
+        out = LiveUserColumns()
+        out.last_minute = max(self.last_minute, minute)
+        active = {}
+        for user in traffic.keys() | conns.keys():
+            b = max(0, traffic.get(user, 0))
+            c = min(conns.get(user, 0), LIVE_USER_CONNS_MAX)
+            if b or c:
+                active[user] = (b, c)
+        cutoff = cutoff_ts // 60
+        out.first_minute = max(minute if self.first_minute is None else self.first_minute, int(cutoff))
+        for user, col in self.columns.items():
+            start = 0 if out._minute(col.minutes[0]) >= cutoff else out._first_at(col, cutoff_ts)
+            sample = active.pop(user, None)
+            if sample is not None:
+                out.columns[user] = col.extended(start, minute, *sample)
+            elif start == 0:
+                out.columns[user] = col  # не изменился — общий с прошлым снимком
+            elif start < len(col.minutes):
+                out.columns[user] = col.sliced(start)
+        for user, (b, c) in active.items():
+            out.columns[sys.intern(user)] = _UserColumn().extended(0, minute, b, c)
+        return out
+
+    def series(self, user: str, start_ts: float) -> List[Tuple[int, int, int]]:
+        """(minute ts, bytes, conns) of one user's active minutes since start_ts"""
+        col = self.columns.get(user)
+        if col is None:
+            return []
+        i = self._first_at(col, start_ts)
+        return [(self._minute(m) * 60, b, c) for m, b, c in zip(col.minutes[i:], col.traffic[i:], col.conns[i:])]
+
+    def totals(self, metric: str, start_ts: float) -> Dict[str, int]:
+        """Per-user sum of "traffic" or "conns" since start_ts"""
+        out = {}
+        for user, col in self.columns.items():
+            values = col.conns if metric == "conns" else col.traffic
+            total = sum(values[self._first_at(col, start_ts):])
+            if total:
+                out[user] = total
+        return out
+
+    def memory_bytes(self) -> int:
+        """Approximate footprint (dict, column objects, arrays)"""
+        size = sys.getsizeof(self.columns)
+        for col in self.columns.values():
+            size += sys.getsizeof(col) + sum(sys.getsizeof(a) for a in (col.minutes, col.traffic, col.conns))
+        return size
+
+_live_state: Dict[str, Any] = {
+    "version": 0,  # bumped on every minute update (ETag source for live endpoints)
+    "buffer": {},  # metric -> tuple of {ts, value, ...} points, oldest first
+    "source": "fallback_access_log",  # "stats" or "fallback_access_log"
+    "traffic_available": False,
+    "hires": (),  # 10s points {ts, value (conns), mask, users {user: conns}}
+    "hires_version": 0,
+    "hires_since": None,  # first high-res sample
+    "users": LiveUserColumns(),
+    "user_counters": {},  # email -> {"uplink", "downlink"}: last Stats API counters
+    "published": 0.0,
+}
+
+def live_snapshot() -> Dict[str, Any]:
+    """Current published live state; read it as is, never modify"""
+    return _live_state
+
+def _publish_live(**changes: Any) -> Dict[str, Any]:
+    """Swap in a new snapshot with changes applied (caller holds live_write_lock)"""
+    global _live_state
+    _live_state = {**_live_state, **changes, "published": time.time()}
+    return _live_state
+
+def _dump_live_state(state: Dict[str, Any]) -> None:
+    """Save the minute ring (дамп) so a restart keeps the last 24h"""
+    try:
+        atomic_write_json(LIVE_STATE_PATH, {
+            "buffer": state["buffer"],
+            "source": state["source"],
+            "trafficAvailable": state["traffic_available"],
+            "updatedAt": now_utc_iso(),
+        })
+    except Exception:
+        pass
+_live_user_counters: Dict[str, int] = {}  # email -> last Stats API uplink+downlink (for per-minute deltas)
+
+def _live_user_traffic(users_data: Dict[str, Dict[str, int]]) -> Dict[str, int]:
+    """Per-user bytes since the previous Stats API query (counter drop = Xray restart)"""
+    out = {}
+    for email, counters in users_data.items():
+        total = counters.get("uplink", 0) + counters.get("downlink", 0)
+        prev = _live_user_counters.get(email)
+        _live_user_counters[email] = total
+        if prev is not None:
+            delta = total - prev if total >= prev else total
+            if delta:
+                out[email] = delta
+    return out
+
+def _live_user_conns() -> Dict[str, int]:
+    """Connections per user over the last minute (high-res ring, or access.log tail until it warms up)"""
+    recent = _live_recent_from_hires(60) or _parse_access_log_recent(1)
+    return recent["user_conns"]
 
 def _update_live_buffer():
     """Update live buffer from Stats API or access.log"""
-    global live_source, live_traffic_available
-    
     # Try Stats API first (Режим 1: Read-only)
     stats_ok, stats_data = _try_stats_api()
     if stats_ok:
-        live_source = "stats"
-        live_traffic_available = True
-
         now_ts = time.time()
         now_min = int(now_ts // 60) * 60  # Round to minute
 
@@ -4322,148 +6912,136 @@ def _update_live_buffer():
         ]
 
         total_traffic = stats_data.get("total_uplink", 0) + stats_data.get("total_downlink", 0)
-
-        with live_buffer_lock:
-            # Initialize buffer keys if needed
-            if "online_users" not in live_buffer:
-                live_buffer["online_users"] = []
-            if "conns" not in live_buffer:
-                live_buffer["conns"] = []
-            if "traffic" not in live_buffer:
-                live_buffer["traffic"] = []
-
-            # Add current minute point
-            live_buffer["online_users"].append({
-                "ts": now_min,
-                "value": len(active_users),
-                "users": active_users,
-            })
-            live_buffer["conns"].append({
-                "ts": now_min,
-                "value": len(active_users),  # Each active user is a connection
-            })
-            live_buffer["traffic"].append({
-                "ts": now_min,
-                "value": total_traffic,
-                "uplink": stats_data.get("total_uplink", 0),
-                "downlink": stats_data.get("total_downlink", 0),
+        user_conns = _live_user_conns()
+
+        with live_write_lock:
+            state = _live_state
+            # Add current minute point; older ones go to the 5m/1h tiers
+            buffer, evicted = _append_live_points(state["buffer"], {
+                "online_users": {
+                    "ts": now_min,
+                    "value": len(active_users),
+                    "mask": user_index.mask(active_users),
+                },
+                "conns": {
+                    "ts": now_min,
+                    "value": sum(user_conns.values()),  # строки access.log за минуту, как в hires и per-user
+                },
+                "traffic": {
+                    "ts": now_min,
+                    "value": total_traffic,
+                    "uplink": stats_data.get("total_uplink", 0),
+                    "downlink": stats_data.get("total_downlink", 0),
+                },
             })
+            users = state["users"].appended(now_min, _live_user_traffic(users_data), user_conns,
+                                            now_min - (LIVE_BUFFER_SIZE - 1) * 60)
+            state = _publish_live(version=state["version"] + 1, buffer=buffer, users=users,
+                                  user_counters=users_data, source="stats", traffic_available=True)
 
-            # Keep only last LIVE_BUFFER_SIZE points
-            for metric in live_buffer:
-                if len(live_buffer[metric]) > LIVE_BUFFER_SIZE:
-                    live_buffer[metric] = live_buffer[metric][-LIVE_BUFFER_SIZE:]
-
-            # Save to file (дамп)
-            try:
-                atomic_write_json(LIVE_STATE_PATH, {
-                    "buffer": live_buffer,
-                    "source": live_source,
-                    "trafficAvailable": live_traffic_available,
-                    "updatedAt": now_utc_iso(),
-                })
-            except Exception:
-                pass
-
+        _dump_live_state(state)
+        _persist_live_evicted(evicted)
         return
     
     # Fallback to access.log
-    live_source = "fallback_access_log"
-    live_traffic_available = False
-    
-    access_data = _parse_access_log_recent(5)
+    # Reuse the high-res ring's counters when it already covers 5 minutes
+    access_data = _live_recent_from_hires(300) or _parse_access_log_recent(5)
+    user_conns = _live_user_conns()
     now_ts = time.time()
     now_min = int(now_ts // 60) * 60  # Round to minute
     
-    with live_buffer_lock:
-        # Update online_users metric
-        if "online_users" not in live_buffer:
-            live_buffer["online_users"] = []
-        if "conns" not in live_buffer:
-            live_buffer["conns"] = []
-        
-        # Add current minute point
-        live_buffer["online_users"].append({
-            "ts": now_min,
-            "value": len(access_data["users"]),
-            "users": list(access_data["users"]),
-        })
-        live_buffer["conns"].append({
-            "ts": now_min,
-            "value": access_data["conns"],
+    with live_write_lock:
+        state = _live_state
+        # Add current minute point; older ones go to the 5m/1h tiers
+        buffer, evicted = _append_live_points(state["buffer"], {
+            "online_users": {
+                "ts": now_min,
+                "value": len(access_data["users"]),
+                "mask": user_index.mask(access_data["users"]),
+            },
+            "conns": {
+                "ts": now_min,
+                "value": sum(user_conns.values()),  # строки access.log за минуту (не за 5-минутное окно)
+            },
         })
-        
-        # Keep only last LIVE_BUFFER_SIZE points
-        for metric in live_buffer:
-            if len(live_buffer[metric]) > LIVE_BUFFER_SIZE:
-                live_buffer[metric] = live_buffer[metric][-LIVE_BUFFER_SIZE:]
-        
-        # Save to file (дамп)
-        try:
-            atomic_write_json(LIVE_STATE_PATH, {
-                "buffer": live_buffer,
-                "source": live_source,
-                "trafficAvailable": live_traffic_available,
-                "updatedAt": now_utc_iso(),
-            })
-        except Exception:
-            pass
+        users = state["users"].appended(now_min, {}, user_conns, now_min - (LIVE_BUFFER_SIZE - 1) * 60)
+        state = _publish_live(version=state["version"] + 1, buffer=buffer, users=users, user_counters={},
+                              source="fallback_access_log", traffic_available=False)
+    
+    _dump_live_state(state)
+    _persist_live_evicted(evicted)
 
 def _load_live_buffer_from_dump():
     """Load live buffer from dump file on startup"""
-    global live_source, live_traffic_available
     try:
         if os.path.exists(LIVE_STATE_PATH):
             data = read_json(LIVE_STATE_PATH, {})
-            with live_buffer_lock:
-                live_buffer.update(data.get("buffer", {}))
-                live_source = data.get("source", "fallback_access_log")
-                live_traffic_available = data.get("trafficAvailable", False)
+            buffer = {metric: tuple(points) for metric, points in (data.get("buffer") or {}).items()
+                      if isinstance(points, list)}
+            with live_write_lock:
+                _publish_live(
+                    version=_live_state["version"] + 1,
+                    buffer={**_live_state["buffer"], **buffer},
+                    source=data.get("source", "fallback_access_log"),
+                    traffic_available=data.get("trafficAvailable", False),
+                )
     except Exception:
         pass
 
-def _get_live_now() -> Dict[str, Any]:
+def _live_version(state: Optional[Dict[str, Any]] = None) -> str:
+    """Version of live buffer data; the minute part rolls the time windows forward"""
+    state = state or live_snapshot()
+    return f"{state['version']}:{state['source']}:{int(time.time() // 60)}"
+
+def _get_live_now(state: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
     """Get current 'now' state (rolling 5 minutes)"""
-    with live_buffer_lock:
-        cutoff = time.time() - 300  # 5 minutes
-        online_users = set()
-        conns_values = []
-        traffic_values = []
-        
-        # Aggregate from buffer
-        for metric_name, metric_data in live_buffer.items():
-            for point in metric_data:
-                if point.get("ts", 0) >= cutoff:
-                    if metric_name == "online_users" and "users" in point:
-                        online_users.update(point["users"])
-                    elif metric_name == "conns":
-                        conns_values.append(point.get("value", 0))
-                    elif metric_name == "traffic":
-                        traffic_values.append(point.get("value", 0))
-        
-        # Use last value (most recent) instead of sum
-        current_conns = conns_values[-1] if conns_values else 0
-        current_traffic = traffic_values[-1] if traffic_values else 0
-        
-        return {
-            "onlineUsers": list(online_users),  # Return list of user IDs
-            "onlineUsersCount": len(online_users),
-            "conns": current_conns,
-            "trafficBytes": current_traffic,
-            "trafficAvailable": live_traffic_available,
-        }
+    state = state or live_snapshot()
+    cutoff = time.time() - 300  # 5 minutes
+    online_mask = 0
+    conns_values = []
+    traffic_values = []
+    
+    # Aggregate from buffer (points are in time order: only the tail is inside the window)
+    for metric_name, metric_data in state["buffer"].items():
+        for point in reversed(metric_data):
+            if point.get("ts", 0) < cutoff:
+                break
+            if metric_name == "online_users":
+                online_mask |= _point_mask(point)
+            elif metric_name == "conns":
+                conns_values.append(point.get("value", 0))
+            elif metric_name == "traffic":
+                traffic_values.append(point.get("value", 0))
+    
+    # Use last value (most recent) instead of sum
+    current_conns = conns_values[0] if conns_values else 0
+    current_traffic = traffic_values[0] if traffic_values else 0
+    online_users = user_index.users(online_mask)
+    
+    return {
+        "onlineUsers": online_users,  # Return list of user IDs
+        "onlineUsersCount": len(online_users),
+        "conns": current_conns,
+        "trafficBytes": current_traffic,
+        "trafficAvailable": state["traffic_available"],
+    }
 
 @app.get("/api/live/now")
 def api_live_now():
     """Get current 'now' state (rolling 5 minutes)"""
-    now_data = _get_live_now()
-    return ok({
+    state = live_snapshot()
+    version = _live_version(state)
+    not_mod = not_modified(version, CACHE_CONTROL["live"])
+    if not_mod is not None:
+        return not_mod
+    now_data = _get_live_now(state)
+    return with_validators(ok({
         "meta": {
-            "source": live_source,
+            "source": state["source"],
             "rollingWindowSec": 300,
         },
         "now": now_data,
-    })
+    }), version, CACHE_CONTROL["live"])
 
 @app.get("/api/live/series")
 def api_live_series():
@@ -4475,61 +7053,101 @@ def api_live_series():
     period = safe_int(request.args.get("period"), 3600)  # 60m default
     gran = safe_int(request.args.get("gran"), 300)  # 5m default
     scope = request.args.get("scope", "global").strip()
-    
-    # Validate
-    if period not in [3600, 21600, 86400]:  # 60m, 6h, 24h
+    # scope=user:<email> — one user's series: online state (0/1) from the same
+    # bitmasks, traffic/conns from the per-user columns (ring window only)
+    user = scope[5:].strip() if scope.startswith("user:") else None
+    if scope != "global" and not user:
+        return fail("invalid_scope: expected global or user:<email>")
+    user_columns = user is not None and metric != "online_users"
+    
+    # Validate: 60m, 6h, 24h from the ring buffer; 7d, 30d from the 5m/1h tiers;
+    # gran=10 from the high-res ring (last hour; conns/online_users, traffic stays per minute)
+    if period not in LIVE_SERIES_PERIODS:
         period = 3600
-    if gran not in [60, 300, 600, 900, 1800]:  # 1m, 5m, 10m, 15m, 30m
+    if gran not in [10, 60, 300, 600, 900, 1800, 3600, 21600, 86400]:  # 10s ... 1d
         gran = 300
-    
-    # Aggregate from ring buffer
+    tier = None if user_columns else LIVE_SERIES_PERIODS[period]
+    hires = (gran < 60 and tier is None and period <= LIVE_HIRES_SECONDS and metric != "traffic"
+             and not user_columns)
+    if hires:
+        tier_res = LIVE_HIRES_RES
+    else:
+        tier_res = next((res for table, res, _keep in LIVE_TIERS if table == tier), 60)
+    gran = min(max(gran, tier_res), period // 2)
+    
+    state = live_snapshot()
+    version = _live_version(state)
+    if hires:
+        version = f"{version}:hires:{state['hires_version']}"
+    not_mod = not_modified(version, CACHE_CONTROL["live"])
+    if not_mod is not None:
+        return not_mod
+    
+    # Aggregate ring buffer (+ tier rows older than the ring) into buckets
     now_ts = time.time()
-    series = []
     points = period // gran
     start_ts = now_ts - period
-    
-    with live_buffer_lock:
-        metric_data = live_buffer.get(metric, [])
-        
-        # Aggregate by buckets
-        for i in range(points):
-            bucket_start = start_ts + i * gran
-            bucket_end = bucket_start + gran
-            bucket_ts = bucket_start
-            
-            # Aggregate values in this bucket
-            value = 0
-            if metric == "online_users":
-                users_in_bucket = set()
-                for point in metric_data:
-                    pt_ts = point.get("ts", 0)
-                    if bucket_start <= pt_ts < bucket_end:
-                        if "users" in point:
-                            users_in_bucket.update(point["users"])
-                value = len(users_in_bucket)
+    values = [0] * points  # sums, or OR-ed online-user bitmasks for online_users
+    distinct = metric == "online_users"
+    scope_mask = -1  # все биты
+    if user is not None:
+        bit = user_index.lookup(user)
+        scope_mask = 0 if bit is None else 1 << bit
+    
+    def add(ts: float, value: int, mask: int = 0) -> None:
+        idx = int((ts - start_ts) // gran)
+        if 0 <= idx < points:
+            if distinct:
+                values[idx] |= mask & scope_mask
             else:
-                for point in metric_data:
-                    pt_ts = point.get("ts", 0)
-                    if bucket_start <= pt_ts < bucket_end:
-                        value += point.get("value", 0)
-            
-            series.append({
-                "ts": dt.datetime.utcfromtimestamp(bucket_ts).isoformat() + "Z",
-                "value": value,
-            })
+                values[idx] += value
     
-    return ok({
+    if user_columns:
+        user_samples = state["users"].series(user, start_ts)
+        metric_data = ()
+    else:
+        metric_data = state["hires"] if hires else state["buffer"].get(metric, ())
+    ring_start = metric_data[0].get("ts", now_ts) if metric_data else now_ts
+    
+    if user_columns:
+        # bytes here are already per minute (Stats API deltas per user)
+        for ts, traffic, conns in user_samples:
+            add(ts, traffic if metric == "traffic" else conns)
+    
+    if tier and start_ts < ring_start:
+        for ts, traffic, conns, users in _live_tier_samples(tier, start_ts, ring_start):
+            add(ts, (traffic or 0) if metric == "traffic" else conns, user_index.mask(users) if distinct else 0)
+    
+    with _live_tiers_lock:
+        prev = _live_tiers_state["prev_traffic"]  # last counter evicted right before the ring
+    for point in metric_data:
+        value = point.get("value", 0)
+        if metric == "traffic":
+            # Stats API counters are cumulative: bytes per point = delta (drop = Xray restart)
+            value, prev = (0 if prev is None else (value - prev if value >= prev else value)), value
+        add(point.get("ts", 0), value, _point_mask(point) if distinct else 0)
+    
+    series = []
+    for i in range(points):
+        series.append({
+            "ts": dt.datetime.utcfromtimestamp(start_ts + i * gran).isoformat() + "Z",
+            "value": _popcount(values[i]) if distinct else values[i],
+        })
+    
+    return with_validators(ok({
         "meta": {
             "metric": metric,
             "period": period,
             "gran": gran,
             "scope": scope,
-            "source": live_source,
-            "trafficAvailable": metric == "traffic" and live_traffic_available,
+            "tier": "hires" if hires else (tier or "ring"),
+            "user": user,
+            "source": state["source"],
+            "trafficAvailable": metric == "traffic" and state["traffic_available"],
         },
         "series": series,
-        "unit": "bytes" if metric == "traffic" else "count",
-    })
+        "unit": {"traffic": "bytes", "conns": "log_lines"}.get(metric, "users"),
+    }), version, CACHE_CONTROL["live"])
 
 @app.get("/api/live/top")
 def api_live_top():
@@ -4544,27 +7162,28 @@ def api_live_top():
     limit = safe_int(request.args.get("limit"), 10)
     limit = max(1, min(50, limit))
     
+    # displayName comes from the Xray config aliases
+    settings = load_settings()
+    state = live_snapshot()
+    version = f"{_live_version(state)}|{path_version(settings['xray'].get('config_path', XRAY_CFG))}"
+    not_mod = not_modified(version, CACHE_CONTROL["live"])
+    if not_mod is not None:
+        return not_mod
+    
     # Aggregate from buffer
     now_ts = time.time()
     start_ts = now_ts - period
     user_stats: Dict[str, int] = {}  # userId -> aggregated value
     
-    with live_buffer_lock:
-        metric_data = live_buffer.get(metric, [])
-        
-        for point in metric_data:
-            pt_ts = point.get("ts", 0)
-            if pt_ts < start_ts:
+    if metric == "online_users":
+        for point in state["buffer"].get(metric, ()):
+            if point.get("ts", 0) < start_ts:
                 continue
-            
-            if metric == "online_users" and "users" in point:
-                for user in point["users"]:
-                    user_stats[user] = user_stats.get(user, 0) + 1
-            elif "users" in point and isinstance(point["users"], dict):
-                # For traffic/conns, if we have per-user data
-                for user, val in point["users"].items():
-                    user_stats[user] = user_stats.get(user, 0) + val
-            # If no per-user data, we can't build top users
+            for user in user_index.users(_point_mask(point)):
+                user_stats[user] = user_stats.get(user, 0) + 1
+    else:
+        # traffic/conns: per-user columns (bytes are per-minute deltas)
+        user_stats = state["users"].totals(metric, start_ts)
     
     # Build rows with display names
     clients = get_xray_clients()
@@ -4573,7 +7192,7 @@ def api_live_top():
     rows = []
     total = sum(user_stats.values()) or 0
     
-    for user, val in sorted(user_stats.items(), key=lambda x: x[1], reverse=True)[:limit]:
+    for user, val in top_k(user_stats, limit):
         client = clients_by_email.get(user, {})
         display_name = client.get("alias") or user
         share = (val / total * 100.0) if total > 0 else 0.0
@@ -4584,15 +7203,385 @@ def api_live_top():
             "sharePct": round(share, 2),
         })
     
-    return ok({
+    return with_validators(ok({
         "meta": {
             "metric": metric,
             "period": period,
-            "source": live_source,
-            "trafficAvailable": metric == "traffic" and live_traffic_available,
+            "source": state["source"],
+            "trafficAvailable": metric == "traffic" and state["traffic_available"],
         },
         "rows": rows,
-    })
+    }), version, CACHE_CONTROL["live"])
+
+# ---------------------------
+# Hourly usage tier (heatmaps)
+# ---------------------------
+HOURLY_RETENTION_DAYS = 120
+HEATMAP_WINDOWS = (30, 60, 90)  # окна ?days=, для каждого ячейки считаются заранее
+HEATMAP_METRICS = ("traffic", "conns")
+
+_hourly_lock = threading.Lock()  # _heatmaps
+_hourly_update_lock = threading.Lock()  # update_hourly_tier (live updater thread and first request)
+_hourly_state: Dict[str, Any] = {"last_live_hour": None, "partials": {}, "pruned_hour": 0}
+_heatmaps: Dict[Tuple[str, int], Dict[str, Any]] = {}  # (metric, days) -> precomputed 7x24 cells
+_heatmap_version = 0
+
+def _hourly_db() -> sqlite3.Connection:
+    conn = sqlite3.connect(METRICS_DB_PATH, timeout=10)
+    # Одна строка на час: ~2k строк на 90 дней. live_* из ring buffer и per-user колонок,
+    # collector_* из usage_*.partial. Подключения везде — строки access.log за час.
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS usage_hourly (
+            hour_ts INTEGER PRIMARY KEY,
+            live_traffic INTEGER,
+            live_lines INTEGER,
+            collector_traffic INTEGER,
+            collector_conns INTEGER
+        ) WITHOUT ROWID
+    """)
+    # Older tables have live_conns (mixed units: active users or 5-minute windows); it is no longer read
+    if "live_lines" not in {row[1] for row in conn.execute("PRAGMA table_info(usage_hourly)")}:
+        conn.execute("ALTER TABLE usage_hourly ADD COLUMN live_lines INTEGER")
+    return conn
+
+def _local_hour_start(ts: float) -> int:
+    """Start of the server-local hour containing ts (heatmaps are in server time)"""
+    return int(dt.datetime.fromtimestamp(ts).replace(minute=0, second=0, microsecond=0).timestamp())
+
+def _rollup_live_hours(after_hour: int, before_hour: int) -> Dict[int, List[Optional[int]]]:
+    """
+    {hour_ts: [traffic, log lines]} for complete hours in (after_hour, before_hour).
+    Traffic comes from the ring buffer: cumulative Stats API counters, so bytes
+    are per-minute deltas (a drop means Xray restarted). Log lines are summed
+    from the per-user columns (access.log lines per user and minute, the unit of
+    collector_conns); None for hours the columns do not fully cover (they live
+    only in memory and start empty after a restart).
+    """
+    state = live_snapshot()
+    hours: Dict[int, List[Optional[int]]] = {}
+    prev = None
+    for point in state["buffer"].get("traffic", ()):
+        value = point.get("value", 0)
+        if prev is not None:
+            hour = _local_hour_start(point.get("ts", 0))
+            if after_hour < hour < before_hour:
+                delta = value - prev if value >= prev else value
+                hours.setdefault(hour, [0, None])[0] += delta
+        prev = value
+    users = state["users"]
+    if users.first_minute is None:
+        return hours
+    covered_from = users.first_minute * 60
+    # last_live_hour is 0 before the first rollup: start at the columns, not at the epoch
+    for ts in range(max(after_hour, covered_from - 3600) + 3600, before_hour, 3600):
+        hour = _local_hour_start(ts)
+        if after_hour < hour < before_hour and hour >= covered_from:
+            hours.setdefault(hour, [0, None])[1] = 0
+    for user in users.columns:
+        for ts, _traffic, lines in users.series(user, max(covered_from, after_hour + 1)):
+            hour = _local_hour_start(ts)
+            bucket = hours.get(hour)
+            if bucket is not None and bucket[1] is not None:
+                bucket[1] += lines
+    return hours
+
+def _ingest_collector_hours(conn: sqlite3.Connection) -> bool:
+    """Hourly buckets of today's/yesterday's usage_*.partial (re-read only when the file changed)"""
+    usage_dir = load_settings()["collector"].get("usage_dir", USAGE_DIR)
+    today = dt.date.today()
+    changed = False
+    seen: Dict[str, str] = {}
+    for day in (today - dt.timedelta(days=1), today):
+        path = os.path.join(usage_dir, f"usage_{day.isoformat()}.partial")
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        version = f"{st.st_mtime_ns}:{st.st_size}"
+        seen[path] = version
+        if _hourly_state["partials"].get(path) == version:
+            continue
+        partial = _load_usage_partial(usage_dir, day.isoformat())
+        if partial is None:
+            continue
+        rows = []
+        for hour, (traffic, conns) in partial["hours"].items():
+            if 0 <= hour < 24:
+                hour_ts = int(dt.datetime.combine(day, dt.time(hour)).timestamp())
+                # 0 = в этот час строк не было (трафик пишется в час запуска), пусть решает live
+                rows.append((hour_ts, traffic or None, conns or None))
+        # partial накопительный за день — строки часа перезаписываются целиком
+        conn.executemany("""
+            INSERT INTO usage_hourly (hour_ts, collector_traffic, collector_conns) VALUES (?, ?, ?)
+            ON CONFLICT(hour_ts) DO UPDATE SET
+                collector_traffic = excluded.collector_traffic,
+                collector_conns = excluded.collector_conns
+        """, rows)
+        changed = True
+    _hourly_state["partials"] = seen
+    return changed
+
+def _rebuild_heatmaps(conn: sqlite3.Connection) -> None:
+    """Precompute weekday x hour cells for every HEATMAP_WINDOWS window (one pass over the tier)"""
+    global _heatmap_version
+    now = time.time()
+    today_start = dt.datetime.combine(dt.date.today(), dt.time())
+    starts = {days: int((today_start - dt.timedelta(days=days - 1)).timestamp()) for days in HEATMAP_WINDOWS}
+    grids = {
+        (metric, days): {"sum": [[0] * 24 for _ in range(7)], "hours": [[0] * 24 for _ in range(7)]}
+        for metric in HEATMAP_METRICS for days in HEATMAP_WINDOWS
+    }
+    rows = conn.execute("""
+        SELECT hour_ts, live_traffic, live_lines, collector_traffic, collector_conns
+        FROM usage_hourly WHERE hour_ts >= ? ORDER BY hour_ts
+    """, (min(starts.values()),)).fetchall()
+    for hour_ts, live_traffic, live_lines, collector_traffic, collector_conns in rows:
+        local = dt.datetime.fromtimestamp(hour_ts)
+        dow, hour = local.weekday(), local.hour
+        # Трафик точнее поминутный (live), подключения — из access.log (collector)
+        values = {
+            "traffic": live_traffic if live_traffic is not None else collector_traffic,
+            "conns": collector_conns if collector_conns is not None else live_lines,
+        }
+        for metric, value in values.items():
+            if value is None:
+                continue
+            for days, start in starts.items():
+                if hour_ts >= start:
+                    grid = grids[(metric, days)]
+                    grid["sum"][dow][hour] += value
+                    grid["hours"][dow][hour] += 1
+
+    generated_at = now_utc_iso()
+    heatmaps = {}
+    for (metric, days), grid in grids.items():
+        avg = [[round(grid["sum"][d][h] / grid["hours"][d][h], 1) if grid["hours"][d][h] else 0
+                for h in range(24)] for d in range(7)]
+        flat = [v for row in grid["sum"] for v in row]
+        heatmaps[(metric, days)] = {
+            "meta": {
+                "metric": metric,
+                "days": days,
+                "from": dt.date.fromtimestamp(starts[days]).isoformat(),
+                "to": dt.date.fromtimestamp(now).isoformat(),
+                "timezone": time.strftime("%z"),
+                "generatedAt": generated_at,
+            },
+            "cells": grid["sum"],  # [weekday 0=Mon][hour]
+            "avg": avg,  # среднее за час этого дня недели (только часы с данными)
+            "hoursWithData": grid["hours"],
+            "total": sum(flat),
+            "max": max(flat) if flat else 0,
+            "unit": "bytes" if metric == "traffic" else "log_lines",  # conns: строки access.log
+        }
+    with _hourly_lock:
+        _heatmaps.clear()
+        _heatmaps.update(heatmaps)
+        _heatmap_version += 1
+
+def update_hourly_tier() -> None:
+    """Fold completed live hours and changed collector partials into usage_hourly, refresh heatmaps"""
+    current_hour = _local_hour_start(time.time())
+    with _hourly_update_lock, closing(_hourly_db()) as conn:
+        if _hourly_state["last_live_hour"] is None:
+            row = conn.execute(
+                "SELECT MAX(hour_ts) FROM usage_hourly WHERE live_traffic IS NOT NULL OR live_lines IS NOT NULL"
+            ).fetchone()
+            _hourly_state["last_live_hour"] = row[0] or 0
+        changed = False
+        if current_hour > _hourly_state["last_live_hour"] + 3600:
+            hours = _rollup_live_hours(_hourly_state["last_live_hour"], current_hour)
+            conn.executemany("""
+                INSERT INTO usage_hourly (hour_ts, live_traffic, live_lines) VALUES (?, ?, ?)
+                ON CONFLICT(hour_ts) DO UPDATE SET
+                    live_traffic = excluded.live_traffic,
+                    live_lines = excluded.live_lines
+            """, [(h, (v[0] if live_snapshot()["traffic_available"] else None), v[1]) for h, v in sorted(hours.items())])
+            _hourly_state["last_live_hour"] = current_hour - 3600
+            changed = True
+        changed = _ingest_collector_hours(conn) or changed
+        if current_hour > _hourly_state["pruned_hour"]:
+            conn.execute("DELETE FROM usage_hourly WHERE hour_ts < ?",
+                         (current_hour - HOURLY_RETENTION_DAYS * 86400,))
+            _hourly_state["pruned_hour"] = current_hour
+            changed = True  # окна сдвигаются раз в час, даже без новых данных
+        conn.commit()
+        if changed or not _heatmaps:
+            _rebuild_heatmaps(conn)
+
+@app.get("/api/usage/heatmap")
+def api_usage_heatmap():
+    """Hour-of-day x day-of-week heatmap (?metric=traffic|conns&days=30|60|90), precomputed cells"""
+    metric = request.args.get("metric", "traffic").strip()
+    if metric not in HEATMAP_METRICS:
+        metric = "traffic"
+    days = safe_int(request.args.get("days"), HEATMAP_WINDOWS[0])
+    days = next((w for w in HEATMAP_WINDOWS if days <= w), HEATMAP_WINDOWS[-1])
+
+    if not _heatmaps:
+        try:
+            update_hourly_tier()
+        except (sqlite3.Error, OSError) as e:
+            return fail(f"Hourly tier unavailable: {str(e)}", code=503)
+    with _hourly_lock:
+        data = _heatmaps.get((metric, days))
+        if data is None:
+            # the first build failed in another thread (error already reported there)
+            return fail("Hourly tier unavailable: heatmaps are not built yet", code=503)
+        version = f"heatmap:{metric}:{days}:{_heatmap_version}:{data['meta']['generatedAt']}"
+    not_mod = not_modified(version, CACHE_CONTROL["usage"])
+    if not_mod is not None:
+        return not_mod
+    return with_validators(ok(data), version, CACHE_CONTROL["usage"])
+
+ACTIVE_USERS_MAX_DAYS = 90
+
+@app.get("/api/usage/active-users")
+def api_usage_active_users():
+    """
+    Daily/weekly/window active users (exact, OR of per-day user bitmasks) and
+    distinct destinations (HyperLogLog estimate) over ?days=30 (7..90, ending today)
+    """
+    days = max(7, min(ACTIVE_USERS_MAX_DAYS, safe_int(request.args.get("days"), 30)))
+    version = f"active-users:{days}:{sync_usage_cache()}"
+    not_mod = not_modified(version, CACHE_CONTROL["usage"])
+    if not_mod is not None:
+        return not_mod
+    cache_key = f"active_users_{days}"
+    entry = get_cached_entry(cache_key, ttl=CACHE_TTL["usage"])
+    if entry is None:
+        settings = load_settings()
+        usage_dir = settings["collector"].get("usage_dir", USAGE_DIR)
+        if not os.path.isdir(usage_dir):
+            return fail(f"Directory not found: {usage_dir}", code=404)
+        today = dt.datetime.utcnow().date()
+        date_keys = [(today - dt.timedelta(days=i)).isoformat() for i in range(days - 1, -1, -1)]
+        per_day = [_day_distinct(usage_dir, k) for k in date_keys]
+
+        daily = []
+        window_users = 0
+        window_dst = HyperLogLog()
+        for i, date_key in enumerate(date_keys):
+            week_users = 0
+            week_dst = HyperLogLog()
+            for d in per_day[max(0, i - 6):i + 1]:
+                week_users |= d["users"]
+                week_dst.merge(d["dst"])
+            window_users |= per_day[i]["users"]
+            window_dst.merge(per_day[i]["dst"])
+            daily.append({
+                "date": date_key,
+                "dau": _popcount(per_day[i]["users"]),
+                "wau": _popcount(week_users),
+                "destinations": per_day[i]["dst"].count(),
+                "weeklyDestinations": week_dst.count(),
+            })
+
+        mau = _popcount(window_users)
+        avg_dau = sum(d["dau"] for d in daily) / len(daily)
+        data = {
+            "ok": True,
+            "daily": daily,
+            "window": {
+                "days": days,
+                "activeUsers": mau,
+                "users": sorted(user_index.users(window_users)),
+                "avgDau": round(avg_dau, 2),
+                "stickiness": round(avg_dau / mau, 4) if mau else None,  # DAU/MAU
+                "destinations": window_dst.count(),
+            },
+            "meta": {"destinationsEstimate": "hyperloglog", "hllPrecision": HLL_PRECISION},
+        }
+        tags = [TAG_USAGE, TAG_SETTINGS] + date_tags(today, days)
+        entry = set_cached(cache_key, data, version=version, tags=tags)
+    return with_validators(cached_json_response(entry), version, CACHE_CONTROL["usage"])
+
+# ---------------------------
+# Cache warmer
+# ---------------------------
+WARMER_POLL_INTERVAL = 30  # секунд между проверками usage_dir (mtime через _usage_data_version)
+WARMER_SETTLE_SECONDS = 5  # ждём, пока коллектор допишет файлы
+WARMER_NICE = 19
+# Warmed entries live this long. WARMER_REFRESH_MARGIN before they expire the
+# warmer restarts their TTL (nothing is recomputed unless sync_usage_cache()
+# invalidated them), so the default dashboard never goes cold between collector runs
+WARMER_TTL = min(CACHE_TTL["usage"], CACHE_TTL["user_stats"])
+WARMER_REFRESH_MARGIN = 2 * WARMER_POLL_INTERVAL
+WARMER_RETRY_SECONDS = 300  # после ошибки — повтор не раньше чем через 5 минут
+
+_warmer_wakeup = threading.Event()
+_warmer_state: Dict[str, Any] = {"version": None, "runs": 0, "last_run": None, "duration_ms": None,
+                                 "error": None, "expires_at": None}
+
+def request_cache_warm() -> None:
+    """Ask the warmer to re-check usage_dir now (e.g. after a collector run)"""
+    _warmer_wakeup.set()
+
+def warm_caches(version: str) -> None:
+    """
+    Precompute what the first visitor would otherwise pay for: the default
+    usage dashboard (latest date, 7d) in daily and cumulative mode with its
+    encoded/compressed bodies, and the all-time user stats. Entries that are
+    still cached only get their TTL restarted; missing ones are built.
+    """
+    date_str = _default_usage_date()
+    modes = ("daily", "cumulative")
+    touch_cached([_usage_dashboard_key(date_str, mode, 7, "host", False) for mode in modes], CACHE_TTL["usage"])
+    touch_cached([USER_ALLTIME_STATS_KEY], CACHE_TTL["user_stats"])
+    for mode in modes:
+        entry = usage_dashboard_entry(date_str, mode, 7, version=version)
+        for encoding in [None] + COMPRESS_ENCODINGS:
+            encoded_body(entry, encoding)
+    _calculate_user_alltime_stats()
+
+def cache_warmer() -> None:
+    # Linux: setpriority on the native thread id renices only this thread
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), WARMER_NICE)
+    except (AttributeError, OSError):
+        pass
+    
+    while True:
+        # Cleared before the scan, so a request_cache_warm() arriving during it is not lost
+        _warmer_wakeup.clear()
+        version = None
+        try:
+            version = sync_usage_cache()
+            changed = version != _warmer_state["version"]
+            expires_at = _warmer_state["expires_at"]
+            expiring = expires_at is not None and time.time() >= expires_at - WARMER_REFRESH_MARGIN
+            if changed or expiring:
+                if changed:
+                    # Wait until the collector has finished writing
+                    time.sleep(WARMER_SETTLE_SECONDS)
+                    settled = sync_usage_cache()
+                    if settled != version:
+                        continue
+                started = time.time()
+                warm_caches(version)
+                _warmer_state.update({
+                    "version": version,
+                    "runs": _warmer_state["runs"] + 1,
+                    "last_run": now_utc_iso(),
+                    "duration_ms": round((time.time() - started) * 1000, 1),
+                    "error": None,
+                    "expires_at": started + WARMER_TTL,
+                })
+        except Exception as e:
+            _warmer_state["error"] = str(e)[:200]
+            try:
+                append_event({
+                    "type": "SYSTEM",
+                    "severity": "WARNING",
+                    "action": "cache_warm_failed",
+                    "message": f"Cache warmer failed: {str(e)[:200]}",
+                })
+            except Exception:
+                pass
+            _warmer_state["version"] = version
+            _warmer_state["expires_at"] = time.time() + WARMER_REFRESH_MARGIN + WARMER_RETRY_SECONDS
+        
+        _warmer_wakeup.wait(WARMER_POLL_INTERVAL)
 
 # ---------------------------
 # Main
@@ -4617,30 +7606,54 @@ def bootstrap():
     except Exception:
         pass
     
-    # Start background thread for live buffer updates (every minute)
+    # Start background thread for live sampling: high-res ring every live.sample_sec,
+    # minute ring (Stats API / access.log) once per wall-clock minute
     def live_updater():
+        def report_failure(action: str, severity: str, message: str, e: Exception) -> None:
+            # Поток не должен умирать: любая ошибка шага — событие, цикл продолжается
+            try:
+                append_event({
+                    "type": "LIVE_BUFFER",
+                    "severity": severity,
+                    "action": action,
+                    "error": type(e).__name__,
+                    "message": f"{message}: {str(e)[:200]}",
+                    "details": traceback.format_exc()[:1000]
+                })
+            except Exception:
+                pass
+
+        last_minute = None
         while True:
+            try:
+                interval = _live_sample_interval()
+            except Exception as e:
+                interval = LIVE_HIRES_RES
+                report_failure("sample_interval_failed", "WARNING", "Live sample interval unavailable", e)
+            try:
+                _sample_live_hires()
+            except Exception as e:
+                report_failure("hires_sample_failed", "WARNING", "High-res live sample failed", e)
+            minute = int(time.time() // 60)
+            if minute == last_minute:
+                time.sleep(interval - time.time() % interval)
+                continue
+            last_minute = minute
             try:
                 _update_live_buffer()
             except Exception as e:
                 # Log critical failures
-                try:
-                    append_event({
-                        "type": "LIVE_BUFFER",
-                        "severity": "ERROR",
-                        "action": "update_failed",
-                        "error": type(e).__name__,
-                        "message": f"Live buffer update crashed: {str(e)[:200]}",
-                        "details": traceback.format_exc()[:1000]
-                    })
-                except Exception:
-                    pass
-            time.sleep(60)  # Update every minute
+                report_failure("update_failed", "ERROR", "Live buffer update crashed", e)
+            try:
+                update_hourly_tier()
+            except Exception as e:
+                report_failure("hourly_update_failed", "WARNING", "Hourly usage tier update failed", e)
+            time.sleep(interval - time.time() % interval)
     
     updater_thread = threading.Thread(target=live_updater, daemon=True)
     updater_thread.start()
     
-    # Start health check monitor (every 30 seconds)
+    # Start health check monitor (every HEALTH_CHECK_INTERVAL seconds)
     def health_checker():
         import socket
         import http.client
@@ -4685,7 +7698,7 @@ def bootstrap():
                 backend_healthy = False
                 try:
                     conn = http.client.HTTPConnection('127.0.0.1', APP_PORT, timeout=2)
-                    conn.request('GET', '/api/settings')
+                    conn.request('GET', '/livez')
                     response = conn.getresponse()
                     backend_healthy = (response.status == 200)
                     conn.close()
@@ -4748,12 +7761,30 @@ def bootstrap():
             except Exception:
                 pass
             
-            time.sleep(60)  # Check every 60 seconds (оптимизировано для слабого сервера)
+            # Publish deep checks for /readyz and /api/health
+            try:
+                _refresh_health_state({
+                    "xray": service_status.get('xray', False),
+                    "frontend": service_status.get('frontend', False),
+                    "backend": service_status.get('backend', False),
+                })
+            except Exception:
+                pass
+            
+            time.sleep(HEALTH_CHECK_INTERVAL)
     
     health_thread = threading.Thread(target=health_checker, daemon=True)
     health_thread.start()
+    
+    # Precompute default dashboards whenever collector output changes
+    warmer_thread = threading.Thread(target=cache_warmer, name="cache-warmer", daemon=True)
+    warmer_thread.start()
 
-bootstrap()
+# XRAY_REPORT_UI_NO_BOOTSTRAP=1: import without background threads and shutdown
+# hooks (benchmarks, one-off scripts)
+NO_BOOTSTRAP = bool(os.environ.get("XRAY_REPORT_UI_NO_BOOTSTRAP"))
+if not NO_BOOTSTRAP:
+    bootstrap()
 
 # Shutdown handler
 import atexit
@@ -4774,7 +7805,8 @@ def shutdown_handler():
     except Exception:
         pass
 
-atexit.register(shutdown_handler)
+if not NO_BOOTSTRAP:
+    atexit.register(shutdown_handler)
 
 def signal_handler(signum, frame):
     """Handle termination signals"""
@@ -4790,8 +7822,9 @@ def signal_handler(signum, frame):
     import sys
     sys.exit(0)
 
-signal.signal(signal.SIGTERM, signal_handler)
-signal.signal(signal.SIGINT, signal_handler)
+if not NO_BOOTSTRAP:
+    signal.signal(signal.SIGTERM, signal_handler)
+    signal.signal(signal.SIGINT, signal_handler)
 
 if __name__ == "__main__":
     app.run(host=APP_HOST, port=APP_PORT, debug=False)
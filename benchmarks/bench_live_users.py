@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Memory and speed of the per-user live columns (LiveUserColumns in app.py).
+
+Fills a full 24h ring (1440 minutes) for N users, a share of whom is active in
+any given minute, the same way _update_live_buffer does: every minute a new
+copy-on-write snapshot with that minute appended and the window trimmed.
+Then measures one user's series and the top-users totals.
+
+Usage:
+    python benchmarks/bench_live_users.py                 # 500 users, every user active every minute
+    python benchmarks/bench_live_users.py --active 0.2    # 20% active per minute
+    python benchmarks/bench_live_users.py --json          # machine-readable
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+os.environ.setdefault("XRAY_REPORT_UI_NO_BOOTSTRAP", "1")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import app  # noqa: E402
+
+
+def run(users: int, minutes: int, active: float, seed: int) -> dict:
+    rng = random.Random(seed)
+    names = [f"user_{i:04d}@bench" for i in range(users)]
+    start_ts = (int(time.time()) // 60 - minutes) * 60
+
+    tracemalloc.start()
+    base, _ = tracemalloc.get_traced_memory()
+    columns = app.LiveUserColumns()
+    append_s = 0.0
+    for m in range(minutes):
+        ts = start_ts + m * 60
+        online = [n for n in names if rng.random() < active]
+        traffic = {n: rng.randint(1, 50_000_000) for n in online}
+        conns = {n: rng.randint(1, 300) for n in online}
+        t0 = time.perf_counter()
+        columns = columns.appended(ts, traffic, conns, ts - app.LIVE_BUFFER_SIZE * 60 + 60)
+        append_s += time.perf_counter() - t0
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    t0 = time.perf_counter()
+    series = columns.series(names[0], start_ts)
+    series_ms = (time.perf_counter() - t0) * 1000
+    t0 = time.perf_counter()
+    totals = columns.totals("traffic", start_ts)
+    totals_ms = (time.perf_counter() - t0) * 1000
+
+    active_points = sum(len(c.minutes) for c in columns.columns.values())
+    return {
+        "users": users,
+        "minutes": minutes,
+        "active_share": active,
+        "active_user_minutes": active_points,
+        "memory_bytes": columns.memory_bytes(),
+        "traced_bytes": current - base,
+        "traced_peak_bytes": peak - base,
+        "bytes_per_active_user_minute": round(columns.memory_bytes() / max(1, active_points), 2),
+        "append_ms_per_minute": round(append_s * 1000 / minutes, 3),
+        "series_one_user_ms": round(series_ms, 3),
+        "series_points": len(series),
+        "totals_all_users_ms": round(totals_ms, 3),
+        "totals_users": len(totals),
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--minutes", type=int, default=app.LIVE_BUFFER_SIZE)
+    parser.add_argument("--active", type=float, default=1.0, help="share of users active per minute")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+
+    result = run(args.users, args.minutes, args.active, args.seed)
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        for key, value in result.items():
+            print(f"{key:32} {value}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
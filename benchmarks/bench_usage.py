@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+"""
+Timing of the usage aggregation pipeline on synthetic CSVs.
+
+Generates usage_*, conns_*, report_* and domains_*.csv the way the collector
+writes them (users × days × destinations, skewed destination popularity),
+then times the heavy loaders of app.py:
+
+    load_usage_dashboard, load_dashboard_data,
+    _calculate_user_alltime_stats, load_usage_data
+
+Every function runs in its own process against its own DATA_DIR, so nothing
+is shared between them:
+    cold     first call: no parsed-CSV cache on disk, no domain index, empty memory cache
+    restart  memory cache dropped, on-disk caches kept (what a service restart sees)
+    warm     repeated calls with everything cached (median of --repeat)
+plus peak RSS of that process.
+
+Usage:
+    python benchmarks/bench_usage.py                               # 50 users × 31 days × 2000 destinations
+    python benchmarks/bench_usage.py --users 500 --days 90 --destinations 20000
+    python benchmarks/bench_usage.py --out before.json             # machine-readable results
+    python benchmarks/bench_usage.py --out after.json --compare before.json
+"""
+import argparse
+import datetime as dt
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("XRAY_REPORT_UI_NO_BOOTSTRAP", "1")
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+FUNCTIONS = ("load_usage_dashboard", "load_dashboard_data", "_calculate_user_alltime_stats", "load_usage_data")
+REGRESSION_RATIO = 1.2  # --compare помечает то, что стало медленнее на 20%+
+
+
+# ---------------------------
+# Synthetic data
+# ---------------------------
+
+def generate(base: str, users: int, days: int, destinations: int, per_user: int, seed: int) -> dict:
+    """Write <base>/usage/*.csv and <base>/config.json (Xray clients); returns counts"""
+    rng = random.Random(seed)
+    usage_dir = os.path.join(base, "usage")
+    os.makedirs(usage_dir, exist_ok=True)
+    emails = [f"user_{i:04d}@bench" for i in range(users)]
+    # half IPs (resolved through domains_*.csv), half hostnames straight from sniffing
+    n_ips = destinations // 2
+    ips = [f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}" for i in range(n_ips)]
+    hosts = [f"h{i}.cdn{i % 97}.example{i % 13}.com" for i in range(destinations - n_ips)]
+    pool = ips + hosts
+    rng.shuffle(pool)
+    # Zipf-like popularity: a few destinations get most of the connections
+    cum, acc = [], 0.0
+    for rank in range(len(pool)):
+        acc += 1.0 / (rank + 1)
+        cum.append(acc)
+
+    today = dt.datetime.utcnow().date()
+    rows = {"usage": 0, "conns": 0, "report": 0, "domains": 0}
+    for k in range(days, 0, -1):
+        day = (today - dt.timedelta(days=k)).isoformat()
+        usage, conns, report = [], [], []
+        for email in emails:
+            up, down = rng.randint(10**5, 10**8), rng.randint(10**6, 10**9)
+            usage.append(f"{email},{up},{down},{up + down}\n")
+            dsts = set(rng.choices(pool, cum_weights=cum, k=per_user))
+            counts = {d: rng.randint(1, 200) for d in dsts}
+            total_conns = sum(counts.values())
+            for dst, c in counts.items():
+                conns.append(f"{email},{dst},{c}\n")
+                report.append(f"{email},{dst},{(up + down) * c // total_conns}\n")
+        domains = [f"{ip},svc{i % 500}.example{i % 13}.net\n" for i, ip in enumerate(ips) if rng.random() < 0.5]
+        for kind, header, lines in (
+            ("usage", "user,uplink_bytes,downlink_bytes,total_bytes\n", usage),
+            ("conns", "user,dst,conn_count\n", conns),
+            ("report", "user,dst,traffic_bytes\n", report),
+            ("domains", "dst,domain\n", domains),
+        ):
+            with open(os.path.join(usage_dir, f"{kind}_{day}.csv"), "w", encoding="utf-8") as f:
+                f.write(header)
+                f.writelines(lines)
+            rows[kind] += len(lines)
+
+    config = {"inbounds": [{"protocol": "vless", "tag": "bench",
+                            "settings": {"clients": [{"id": f"00000000-0000-0000-0000-{i:012d}", "email": e}
+                                                     for i, e in enumerate(emails)]}}]}
+    with open(os.path.join(base, "config.json"), "w", encoding="utf-8") as f:
+        json.dump(config, f)
+    size = sum(os.path.getsize(os.path.join(usage_dir, n)) for n in os.listdir(usage_dir))
+    return {"rows": rows, "bytes": size}
+
+
+# ---------------------------
+# Worker (one function, fresh process)
+# ---------------------------
+
+def _isolate(app, base: str) -> None:
+    """Point every DATA_DIR path of app at base/data and the collector at base/usage"""
+    data_dir = os.path.join(base, "data")
+    shutil.rmtree(data_dir, ignore_errors=True)
+    app.DATA_DIR = data_dir
+    app.BACKUPS_DIR = os.path.join(data_dir, "backups")
+    app.SETTINGS_PATH = os.path.join(data_dir, "settings.json")
+    app.EVENTS_PATH = os.path.join(data_dir, "events.log")
+    app.LIVE_STATE_PATH = os.path.join(data_dir, "usage_live.json")
+    app.LIVE_STATE_OFFSET_PATH = os.path.join(data_dir, "usage_state.json")
+    app.DOMAINS_INDEX_PATH = os.path.join(data_dir, "domains_index.json")
+    app.METRICS_DB_PATH = os.path.join(data_dir, "metrics.db")
+    app.LIVE_USER_IDS_PATH = os.path.join(data_dir, "live_user_ids.json")
+    app.PARSED_CACHE_DIR = os.path.join(data_dir, "parsed_cache")
+    app.PROFILES_DIR = os.path.join(data_dir, "profiles")
+    app._domain_index = app.DomainIndex(app.DOMAINS_INDEX_PATH)
+    app.user_index = app.UserIndex(app.LIVE_USER_IDS_PATH)
+    app.save_settings({
+        "collector": {"usage_dir": os.path.join(base, "usage")},
+        "xray": {"config_path": os.path.join(base, "config.json"), "stats_api_enabled": False},
+    })
+
+
+def _peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def worker(name: str, base: str, window: int, repeat: int) -> dict:
+    sys.path.insert(0, ROOT)
+    import app  # noqa: E402
+
+    _isolate(app, base)
+    today = dt.datetime.utcnow().date().isoformat()
+    calls = {
+        "load_usage_dashboard": lambda: app.load_usage_dashboard(today, "daily", window),
+        "load_dashboard_data": lambda: app.load_dashboard_data(window),
+        "_calculate_user_alltime_stats": app._calculate_user_alltime_stats,
+        "load_usage_data": lambda: app.load_usage_data(window),
+    }
+    call = calls[name]
+
+    def timed() -> float:
+        t0 = time.perf_counter()
+        call()
+        return (time.perf_counter() - t0) * 1000
+
+    rss_before = _peak_rss_mb()
+    cold = timed()
+    app.clear_cache()
+    app._domain_index = app.DomainIndex(app.DOMAINS_INDEX_PATH)  # как после рестарта: индекс с диска
+    restart = timed()
+    warm = [timed() for _ in range(repeat)]
+    return {
+        "cold_ms": round(cold, 2),
+        "restart_ms": round(restart, 2),
+        "warm_ms": round(statistics.median(warm), 3),
+        "warm_min_ms": round(min(warm), 3),
+        "peak_rss_mb": _peak_rss_mb(),
+        "rss_growth_mb": round(_peak_rss_mb() - rss_before, 1),
+    }
+
+
+# ---------------------------
+# Driver
+# ---------------------------
+
+def _git_commit() -> str:
+    try:
+        out = subprocess.run(["git", "-C", ROOT, "rev-parse", "--short", "HEAD"],
+                             capture_output=True, text=True, timeout=5)
+        dirty = subprocess.run(["git", "-C", ROOT, "status", "--porcelain", "--untracked-files=no"],
+                               capture_output=True, text=True, timeout=5)
+        return out.stdout.strip() + ("-dirty" if dirty.stdout.strip() else "")
+    except (OSError, subprocess.SubprocessError):
+        return ""
+
+
+def run(args: argparse.Namespace) -> dict:
+    base = args.data_dir or tempfile.mkdtemp(prefix="bench_usage_")
+    try:
+        t0 = time.perf_counter()
+        dataset = generate(base, args.users, args.days, args.destinations, args.per_user, args.seed)
+        dataset["generate_s"] = round(time.perf_counter() - t0, 2)
+        results = {}
+        for name in args.only or FUNCTIONS:
+            proc = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--worker", name, "--data-dir", base,
+                 "--window", str(args.window), "--repeat", str(args.repeat)],
+                capture_output=True, text=True,
+            )
+            if proc.returncode != 0:
+                raise RuntimeError(f"{name} failed:\n{proc.stderr}")
+            results[name] = json.loads(proc.stdout.strip().splitlines()[-1])
+    finally:
+        if not args.data_dir and not args.keep:
+            shutil.rmtree(base, ignore_errors=True)
+    return {
+        "meta": {
+            "commit": _git_commit(),
+            "generated_at": dt.datetime.utcnow().replace(microsecond=0).isoformat() + "Z",
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "scale": {"users": args.users, "days": args.days, "destinations": args.destinations,
+                  "per_user": args.per_user, "seed": args.seed, "window": args.window, "repeat": args.repeat},
+        "dataset": dataset,
+        "results": results,
+    }
+
+
+def print_table(result: dict, base: dict = None) -> None:
+    cols = ("cold_ms", "restart_ms", "warm_ms", "peak_rss_mb")
+    print(f"{'function':32}" + "".join(f"{c:>14}" for c in cols))
+    for name, row in result["results"].items():
+        line = f"{name:32}"
+        for c in cols:
+            line += f"{row[c]:>14}"
+        print(line)
+        old = (base or {}).get("results", {}).get(name)
+        if old:
+            line = f"{'  vs ' + base['meta'].get('commit', 'base'):32}"
+            for c in cols:
+                ratio = row[c] / old[c] if old.get(c) else 0.0
+                mark = " !" if ratio >= REGRESSION_RATIO else "  "
+                line += f"{f'x{ratio:.2f}' + mark:>14}"
+            print(line)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--days", type=int, default=31)
+    parser.add_argument("--destinations", type=int, default=2000, help="size of the destination pool")
+    parser.add_argument("--per-user", type=int, default=40, help="destinations per user per day (drawn, before dedup)")
+    parser.add_argument("--window", type=int, default=7, help="days argument of the loaders")
+    parser.add_argument("--repeat", type=int, default=20, help="warm calls (median is reported)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--only", action="append", choices=FUNCTIONS, help="benchmark only this function (repeatable)")
+    parser.add_argument("--data-dir", help="generate into this directory and keep it (default: temp dir)")
+    parser.add_argument("--keep", action="store_true", help="keep the temp directory")
+    parser.add_argument("--out", help="write results as JSON to this file")
+    parser.add_argument("--compare", help="results JSON of a previous run to compare with")
+    parser.add_argument("--json", action="store_true", help="print results as JSON instead of a table")
+    parser.add_argument("--worker", choices=FUNCTIONS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(worker(args.worker, args.data_dir, args.window, args.repeat)))
+        return 0
+
+    result = run(args)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+    base = None
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            base = json.load(f)
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print_table(result, base)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
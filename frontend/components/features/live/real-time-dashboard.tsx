@@ -46,7 +46,7 @@ export function RealTimeDashboard() {
   const [paused, setPaused] = useState(false);
   const [loading, setLoading] = useState(true);
   const [selectedMetric, setSelectedMetric] = useState<'traffic' | 'connections' | 'online'>('connections');
-  const [timeRange, setTimeRange] = useState<'1h' | '6h' | '24h'>('1h');
+  const [timeRange, setTimeRange] = useState<'1h' | '6h' | '24h' | '7d' | '30d'>('1h');
   const { lang } = useAppStore();
   const tr = useTr();
 
@@ -87,9 +87,12 @@ export function RealTimeDashboard() {
   // Load chart data for all metrics
   const loadChartData = useCallback(async () => {
     try {
-      const periodMap = { '1h': '3600', '6h': '21600', '24h': '86400' };
+      const periodMap = { '1h': '3600', '6h': '21600', '24h': '86400', '7d': '604800', '30d': '2592000' };
+      // 1h: 10s points for conns/online (traffic comes back per minute)
+      const granMap = { '1h': '10', '6h': '300', '24h': '600', '7d': '3600', '30d': '21600' };
       const period = periodMap[timeRange];
-      const gran = timeRange === '1h' ? '60' : timeRange === '6h' ? '300' : '600';
+      const gran = granMap[timeRange];
+      const multiDay = timeRange === '7d' || timeRange === '30d';
 
       // Load all three metrics in parallel
       const [trafficRes, connsRes, onlineRes] = await Promise.all([
@@ -102,10 +105,18 @@ export function RealTimeDashboard() {
         return (series || []).map((point: any) => {
           const timestamp = new Date(point.ts);
           return {
-            x: timestamp.toLocaleTimeString(lang === 'ru' ? 'ru-RU' : 'en-US', {
-              hour: '2-digit',
-              minute: '2-digit',
-            }),
+            x: multiDay
+              ? timestamp.toLocaleString(lang === 'ru' ? 'ru-RU' : 'en-US', {
+                  day: '2-digit',
+                  month: '2-digit',
+                  hour: '2-digit',
+                  minute: '2-digit',
+                })
+              : timestamp.toLocaleTimeString(lang === 'ru' ? 'ru-RU' : 'en-US', {
+                  hour: '2-digit',
+                  minute: '2-digit',
+                  ...(timeRange === '1h' ? { second: '2-digit' as const } : {}),
+                }),
             y: (point.value || 0) / divider,
           };
         });
@@ -320,6 +331,22 @@ export function RealTimeDashboard() {
               >
                 24h
               </Button>
+              <Button
+                variant={timeRange === '7d' ? 'default' : 'ghost'}
+                size="sm"
+                onClick={() => setTimeRange('7d')}
+                className="h-7 text-xs px-2"
+              >
+                7d
+              </Button>
+              <Button
+                variant={timeRange === '30d' ? 'default' : 'ghost'}
+                size="sm"
+                onClick={() => setTimeRange('30d')}
+                className="h-7 text-xs px-2"
+              >
+                30d
+              </Button>
             </div>
 
             {/* Pause/Play */}
@@ -157,27 +157,39 @@ export function CollectorSettings() {
       setRunning(true);
       setRunOutput(null);
       
-      const response = await apiClient.runCollector(includeToday);
+      const started = await apiClient.runCollector(includeToday);
       
-      setRunOutput(response.data.output);
+      // Scripts run as a background job - poll until it has finished
+      let job = started.data.job;
+      while (!job.finished) {
+        await new Promise((resolve) => setTimeout(resolve, 1000));
+        job = (await apiClient.getCollectorJob(started.data.job_id || job.id)).data.job;
+        setRunOutput(
+          job.scripts
+            .map((s) => `${s.name}: ${s.status}${s.duration_ms != null ? ` (${(s.duration_ms / 1000).toFixed(1)}s)` : ''}`)
+            .join('\n')
+        );
+      }
+      
+      setRunOutput(job.output || null);
       
-      const scriptsRun = response.data.scripts_run || 0;
+      const scriptsRun = job.scripts_run || 0;
       
-      if (response.data.success) {
+      if (job.success) {
         toast.success(
           lang === 'ru' 
             ? `✓ Выполнено ${scriptsRun} скриптов${includeToday ? ' (за сегодня)' : ''}` 
             : `✓ Ran ${scriptsRun} scripts${includeToday ? ' (for today)' : ''}`,
           {
-            description: response.data.message,
+            description: job.message,
             duration: 4000,
           }
         );
       } else {
         toast.error(
           lang === 'ru' 
-            ? `Ошибка выполнения (код ${response.data.return_code})` 
-            : `Execution failed (code ${response.data.return_code})`
+            ? `Ошибка выполнения (код ${job.return_code ?? 1})` 
+            : `Execution failed (code ${job.return_code ?? 1})`
         );
       }
       
@@ -14,6 +14,9 @@ import type {
   LiveSeriesResponse,
   LiveTopResponse,
   UsageDashboardResponse,
+  UsageUserDetailResponse,
+  UsageHeatmapResponse,
+  ActiveUsersResponse,
   EventsStatsResponse,
   CollectorStatus,
   XrayConfig,
@@ -25,7 +28,7 @@ import type {
   BackupRestorePreview,
   BackupRestoreResult,
   CollectorToggleResponse,
-  CollectorRunResponse,
+  CollectorJobResponse,
   VersionResponse,
 } from '@/types';
 
@@ -74,7 +77,7 @@ export const apiClient = {
     api.post<ApiResponse>('/users/update-alias', { uuid, alias }),
 
   // Dashboard
-  getDashboard: (params?: { days?: number; user_filter?: string }) => 
+  getDashboard: (params?: { days?: number; user_filter?: string; group?: 'host' | 'etld1' }) => 
     api.get<DashboardApiResponse>('/dashboard', { params }),
 
   // Usage dates
@@ -84,7 +87,26 @@ export const apiClient = {
     date?: string;
     mode?: 'daily' | 'cumulative';
     window_days?: number;
-  }) => api.get<UsageDashboardResponse>('/usage/dashboard', { params }),
+    details?: boolean;
+    group?: 'host' | 'etld1';
+  }) => api.get<UsageDashboardResponse>('/usage/dashboard', {
+    params: { ...params, details: params.details ? 1 : undefined },
+  }),
+
+  getUsageUserDetail: (userId: string, params?: {
+    date?: string;
+    mode?: 'daily' | 'cumulative';
+    window_days?: number;
+    group?: 'host' | 'etld1';
+  }) => api.get<UsageUserDetailResponse>(`/usage/user/${encodeURIComponent(userId)}`, { params }),
+
+  getUsageHeatmap: (params?: {
+    metric?: 'traffic' | 'conns';
+    days?: 30 | 60 | 90;
+  }) => api.get<UsageHeatmapResponse>('/usage/heatmap', { params }),
+
+  getActiveUsers: (params?: { days?: number }) =>
+    api.get<ActiveUsersResponse>('/usage/active-users', { params }),
 
   // Online/Live
   // Note: getOnlineData() removed - endpoint /api/online doesn't exist
@@ -152,7 +174,10 @@ export const apiClient = {
     api.post<CollectorToggleResponse>('/collector/toggle', { enabled, script }),
   
   runCollector: (includeToday: boolean = false) =>
-    api.post<CollectorRunResponse>('/collector/run', { include_today: includeToday }),
+    api.post<CollectorJobResponse>('/collector/run', { include_today: includeToday }),
+  
+  getCollectorJob: (jobId: string) =>
+    api.get<CollectorJobResponse>(`/collector/jobs/${jobId}`),
   
   updateCronSchedule: (script: string, schedule: string) =>
     api.post<ApiResponse>('/collector/update-schedule', { script, schedule }),
@@ -21,6 +21,7 @@ export interface UserStats {
     domain: string;
     trafficBytes: number;
   }>;
+  topDomainsApproximate?: boolean; // top3Domains are lower bounds (top-K sketch pruned)
 }
 
 export type UserFilter = 'all' | 'active' | 'low-activity' | 'online';
@@ -50,6 +51,12 @@ export interface Settings {
     usage_dir: string;
     enabled: boolean;
   };
+  live?: {
+    sample_sec: number; // 5..60, high-res (10s) ring sampling interval
+  };
+  perf?: {
+    slow_request_ms: number; // > 0: slower requests are logged as PERFORMANCE/slow_request events
+  };
 }
 
 // ==================== DASHBOARD TYPES ====================
@@ -283,7 +290,9 @@ export interface LiveSeriesResponse {
     metric: string;
     period: number;
     gran: number;
-    scope: string;
+    scope: string; // 'global' | `user:${email}`
+    tier?: 'hires' | 'ring' | 'live_5m' | 'live_1h';
+    user?: string | null;
   };
 }
 
@@ -317,8 +326,71 @@ export interface UsageDashboardResponse {
     top_domains_conns?: Array<{ domain: string; value: number }>;
   };
   users?: Record<string, any>;
+  userDetails?: Record<string, any>;
   meta?: {
     days?: string[];
+    topDomainsApproximate?: boolean; // top_domains_* values are lower bounds
+  };
+}
+
+export interface UsageUserDetailResponse {
+  ok: boolean;
+  meta: {
+    date: string;
+    mode: 'daily' | 'cumulative';
+    windowDays: number;
+    groupBy: 'host' | 'etld1';
+    userId: string;
+    displayName: string;
+    generatedAt: string;
+  };
+  trafficTrendDailyBytes: Array<{ date: string; value: number }>;
+  connsTrendDaily: Array<{ date: string; value: number }>;
+  topDomainsTraffic: Array<{ domain: string; trafficBytes: number; sharePct: number }>;
+  topDomainsConns: Array<{ domain: string; conns: number; sharePct: number }>;
+  topDomainsApproximate?: boolean;
+}
+
+export interface UsageHeatmapResponse {
+  ok: boolean;
+  meta: {
+    metric: 'traffic' | 'conns';
+    days: 30 | 60 | 90;
+    from: string;
+    to: string;
+    timezone: string;
+    generatedAt: string;
+  };
+  cells: number[][]; // [weekday 0=Mon][hour 0..23], sum over the window
+  avg: number[][];
+  hoursWithData: number[][];
+  total: number;
+  max: number;
+  unit: 'bytes' | 'log_lines';
+}
+
+export interface ActiveUsersDay {
+  date: string;
+  dau: number;
+  wau: number; // distinct users over the 7 days ending at date
+  destinations: number; // HyperLogLog estimate
+  weeklyDestinations: number;
+}
+
+export interface ActiveUsersResponse {
+  ok: boolean;
+  daily: ActiveUsersDay[];
+  window: {
+    days: number;
+    activeUsers: number;
+    users: string[];
+    avgDau: number;
+    stickiness: number | null; // avg DAU / window active users
+    destinations: number;
+  };
+  meta: {
+    destinationsEstimate: 'hyperloglog';
+    hllPrecision: number;
   };
 }
 
@@ -486,6 +558,40 @@ export interface CollectorRunResponse {
   message: string;
 }
 
+export type CollectorJobStatus = 'queued' | 'running' | 'success' | 'partial' | 'error';
+
+export interface CollectorJobScript {
+  name: string;
+  path: string;
+  status: 'queued' | 'running' | 'success' | 'failed' | 'timeout' | 'error';
+  started_at: string | null;
+  finished_at: string | null;
+  duration_ms: number | null;
+  return_code: number | null;
+  output_bytes: number;
+}
+
+export interface CollectorJob extends Partial<CollectorRunResponse> {
+  id: string;
+  status: CollectorJobStatus;
+  finished: boolean;
+  seq: number;
+  created_at: string;
+  finished_at?: string;
+  duration_ms?: number;
+  label_date: string;
+  include_today: boolean;
+  parallelism: number;
+  scripts: CollectorJobScript[];
+}
+
+export interface CollectorJobResponse {
+  ok: boolean;
+  job_id?: string;
+  already_running?: boolean;
+  job: CollectorJob;
+}
+
 export interface VersionResponse {
   version: string;
   name: string;
@@ -0,0 +1,465 @@
+#!/usr/bin/env python3
+"""
+Built-in usage collector (replaces xray_daily_usage.sh / xray_daily_conns.sh /
+xray_daily_report.sh).
+
+One streaming pass over access.log, resumed from the last byte offset (the first
+run only records the current end), plus one Xray Stats API snapshot. Writes all CSV families into usage_dir, in the same
+formats as before:
+    usage_<date>.csv    user,uplink_bytes,downlink_bytes,total_bytes
+    conns_<date>.csv    user,dst,conn_count
+    report_<date>.csv   user,dst,traffic_bytes
+    domains_<date>.csv  dst,domain
+
+Intra-day runs are incremental. Data of a day that is not over yet (today) is
+appended to usage_<date>.partial in hourly buckets instead of rewriting the
+CSVs:
+    usage_<date>.partial  hour,user,dst,uplink_bytes,downlink_bytes,conn_count,domain
+    (traffic rows have no dst, connection rows have conn_count, DNS rows have domain)
+Once the day is over the next run folds the partial into the CSVs and removes
+it. Stats API deltas since the previous run are added to the label date.
+
+Usage (cron or POST /api/collector/run):
+    xray_collector.py            # label date = yesterday (LABEL_DATE env overrides)
+    xray_collector.py --today    # label date = today, e.g. hourly cron
+"""
+import csv
+import datetime as dt
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+from typing import Any, Dict, List, Optional, Tuple
+
+DATA_DIR = "/opt/xray-report-ui/data"
+SETTINGS_PATH = os.path.join(DATA_DIR, "settings.json")
+STATE_PATH = os.path.join(DATA_DIR, "usage_state.json")
+USAGE_DIR = "/var/log/xray/usage"
+ACCESS_LOG = os.environ.get("XRAY_ACCESS_LOG", "/var/log/xray/access.log")
+STATS_API_ADDRESS = "127.0.0.1:10085"
+
+STATE_KEEP_DAYS = 62  # how long to remember which days this collector owns
+
+# DNS answers in the access log: "... got answer: example.com. TypeA -> [1.2.3.4 5.6.7.8] 12ms"
+DNS_RE = re.compile(r"\s(?P<domain>[A-Za-z0-9][A-Za-z0-9._-]*?)\.?\s+(?:Type\w+\s+)?->\s*\[(?P<ips>[^\]]*)\]")
+DATE_RE = re.compile(r"^(\d{4})[/-](\d{2})[/-](\d{2})\s")
+
+
+def load_settings() -> Dict[str, Any]:
+    try:
+        with open(SETTINGS_PATH, "r", encoding="utf-8") as f:
+            s = json.load(f)
+        return s if isinstance(s, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+
+def load_state() -> Dict[str, Any]:
+    try:
+        with open(STATE_PATH, "r", encoding="utf-8") as f:
+            state = json.load(f)
+        if isinstance(state, dict):
+            return state
+    except (OSError, ValueError):
+        pass
+    return {}
+
+
+def atomic_write(path: str, write) -> None:
+    d = os.path.dirname(path) or "."
+    os.makedirs(d, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(prefix=".tmp_", dir=d)
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8", newline="") as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def save_state(state: Dict[str, Any]) -> None:
+    atomic_write(STATE_PATH, lambda f: json.dump(state, f, ensure_ascii=False, indent=2))
+
+
+def to_int(value: str) -> int:
+    try:
+        return int(float(value or 0))
+    except ValueError:
+        return 0
+
+
+# ---------------------------
+# access.log
+# ---------------------------
+
+def split_dst(token: str) -> str:
+    """"tcp:example.com:443" / "udp:[2001:db8::1]:53" -> host"""
+    if token.startswith(("tcp:", "udp:")):
+        token = token[4:]
+    if token.startswith("["):
+        return token[1:token.find("]")] if "]" in token else token[1:]
+    host, sep, port = token.rpartition(":")
+    return host if sep and port.isdigit() else token
+
+
+def parse_line(line: str, conns: Dict[str, Dict[Tuple[str, str, int], int]],
+               domains: Dict[str, Dict[str, str]]) -> None:
+    m = DATE_RE.match(line)
+    if not m:
+        return
+    day = f"{m.group(1)}-{m.group(2)}-{m.group(3)}"
+    hour = to_int(line[11:13])
+
+    pos = line.find(" accepted ")
+    if pos != -1:
+        epos = line.find("email:", pos)
+        if epos == -1:
+            return
+        email = line[epos + 6:].strip().split(" ", 1)[0]
+        rest = line[pos + 10:].lstrip()
+        dst = split_dst(rest.split(" ", 1)[0]) if rest else ""
+        if email and dst:
+            day_conns = conns.setdefault(day, {})
+            key = (sys.intern(email), sys.intern(dst), hour)
+            day_conns[key] = day_conns.get(key, 0) + 1
+        return
+
+    if "->" in line:
+        dm = DNS_RE.search(line)
+        if dm:
+            domain = dm.group("domain").lower()
+            day_domains = domains.setdefault(day, {})
+            for ip in re.split(r"[\s,]+", dm.group("ips").strip()):
+                if ip:
+                    day_domains[ip] = domain
+
+
+def read_log_from(path: str, offset: int, conns, domains) -> Tuple[int, int]:
+    """Parse complete lines from offset; returns (new offset, lines parsed)"""
+    lines = 0
+    with open(path, "rb") as f:
+        f.seek(offset)
+        for raw in f:
+            if not raw.endswith(b"\n"):
+                break  # line still being written, pick it up next run
+            offset += len(raw)
+            lines += 1
+            parse_line(raw.decode("utf-8", "replace"), conns, domains)
+    return offset, lines
+
+
+def last_line_end(path: str, size: int) -> int:
+    """Offset just after the last complete line within the first size bytes"""
+    with open(path, "rb") as f:
+        pos = size
+        while pos > 0:
+            start = max(0, pos - 65536)
+            f.seek(start)
+            nl = f.read(pos - start).rfind(b"\n")
+            if nl >= 0:
+                return start + nl + 1
+            pos = start
+    return 0
+
+
+def scan_access_log(state: Dict[str, Any], conns, domains) -> int:
+    """One pass over new access.log data (handles rotation and truncation)"""
+    try:
+        st = os.stat(ACCESS_LOG)
+    except OSError:
+        print(f"WARNING: access log not found: {ACCESS_LOG}")
+        return 0
+
+    ck = state.get("access_log") or {}
+    if not ck:
+        # First run: checkpoint at the current end, like the live sampler. Parsing a
+        # multi-GB log from 0 would outlast the job timeout before save_state() runs,
+        # and every later run would start over. Days before it come from the old scripts.
+        offset = last_line_end(ACCESS_LOG, st.st_size)
+        state["access_log"] = {"path": ACCESS_LOG, "inode": st.st_ino, "offset": offset}
+        print(f"INFO: no access.log checkpoint, starting at the current end ({offset} bytes skipped)")
+        return 0
+    offset = int(ck.get("offset", 0))
+    lines = 0
+    if ck.get("inode") and ck.get("inode") != st.st_ino:
+        # Rotated: finish the previous file first if it is still around
+        for rotated in (ACCESS_LOG + ".1",):
+            try:
+                if os.stat(rotated).st_ino == ck["inode"]:
+                    _, n = read_log_from(rotated, offset, conns, domains)
+                    lines += n
+            except OSError:
+                pass
+        offset = 0
+    elif st.st_size < offset:
+        offset = 0  # truncated (copytruncate)
+
+    offset, n = read_log_from(ACCESS_LOG, offset, conns, domains)
+    state["access_log"] = {"path": ACCESS_LOG, "inode": st.st_ino, "offset": offset}
+    return lines + n
+
+
+# ---------------------------
+# Stats API
+# ---------------------------
+
+def query_stats(settings: Dict[str, Any]) -> Optional[Dict[str, List[int]]]:
+    """{email: [uplink, downlink]} counters from `xray api statsquery`, None if unavailable"""
+    xray = settings.get("xray", {})
+    if not xray.get("stats_api_enabled", True):
+        return None
+    address = xray.get("stats_api_address", STATS_API_ADDRESS)
+    try:
+        cp = subprocess.run(["xray", "api", "statsquery", "-s", address],
+                            capture_output=True, text=True, timeout=10)
+        if cp.returncode != 0 or not cp.stdout.strip():
+            return None
+        data = json.loads(cp.stdout)
+    except (OSError, subprocess.TimeoutExpired, ValueError):
+        return None
+
+    users: Dict[str, List[int]] = {}
+    for stat in data.get("stat", []):
+        parts = stat.get("name", "").split(">>>")
+        if len(parts) >= 4 and parts[0] == "user" and parts[2] == "traffic":
+            counters = users.setdefault(parts[1], [0, 0])
+            counters[0 if parts[3] == "uplink" else 1] = int(stat.get("value", 0) or 0)
+    return users
+
+
+def stats_delta(state: Dict[str, Any], current: Dict[str, List[int]]) -> Dict[str, List[int]]:
+    """
+    Traffic since the previous snapshot (a counter that went down means Xray restarted).
+    The first run only records the baseline: the counters hold everything since
+    Xray started, which must not land in a single day.
+    """
+    if "stats" not in state:
+        state["stats"] = current
+        return {}
+    prev = state["stats"] or {}
+    delta = {}
+    for email, (up, down) in current.items():
+        p_up, p_down = (prev.get(email) or [0, 0])[:2]
+        d_up = up - p_up if up >= p_up else up
+        d_down = down - p_down if down >= p_down else down
+        if d_up or d_down:
+            delta[email] = [d_up, d_down]
+    state["stats"] = current
+    return delta
+
+
+# ---------------------------
+# CSV output
+# ---------------------------
+
+def read_rows(path: str) -> List[Dict[str, str]]:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return [{(k or "").strip().lower(): (v or "").strip() for k, v in row.items()}
+                    for row in csv.DictReader(f)]
+    except OSError:
+        return []
+
+
+def write_csv(path: str, header: List[str], rows) -> None:
+    def write(f):
+        w = csv.writer(f, lineterminator="\n")
+        w.writerow(header)
+        w.writerows(rows)
+    atomic_write(path, write)
+
+
+def write_day(usage_dir: str, day: str, owned: bool, conns: Dict[Tuple[str, str], int],
+              domains: Dict[str, str], usage: Dict[str, List[int]]) -> None:
+    """Merge new data into the CSVs of one day (existing files only if this collector wrote them)"""
+    p_usage = os.path.join(usage_dir, f"usage_{day}.csv")
+    p_conns = os.path.join(usage_dir, f"conns_{day}.csv")
+    p_report = os.path.join(usage_dir, f"report_{day}.csv")
+    p_domains = os.path.join(usage_dir, f"domains_{day}.csv")
+
+    all_conns: Dict[Tuple[str, str], int] = {}
+    all_domains: Dict[str, str] = {}
+    all_usage: Dict[str, List[int]] = {}
+    if owned:
+        for row in read_rows(p_conns):
+            key = (row.get("user", ""), row.get("dst", ""))
+            all_conns[key] = all_conns.get(key, 0) + to_int(row.get("conn_count"))
+        for row in read_rows(p_domains):
+            ip = row.get("dst") or row.get("ip") or ""
+            if ip and row.get("domain"):
+                all_domains[ip] = row["domain"]
+        for row in read_rows(p_usage):
+            all_usage[row.get("user", "")] = [to_int(row.get("uplink_bytes")), to_int(row.get("downlink_bytes"))]
+
+    for key, c in conns.items():
+        all_conns[key] = all_conns.get(key, 0) + c
+    all_domains.update(domains)
+    for email, (up, down) in usage.items():
+        cur = all_usage.setdefault(email, [0, 0])
+        cur[0] += up
+        cur[1] += down
+
+    # Days not written by this collector yet (e.g. by the old scripts) are
+    # recomputed like before, but a file is never blanked without new data
+    if conns or not os.path.exists(p_conns):
+        write_csv(p_conns, ["user", "dst", "conn_count"],
+                  ([u, d, c] for (u, d), c in sorted(all_conns.items())))
+    if domains or not os.path.exists(p_domains):
+        write_csv(p_domains, ["dst", "domain"], sorted(all_domains.items()))
+    if usage or not os.path.exists(p_usage):
+        write_csv(p_usage, ["user", "uplink_bytes", "downlink_bytes", "total_bytes"],
+                  ([u, up, down, up + down] for u, (up, down) in sorted(all_usage.items())))
+    if not (conns or usage or not os.path.exists(p_report)):
+        return
+    if not owned:
+        # report needs both sides: take whatever is on disk for the missing one
+        if not conns:
+            for row in read_rows(p_conns):
+                all_conns[(row.get("user", ""), row.get("dst", ""))] = to_int(row.get("conn_count"))
+        if not usage:
+            for row in read_rows(p_usage):
+                all_usage[row.get("user", "")] = [to_int(row.get("uplink_bytes")), to_int(row.get("downlink_bytes"))]
+
+    # access.log has no byte counts: a user's traffic for the day is split
+    # across destinations by their share of the user's connections
+    per_user_conns: Dict[str, int] = {}
+    for (u, _d), c in all_conns.items():
+        per_user_conns[u] = per_user_conns.get(u, 0) + c
+    report = []
+    for (u, d), c in sorted(all_conns.items()):
+        total = sum(all_usage.get(u, [0, 0]))
+        if total and per_user_conns.get(u):
+            report.append([u, d, total * c // per_user_conns[u]])
+    write_csv(p_report, ["user", "dst", "traffic_bytes"], report)
+
+
+PARTIAL_HEADER = ["hour", "user", "dst", "uplink_bytes", "downlink_bytes", "conn_count", "domain"]
+
+
+def partial_path(usage_dir: str, day: str) -> str:
+    return os.path.join(usage_dir, f"usage_{day}.partial")
+
+
+def append_partial(usage_dir: str, day: str, hour: int, conns: Dict[Tuple[str, str, int], int],
+                   domains: Dict[str, str], usage: Dict[str, List[int]]) -> None:
+    """Append one run's worth of hourly buckets to the partial snapshot of an open day"""
+    rows = [[h, u, d, 0, 0, c, ""] for (u, d, h), c in sorted(conns.items())]
+    rows += [[hour, "", ip, 0, 0, 0, dom] for ip, dom in sorted(domains.items())]
+    rows += [[hour, u, "", up, down, 0, ""] for u, (up, down) in sorted(usage.items())]
+    if not rows:
+        return
+    path = partial_path(usage_dir, day)
+    os.makedirs(usage_dir, exist_ok=True)
+    with open(path, "a", encoding="utf-8", newline="") as f:
+        w = csv.writer(f, lineterminator="\n")
+        if f.tell() == 0:
+            w.writerow(PARTIAL_HEADER)
+        w.writerows(rows)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def read_partial(path: str) -> Tuple[Dict[Tuple[str, str], int], Dict[str, str], Dict[str, List[int]]]:
+    """Collapse the hourly buckets of a partial snapshot into daily (conns, domains, usage)"""
+    conns: Dict[Tuple[str, str], int] = {}
+    domains: Dict[str, str] = {}
+    usage: Dict[str, List[int]] = {}
+    for row in read_rows(path):
+        user, dst = row.get("user", ""), row.get("dst", "")
+        if row.get("domain"):
+            domains[dst] = row["domain"]
+        elif dst:
+            conns[(user, dst)] = conns.get((user, dst), 0) + to_int(row.get("conn_count"))
+        elif user:
+            cur = usage.setdefault(user, [0, 0])
+            cur[0] += to_int(row.get("uplink_bytes"))
+            cur[1] += to_int(row.get("downlink_bytes"))
+    return conns, domains, usage
+
+
+def label_date() -> str:
+    if "--today" in sys.argv[1:]:
+        return dt.datetime.now().strftime("%Y-%m-%d")
+    env_date = os.environ.get("LABEL_DATE", "").strip()
+    if env_date:
+        return env_date
+    return (dt.datetime.now() - dt.timedelta(days=1)).strftime("%Y-%m-%d")
+
+
+def main():
+    """Main entry point"""
+    settings = load_settings()
+    usage_dir = settings.get("collector", {}).get("usage_dir", USAGE_DIR)
+    state = load_state()
+    label = label_date()
+
+    conns: Dict[str, Dict[Tuple[str, str, int], int]] = {}
+    domains: Dict[str, Dict[str, str]] = {}
+    lines = scan_access_log(state, conns, domains)
+
+    current = query_stats(settings)
+    first_snapshot = "stats" not in state
+    usage = stats_delta(state, current) if current is not None else {}
+    if current is None:
+        print("WARNING: Stats API unavailable, usage_*.csv not updated")
+    elif first_snapshot:
+        print("INFO: first Stats API snapshot saved as baseline, traffic is counted from the next run")
+
+    now = dt.datetime.now()
+    today = now.strftime("%Y-%m-%d")
+    owned = set(state.get("days") or [])
+    days = set(conns) | set(domains) | ({label} if current is not None else set())
+    # Partial snapshots of days that are over are folded even without new data
+    try:
+        days.update(name[6:16] for name in os.listdir(usage_dir)
+                    if name.startswith("usage_") and name.endswith(".partial") and name[6:16] < today)
+    except OSError:
+        pass
+    days = sorted(days)
+    try:
+        for day in days:
+            day_usage = usage if day == label else {}
+            if day >= today:
+                append_partial(usage_dir, day, now.hour, conns.get(day, {}), domains.get(day, {}), day_usage)
+                continue
+            day_conns: Dict[Tuple[str, str], int] = {}
+            day_domains: Dict[str, str] = {}
+            p_partial = partial_path(usage_dir, day)
+            has_partial = os.path.exists(p_partial)
+            if has_partial:
+                day_conns, day_domains, folded = read_partial(p_partial)
+                for email, (up, down) in day_usage.items():
+                    cur = folded.setdefault(email, [0, 0])
+                    cur[0] += up
+                    cur[1] += down
+                day_usage = folded
+            for (u, d, _h), c in conns.get(day, {}).items():
+                day_conns[(u, d)] = day_conns.get((u, d), 0) + c
+            day_domains.update(domains.get(day, {}))
+            write_day(usage_dir, day, day in owned, day_conns, day_domains, day_usage)
+            owned.add(day)
+            if has_partial:
+                os.remove(p_partial)
+    except OSError as e:
+        print(f"ERROR: Failed to write CSV: {e}", file=sys.stderr)
+        return 1
+
+    # Checkpoint only after the CSVs are on disk
+    cutoff = (dt.date.today() - dt.timedelta(days=STATE_KEEP_DAYS)).isoformat()
+    state["days"] = sorted(d for d in owned if d >= cutoff)
+    state["updated_at"] = dt.datetime.utcnow().replace(microsecond=0).isoformat() + "Z"
+    save_state(state)
+
+    print(f"Parsed {lines} access.log lines, {len(usage)} users with new traffic")
+    print(f"Updated days: {', '.join(days) if days else 'none'} (label {label})")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())